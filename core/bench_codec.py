@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+import pickle
+import sys
+import timeit
+from classes import Command, Msg
+
+# ----------------------------------------------------------------------------------------------------
+#
+# MICRO-BENCHMARK OF THE WIRE FORMAT
+#
+# ----------------------------------------------------------------------------------------------------
+
+
+def pickle_encode(msg):
+    """ Encoding used before the binary wire format. """
+    return pickle.dumps({"instance": msg.instance, "phase": msg.phase, "data": msg.data})
+
+
+def pickle_decode(encoded, msg):
+    decoded = pickle.loads(encoded)
+    msg.instance, msg.phase, msg.data = (decoded['instance'], decoded['phase'], decoded['data'])
+    return msg
+
+
+def sample_messages():
+    """ Return one message for the most frequent phases, with realistic values. """
+    batch = [str(20000 + i) for i in range(100)]
+    commands = [Command(1 << 32, seq, str(20000 + seq)) for seq in range(100)]
+    messages = []
+    for phase, data in [("REQUEST", {"client_id": 1 << 32, "seq": 42, "v": "12345"}),
+                        ("PHASE_2A", {"c_rnd": 1003, "c_val": "12345"}),
+                        ("PHASE_2B", {"v_rnd": 1003, "voters": 4, "v_val": "12345"}),
+                        ("DECISION", {"c_rnd": 1003, "v_val": "12345"}),
+                        ("PHASE_2A", {"c_rnd": 1003, "c_val": batch}),
+                        ("PHASE_2A", {"c_rnd": 1003, "c_val": commands})]:
+        messages.append(Msg(4242, phase, data))
+    return messages
+
+
+def benchmark(number):
+    """ Print, for each sample message, the size and the time to encode and decode it with both formats.
+
+        :param number: int
+            Number of repetitions of each measurement.
+    """
+    print(f"{'phase':<10} {'values':>6} {'pickle B':>9} {'struct B':>9} "
+          f"{'pickle us':>10} {'struct us':>10} {'speedup':>8}")
+    preallocated = Msg()
+    for msg in sample_messages():
+        encoded_pickle = pickle_encode(msg)
+        encoded_struct = msg.encode()
+        time_pickle = timeit.timeit(lambda: pickle_decode(pickle_encode(msg), preallocated), number=number)
+        time_struct = timeit.timeit(lambda: preallocated.decode(msg.encode()), number=number)
+        values = msg.data.get('c_val')
+        values = len(values) if isinstance(values, list) else 1
+        print(f"{msg.phase:<10} {values:>6} {len(encoded_pickle):>9} {len(encoded_struct):>9} "
+              f"{time_pickle / number * 1e6:>10.2f} {time_struct / number * 1e6:>10.2f} "
+              f"{time_pickle / time_struct:>7.2f}x")
+
+
+if __name__ == '__main__':
+    benchmark(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+import struct
+import sys
+import time
+import tracemalloc
+from classes import Proposer, Acceptor, Learner
+from simulation import SimNetwork
+from utils import create_network
+
+# ----------------------------------------------------------------------------------------------------
+#
+# MEMORY BENCHMARK OF THE INSTANCE STATES
+#
+# ----------------------------------------------------------------------------------------------------
+
+ROUND = struct.Struct('!q')
+ENCODED_ROUND = ROUND.pack(1003)
+VALUE = [str(20000 + i) for i in range(100)]    # shared by all the instances: only the states are measured
+
+
+def wire_round():
+    """ Return a round decoded from a message, a new int object like the rounds of the agents. """
+    return ROUND.unpack(ENCODED_ROUND)[0]
+
+
+def create_agent(cls):
+    """ Return an agent of class cls on a simulated network, with empty states. """
+    network = create_network([['clients', '239.0.0.1', '5000'], ['proposers', '239.0.0.1', '6000'],
+                              ['acceptors', '239.0.0.1', '7000'], ['learners', '239.0.0.1', '8000']])
+    role = {Proposer: 'proposers', Acceptor: 'acceptors', Learner: 'learners'}[cls]
+    ip, port = network[role]['ip'], network[role]['port']
+    return cls(ip=ip, port=port, p_id=1, network=network, transport=SimNetwork().transport(ip, port))
+
+
+# Each role fills the states of n decided instances with the writes of the protocol,
+# with the dicts used before the columns and with the InstanceStates of the agents.
+
+def proposer_dicts(n):
+    states = {}
+    for i in range(n):
+        states[i] = {"c_rnd": 2, "c_val": None, "v": None, "max_v_rnd": 0, "max_v_val": 0,
+                     "quorum1B": (0, 0), "quorum2B": (0, 0), "decided": False}
+        states[i]['v'] = VALUE
+        states[i]['c_rnd'] = wire_round()
+        states[i]['c_val'] = VALUE
+        states[i]['quorum2B'] = (wire_round(), 3)
+        states[i]['decided'] = True
+    return states
+
+
+def proposer_columns(n):
+    agent = create_agent(Proposer)
+    states = agent.states
+    for i in range(n):
+        agent.update_state(i)
+        state = states[i]
+        state['v'] = VALUE
+        state['c_rnd'] = wire_round()
+        state['c_val'] = VALUE
+        state['quorum2B_rnd'], state['quorum2B'] = wire_round(), 3
+        state['decided'] = True
+    return states
+
+
+def acceptor_dicts(n):
+    states = {}
+    for i in range(n):
+        states[i] = {"rnd": 0, "v_rnd": 0, "v_val": None}
+        states[i]['rnd'] = wire_round()
+        states[i]['v_rnd'] = wire_round()
+        states[i]['v_val'] = VALUE
+    return states
+
+
+def acceptor_columns(n):
+    agent = create_agent(Acceptor)
+    states = agent.states
+    for i in range(n):
+        agent.update_state(i)
+        state = states[i]
+        state['rnd'] = wire_round()
+        state['v_rnd'] = wire_round()
+        state['v_val'] = VALUE
+    return states
+
+
+def learner_dicts(n):
+    states = {}
+    for i in range(n):
+        states[i] = {'v': VALUE, 'learned': time.monotonic()}
+    return states
+
+
+def learner_columns(n):
+    states = create_agent(Learner).states
+    for i in range(n):
+        states.add(i, v=VALUE, learned=time.monotonic())
+    return states
+
+
+# The lookups of phase_1B and phase_2B (acceptors), phase_2A and decide (proposers), deliver (learners).
+
+def proposer_lookups(states, n):
+    for i in range(n):
+        if i in states and states[i]['decided']:
+            states[i]['c_val']
+
+
+def acceptor_lookups(states, n):
+    for i in range(n):
+        states[i]['rnd']
+        states[i]['v_rnd']
+        states[i]['v_val']
+
+
+def learner_lookups(states, n):
+    for i in range(n):
+        if i in states:
+            states[i]['v']
+            states[i]['learned']
+
+
+def measure(fill, lookups, n):
+    """ Return the bytes allocated by the states of n instances, and the seconds to fill them and to look them up. """
+    start = time.perf_counter()
+    states = fill(n)
+    fill_time = time.perf_counter() - start
+    start = time.perf_counter()
+    lookups(states, n)
+    lookup_time = time.perf_counter() - start
+    del states
+    tracemalloc.start()
+    states = fill(n)
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return size, fill_time, lookup_time
+
+
+def benchmark(n):
+    """ Print, for each role, the memory and the time per instance of the states with dicts and with columns.
+
+        :param n: int
+            Number of instances.
+    """
+    print(f"{'role':<9} {'layout':<8} {'B/inst':>7} {'MB':>8} {'fill us':>8} {'lookup us':>10} {'memory':>7}")
+    for role, dicts, columns, lookups in [("proposer", proposer_dicts, proposer_columns, proposer_lookups),
+                                          ("acceptor", acceptor_dicts, acceptor_columns, acceptor_lookups),
+                                          ("learner", learner_dicts, learner_columns, learner_lookups)]:
+        results = [("dicts", measure(dicts, lookups, n)), ("columns", measure(columns, lookups, n))]
+        for layout, (size, fill_time, lookup_time) in results:
+            print(f"{role:<9} {layout:<8} {size / n:>7.1f} {size / 2 ** 20:>8.1f} {fill_time / n * 1e6:>8.2f} "
+                  f"{lookup_time / n * 1e6:>10.2f} {results[0][1][0] / size:>6.1f}x")
+
+
+if __name__ == '__main__':
+    benchmark(int(sys.argv[1]) if len(sys.argv) > 1 else 1000000)
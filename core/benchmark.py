@@ -0,0 +1,314 @@
+#!/usr/bin/env python
+import argparse
+import asyncio
+import io
+import json
+import os
+import random
+import socket
+import struct
+import sys
+import tempfile
+import time
+from classes import Client, Msg, PHASES, unbundle
+from utils import create_network, group_network, import_config
+
+# ----------------------------------------------------------------------------------------------------
+#
+# END-TO-END BENCHMARK
+#
+# ----------------------------------------------------------------------------------------------------
+
+PAXOS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'paxos.py')
+ROLES = ['clients', 'proposers', 'acceptors', 'learners']
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+
+
+def write_config(path, ip, base_port, settings, processes=None):
+    """ Write a config file with a multicast group for each role, or with the address of each process.
+
+        :param path: str
+            The name of the config file.
+        :param ip: str
+            The multicast address used by all the roles.
+        :param base_port: int
+            Port of the clients, the other roles use the ports base_port + 100, + 200 and + 300
+            (the Paxos groups use the ports that follow those of the first group).
+        :param settings: dict
+            Other lines of the config file, like the number of acceptors and the quorums.
+        :param processes: dict
+            Unicast: the number of processes of each role. The process p_id listens on ip and on the port
+            of its role + p_id * groups (a learner process listens on the next groups - 1 ports too).
+    """
+    with open(path, 'w') as f:
+        for k, role in enumerate(ROLES):
+            if processes is None:
+                f.write(f"{role} {ip} {base_port + 100 * k}\n")
+                continue
+            for p_id in range(1, processes[role] + 1):
+                f.write(f"{role} {p_id} {ip} {base_port + 100 * k + p_id * settings['groups']}\n")
+        for key, value in settings.items():
+            f.write(f"{key} {value}\n")
+
+
+def cpu_seconds(pid):
+    """ Return the user + system CPU seconds used by a process, or None if it is not available. """
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+def percentile(values, p):
+    """ Return the p-th percentile (0-100) of a sorted list, None if the list is empty. """
+    if len(values) == 0:
+        return None
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+class PhaseCounter(asyncio.DatagramProtocol):
+
+    """ Passive member of the multicast groups counting the datagrams and the messages of each phase. """
+
+    def __init__(self):
+        self.counts = {}
+        self.datagrams = 0
+        self.counting = False
+
+    def datagram_received(self, data, address):
+        if self.counting and len(data) > 0 and data[0] < len(PHASES):
+            self.datagrams += 1
+            for msg in unbundle(data):
+                phase = PHASES[msg[0]]
+                self.counts[phase] = self.counts.get(phase, 0) + 1
+
+
+async def listen_groups(loop, ip, ports):
+    """ Join the multicast group on every port and count the messages with a single PhaseCounter. """
+    counter = PhaseCounter()
+    for port in ports:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, struct.pack('4sL',
+                        socket.inet_aton(ip), socket.INADDR_ANY))
+        sock.bind((ip, port))
+        sock.setblocking(False)
+        await loop.create_datagram_endpoint(lambda: counter, sock=sock)
+    return counter
+
+
+async def load_generator(client_id, ip, port, rate, value_size, duration, sent):
+    """ Send values to the proposers at a fixed rate. Each value carries the client id and
+        a sequence number, and is padded to value_size characters.
+
+        :param sent: dict
+            Filled with the sending time of each value.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, struct.pack('b', 1))
+    msg = Msg()
+    start = time.time()
+    seq = 0
+    while time.time() - start < duration:
+        now = time.time()
+        value = f"{client_id}:{seq}:"
+        value += 'x' * max(0, value_size - len(value))
+        msg.fill_REQUEST(value)
+        sock.sendto(msg.encode(), (ip, port))
+        sent[value] = now
+        seq += 1
+        delay = start + seq / rate - time.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+    sock.close()
+
+
+async def closed_loop_client(client_id, network, outstanding, value_size, duration, sent, committed,
+                             read_fraction=0, reads=None):
+    """ Keep outstanding requests in flight with the Client API: a new value is proposed as soon as
+        the commit of a previous one is acknowledged.
+
+        :param network: dict
+            The network of the group of the client.
+        :param committed: list
+            Filled with the latency in milliseconds from the request to the commit acknowledgement.
+        :param read_fraction: float
+            Fraction of the operations that are local reads of the leader instead of proposals.
+        :param reads: list
+            Filled with the latency in milliseconds of each read.
+    """
+    client = Client(ip=network['clients']['ip'], port=network['clients']['port'], p_id=client_id, network=network)
+    client.input = io.StringIO()        # the values are not read from stdin
+    client.max_outstanding = outstanding
+    await client.start()
+    end = time.time() + duration
+
+    async def worker(k):
+        seq = 0
+        choices = random.Random(client_id * 1000 + k)
+        while time.time() < end:
+            if choices.random() < read_fraction:
+                start = time.time()
+                await client.read()
+                reads.append((time.time() - start) * 1000)
+                continue
+            value = f"{client_id}:{k}:{seq}:"
+            value += 'x' * max(0, value_size - len(value))
+            sent[value] = time.time()
+            await client.submit(value)
+            committed.append((time.time() - sent[value]) * 1000)
+            seq += 1
+
+    await asyncio.gather(*[worker(k) for k in range(outstanding)])
+
+
+async def read_learner(process, delivered):
+    """ Record the delivery time of each value printed by a learner. """
+    while True:
+        line = await process.stdout.readline()
+        if not line:
+            break
+        delivered.append((line.decode().rstrip('\n'), time.time()))
+
+
+async def benchmark(args):
+    """ Run the processes, send the load and return the results as a dictionary. """
+    loop = asyncio.get_running_loop()
+    config = tempfile.NamedTemporaryFile('w', suffix='.conf', delete=False)
+    config.close()
+    settings = {'num_acceptors': args.acceptors, 'groups': args.groups}
+    if args.quorum1 is not None:
+        settings['phase1_quorum'] = args.quorum1
+    if args.quorum2 is not None:
+        settings['phase2_quorum'] = args.quorum2
+    if args.unicast:
+        # the messages are not visible from outside the processes, the counter stays empty
+        write_config(config.name, '127.0.0.1', args.base_port, settings,
+                     {'clients': args.clients, 'proposers': args.proposers * args.groups,
+                      'acceptors': args.acceptors * args.groups, 'learners': args.learners})
+        counter = PhaseCounter()
+    else:
+        write_config(config.name, args.ip, args.base_port, settings)
+        counter = await listen_groups(loop, args.ip, [args.base_port + 100 * k + g for k in range(len(ROLES))
+                                                      for g in range(args.groups)])
+
+    processes = {}
+
+    async def launch(role, p_id, stdout=None):
+        process = await asyncio.create_subprocess_exec(sys.executable, PAXOS, config.name, role, str(p_id),
+                                                       stdin=asyncio.subprocess.DEVNULL, stdout=stdout,
+                                                       limit=max(2 ** 16, 2 * args.value_size))    # longest line
+        processes[(role, p_id)] = process
+        return process
+
+    learners_delivered = {}
+    readers = []
+    try:
+        for p_id in range(1, args.acceptors * args.groups + 1):     # p_id belongs to the group (p_id - 1) % groups
+            await launch('acceptor', p_id)
+        await asyncio.sleep(0.5)
+        for p_id in range(1, args.learners + 1):
+            process = await launch('learner', p_id, stdout=asyncio.subprocess.PIPE)
+            learners_delivered[p_id] = []
+            readers.append(loop.create_task(read_learner(process, learners_delivered[p_id])))
+        await asyncio.sleep(0.5)
+        for p_id in range(1, args.proposers * args.groups + 1):
+            await launch('proposer', p_id)
+        await asyncio.sleep(args.warmup)
+
+        cpu_start = {key: cpu_seconds(process.pid) for key, process in processes.items()}
+        counter.counting = True
+        sent = {}
+        committed = []
+        reads = []
+        start = time.time()
+        if args.outstanding is None:
+            proposers_port = args.base_port + 100 * ROLES.index('proposers')
+            await asyncio.gather(*[load_generator(c, args.ip, proposers_port + (c - 1) % args.groups,
+                                                  args.rate, args.value_size, args.duration, sent)
+                                   for c in range(1, args.clients + 1)])
+        else:
+            network = create_network(import_config(config.name))
+            await asyncio.gather(*[closed_loop_client(c, group_network(network, (c - 1) % args.groups),
+                                                      args.outstanding, args.value_size, args.duration,
+                                                      sent, committed, args.read_fraction, reads)
+                                   for c in range(1, args.clients + 1)])
+        await asyncio.sleep(args.drain)
+        counter.counting = False
+        elapsed = time.time() - start
+        cpu_end = {key: cpu_seconds(process.pid) for key, process in processes.items()}
+    finally:
+        for process in processes.values():
+            if process.returncode is None:
+                process.terminate()
+        for process in processes.values():
+            await process.wait()
+        for reader in readers:
+            await reader
+        os.unlink(config.name)
+
+    latencies = sorted((t - sent[v]) * 1000 for v, t in learners_delivered[1] if v in sent)
+    committed.sort()
+    reads.sort()
+    cpu = {}
+    for (role, p_id) in processes:
+        if cpu_start[(role, p_id)] is not None and cpu_end[(role, p_id)] is not None:
+            cpu.setdefault(role, {})[p_id] = round(cpu_end[(role, p_id)] - cpu_start[(role, p_id)], 3)
+    return {
+        "parameters": vars(args),
+        "values_sent": len(sent),
+        "values_delivered": {p_id: len([v for v, t in d if v in sent]) for p_id, d in learners_delivered.items()},
+        "throughput": len(latencies) / args.duration,
+        "latency_ms": {"p50": percentile(latencies, 50), "p99": percentile(latencies, 99),
+                       "p999": percentile(latencies, 99.9), "max": latencies[-1] if latencies else None},
+        "commit_latency_ms": {"p50": percentile(committed, 50), "p99": percentile(committed, 99),
+                              "p999": percentile(committed, 99.9), "max": committed[-1] if committed else None},
+        "reads": len(reads),
+        "read_latency_ms": {"p50": percentile(reads, 50), "p99": percentile(reads, 99),
+                            "p999": percentile(reads, 99.9), "max": reads[-1] if reads else None},
+        "messages": counter.counts,
+        "messages_per_value": {phase: n / max(len(latencies), 1) for phase, n in counter.counts.items()},
+        "datagrams": counter.datagrams,
+        "datagrams_per_value": counter.datagrams / max(len(latencies), 1),
+        "cpu_seconds": cpu,
+        "elapsed": elapsed,
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="End-to-end benchmark of the paxos processes on loopback multicast.")
+    parser.add_argument('--groups', type=int, default=1, help="Paxos groups, the clients are partitioned among them")
+    parser.add_argument('--acceptors', type=int, default=3, help="acceptors of each group")
+    parser.add_argument('--proposers', type=int, default=2, help="proposers of each group")
+    parser.add_argument('--learners', type=int, default=2)
+    parser.add_argument('--quorum1', type=int, help="size of the phase 1 quorums (default: majority)")
+    parser.add_argument('--quorum2', type=int, help="size of the phase 2 quorums (default: majority)")
+    parser.add_argument('--clients', type=int, default=2, help="number of concurrent load generators")
+    parser.add_argument('--rate', type=float, default=1000, help="values per second sent by each client")
+    parser.add_argument('--outstanding', type=int,
+                        help="closed loop: each client keeps this number of requests waiting for their commit "
+                             "(default: open loop at --rate)")
+    parser.add_argument('--read-fraction', type=float, default=0,
+                        help="closed loop: fraction of the operations that are local reads of the leader")
+    parser.add_argument('--value-size', type=int, default=16, help="characters of each value")
+    parser.add_argument('--duration', type=float, default=5, help="seconds of load")
+    parser.add_argument('--warmup', type=float, default=3, help="seconds waited for the leader election")
+    parser.add_argument('--drain', type=float, default=1, help="seconds waited for the last decisions")
+    parser.add_argument('--ip', default='239.0.0.1')
+    parser.add_argument('--unicast', action='store_true',
+                        help="closed loop: every process listens on its own loopback port and the messages travel "
+                             "on TCP connections instead of multicast (the messages are not counted)")
+    parser.add_argument('--base-port', type=int, default=15000)
+    parser.add_argument('--output', help="file where the results are written (default: stdout)")
+    args = parser.parse_args()
+    if args.unicast and args.outstanding is None:
+        parser.error("--unicast needs the closed loop clients of --outstanding")
+
+    results = asyncio.run(benchmark(args))
+    if args.output is None:
+        print(json.dumps(results, indent=2))
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
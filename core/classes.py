@@ -1,13 +1,364 @@
-from threading import Thread
-import time
+import array
+import asyncio
+import collections
+import cProfile
+import hashlib
+import itertools
+import json
+import os
+import signal
 import socket
 import struct
 import sys
-import pickle
+import time
 import math
 from utils import print_stuff
 
 
+# ----------------------------------------------------------------------------------------------------
+#
+# WIRE FORMAT
+#
+# ----------------------------------------------------------------------------------------------------
+
+# Every message starts with a fixed layout (phase code, instance, int64/double fields of its phase)
+# packed with a single struct, followed by the variable fields of the phase.
+# Field kinds: 'q' int64, 'd' double, 'v' value, 'w' votes {instance: (v_rnd, v_val)}, 'm' decisions {instance: v}.
+# Values are tagged and length-prefixed: None, str, int, bytes, Command, Digest or list of values (batches of
+# strings are sent as a single payload of lines, batches of commands as an array of ids and a payload).
+# The messages sent to the same group in the same iteration of the event loop travel together in a datagram:
+# a BUNDLE is its phase code followed by the length-prefixed messages, and it is not decoded by Msg.
+
+PHASE_FIELDS = {
+    "REQUEST": (("client_id", "q"), ("seq", "q"), ("v", "v")),
+    "PHASE_1A": (("c_rnd", "q"),),
+    "PHASE_1B": (("rnd", "q"), ("voters", "q"), ("v_rnd", "q"), ("v_val", "v")),
+    "PHASE_1A_RANGE": (("c_rnd", "q"),),
+    "PHASE_1B_RANGE": (("rnd", "q"), ("voters", "q"), ("num_instance", "q"), ("part", "q"), ("parts", "q"),
+                       ("votes", "w")),
+    "PHASE_2A": (("c_rnd", "q"), ("c_val", "v")),
+    "PHASE_2B": (("v_rnd", "q"), ("voters", "q"), ("v_val", "v")),
+    "DECISION": (("c_rnd", "q"), ("v_val", "v")),
+    "NACK": (("rnd", "q"),),
+    "TRIMMED": (("trimmed", "q"), ("num_instance", "q")),
+    "BACKPRESSURE": (("pause", "d"),),
+    "leader_sender": (("p_id", "q"), ("rnd", "q")),
+    "catch_up_instance": (("num_instance", "v"), ("role", "v")),
+    "catch_up_learners": (("p_id", "q"), ("server", "q"), ("first", "q"), ("last", "q")),
+    "catch_up_chunk": (("p_id", "q"), ("last", "q"), ("decisions", "m")),
+    "catch_up_ack": (("p_id", "q"), ("server", "q"), ("next", "q")),
+    "update_c_rnd": (("c_rnd", "q"),),
+    "learner_watermark": (("p_id", "q"), ("last_delivered", "q")),
+    "snapshot_request": (("last_delivered", "q"),),
+    "SNAPSHOT": (("state", "v"),),
+    "skip": (("last", "q"),),
+    "COMMIT": (("ids", "v"),),
+    "LEASE_REQUEST": (("rnd", "q"), ("sent", "d"), ("duration", "d")),
+    "LEASE": (("rnd", "q"), ("voters", "q"), ("sent", "d")),
+    "LEASE_RELEASE": (("rnd", "q"),),
+    "READ": (("client_id", "q"), ("read_id", "q"), ("key", "v")),
+    "READ_REPLY": (("client_id", "q"), ("read_id", "q"), ("result", "v")),
+    "PAYLOAD": (("offset", "q"), ("digest", "v"), ("chunk", "v")),
+    "PAYLOAD_REQUEST": (("server", "q"), ("digest", "v"), ("role", "v"), ("offsets", "v")),
+    "PAYLOAD_ACK": (("voters", "q"), ("digest", "v")),
+    "BUNDLE": (),
+}
+PHASES = list(PHASE_FIELDS)
+PHASE_CODES = {phase: code for code, phase in enumerate(PHASES)}
+BUNDLE_CODE = PHASE_CODES["BUNDLE"]
+
+
+def build_layout(fields):
+    """ Return the layout of a phase: the struct of its fixed part, the names of its fixed fields,
+        its variable fields and, if its only variable field is a value, the struct of the fixed part
+        followed by the header of a str value (fast path for the most frequent messages).
+
+        :param fields: tuple
+            The (name, kind) pairs of the fields of the phase.
+    """
+    fixed = tuple(key for key, kind in fields if kind in 'qd')
+    fmt = '!Bq' + ''.join(kind for key, kind in fields if kind in 'qd')     # phase code, instance (-1 if None)
+    variable = tuple((key, kind) for key, kind in fields if kind not in 'qd')
+    with_str = None
+    if len(variable) == 1 and variable[0][1] == 'v':
+        with_str = struct.Struct(fmt + 'Bi')
+    return struct.Struct(fmt), fixed, variable, with_str
+
+
+PHASE_LAYOUTS = [build_layout(PHASE_FIELDS[phase]) for phase in PHASES]
+
+INT = struct.Struct('!q')
+VOTE = struct.Struct('!qq')         # instance, v_rnd
+LENGTH = struct.Struct('!i')        # length of dictionaries (-1 if None)
+TAGGED_INT = struct.Struct('!Bq')
+TAGGED_LENGTH = struct.Struct('!Bi')
+TAGGED_LINES = struct.Struct('!Bii')     # number of values, length of the payload
+TAGGED_COMMAND = struct.Struct('!Bqq')   # client_id, seq, followed by the value
+TAGGED_DIGEST = struct.Struct('!B32sq')  # SHA-256 and size of the payload
+TAG_NONE, TAG_STR, TAG_INT, TAG_LIST, TAG_STR_LIST, TAG_COMMAND, TAG_COMMAND_LIST = 0, 1, 2, 3, 4, 5, 6
+TAG_BYTES, TAG_DIGEST = 7, 8
+ENCODED_NONE = bytes([TAG_NONE])
+BUNDLE_HEADER = bytes([BUNDLE_CODE])
+
+
+class Command(collections.namedtuple('Command', ['client_id', 'seq', 'v'])):
+
+    """ Value proposed by a client with the id of its request, so that the request can be
+        acknowledged and a retried request is not delivered twice. It is delivered as its value.
+    """
+
+    __slots__ = ()
+
+    def __str__(self):
+        return str(self.v)
+
+
+class Digest(collections.namedtuple('Digest', ['digest', 'size'])):
+
+    """ Value proposed in place of a large value: the SHA-256 and the size of its payload.
+        The payload is sent once to acceptors and learners in PAYLOAD chunks, out of band,
+        so the messages of consensus keep a bounded size.
+    """
+
+    __slots__ = ()
+
+    @classmethod
+    def of(cls, payload):
+        return cls(hashlib.sha256(payload).digest(), len(payload))
+
+    def __str__(self):
+        return f"<{self.digest.hex()} {self.size} bytes>"
+
+
+def commands(v):
+    """ Return the commands contained in a value (or batch of values). """
+    if isinstance(v, Command):
+        return [v]
+    if isinstance(v, list):
+        return [value for value in v if isinstance(value, Command)]
+    return []
+
+
+def digests(v):
+    """ Return the digests of the large values contained in a value (or batch of values). """
+    return [command.v for command in commands(v) if isinstance(command.v, Digest)]
+
+
+def encode_value(parts, v):
+    """ Append the encoding of a value to parts.
+
+        :param parts: list
+            List of bytes that will be joined to build the message.
+        :param v: None, str, int, bytes, Command, Digest or list
+            Value to be encoded.
+    """
+    if v is None:
+        parts.append(ENCODED_NONE)
+    elif isinstance(v, str):
+        encoded = v.encode()
+        parts.append(TAGGED_LENGTH.pack(TAG_STR, len(encoded)))
+        parts.append(encoded)
+    elif isinstance(v, int):
+        parts.append(TAGGED_INT.pack(TAG_INT, v))
+    elif isinstance(v, Command):
+        parts.append(TAGGED_COMMAND.pack(TAG_COMMAND, v.client_id, v.seq))
+        encode_value(parts, v.v)
+    elif isinstance(v, Digest):
+        parts.append(TAGGED_DIGEST.pack(TAG_DIGEST, v.digest, v.size))
+    elif isinstance(v, bytes):
+        parts.append(TAGGED_LENGTH.pack(TAG_BYTES, len(v)))
+        parts.append(v)
+    elif isinstance(v, (list, tuple)):
+        if len(v) > 0 and isinstance(v[0], Command):
+            try:
+                joined = '\n'.join([command.v for command in v])
+            except (TypeError, AttributeError):     # not all the values are commands with a string
+                joined = None
+            if joined is not None and joined.count('\n') == len(v) - 1:
+                # batch of commands: the ids in a single array, the values in a single payload
+                encoded = joined.encode()
+                parts.append(TAGGED_LINES.pack(TAG_COMMAND_LIST, len(v), len(encoded)))
+                parts.append(struct.pack(f'!{2 * len(v)}q', *[x for command in v for x in command[:2]]))
+                parts.append(encoded)
+                return
+        try:
+            joined = '\n'.join(v)
+        except TypeError:           # not all the values are strings
+            joined = None
+        if joined is not None and joined.count('\n') == len(v) - 1:
+            # batch of strings without new lines: a single payload, split when decoded
+            encoded = joined.encode()
+            parts.append(TAGGED_LINES.pack(TAG_STR_LIST, len(v), len(encoded)))
+            parts.append(encoded)
+        else:
+            parts.append(TAGGED_LENGTH.pack(TAG_LIST, len(v)))
+            for value in v:
+                encode_value(parts, value)
+    else:
+        raise ValueError(f"Cannot encode value of type {type(v).__name__}")
+
+
+def encoded_size(v):
+    """ Return the size in bytes of the encoding of a value. Inside a batch, where the strings and the ids
+        of the commands share a single payload, the value takes at most this size.
+
+        :param v: None, str, int, bytes, Command, Digest or list
+            Value to be encoded.
+    """
+    parts = []
+    encode_value(parts, v)
+    return sum(len(part) for part in parts)
+
+
+def decode_value(encoded, offset):
+    """ Decode a value starting at offset.
+
+        :param encoded: bytes
+            The encoded message.
+        :param offset: int
+            Position of the value in the encoded message.
+        :return: tuple
+            The decoded value and the position following it.
+    """
+    tag = encoded[offset]
+    if tag == TAG_NONE:
+        return None, offset + 1
+    if tag == TAG_STR:
+        length = TAGGED_LENGTH.unpack_from(encoded, offset)[1]
+        offset += TAGGED_LENGTH.size
+        return encoded[offset:offset + length].decode(), offset + length
+    if tag == TAG_INT:
+        return TAGGED_INT.unpack_from(encoded, offset)[1], offset + TAGGED_INT.size
+    if tag == TAG_STR_LIST:
+        tag, count, length = TAGGED_LINES.unpack_from(encoded, offset)
+        offset += TAGGED_LINES.size
+        if count == 0:
+            return [], offset
+        return encoded[offset:offset + length].decode().split('\n'), offset + length
+    if tag == TAG_LIST:
+        count = TAGGED_LENGTH.unpack_from(encoded, offset)[1]
+        offset += TAGGED_LENGTH.size
+        values = []
+        for _ in range(count):
+            value, offset = decode_value(encoded, offset)
+            values.append(value)
+        return values, offset
+    if tag == TAG_COMMAND_LIST:
+        tag, count, length = TAGGED_LINES.unpack_from(encoded, offset)
+        offset += TAGGED_LINES.size
+        ids = struct.unpack_from(f'!{2 * count}q', encoded, offset)
+        offset += 16 * count
+        values = encoded[offset:offset + length].decode().split('\n')
+        return list(map(Command, ids[0::2], ids[1::2], values)), offset + length
+    if tag == TAG_COMMAND:
+        tag, client_id, seq = TAGGED_COMMAND.unpack_from(encoded, offset)
+        value, offset = decode_value(encoded, offset + TAGGED_COMMAND.size)
+        return Command(client_id, seq, value), offset
+    if tag == TAG_DIGEST:
+        tag, digest, size = TAGGED_DIGEST.unpack_from(encoded, offset)
+        return Digest(digest, size), offset + TAGGED_DIGEST.size
+    if tag == TAG_BYTES:
+        length = TAGGED_LENGTH.unpack_from(encoded, offset)[1]
+        offset += TAGGED_LENGTH.size
+        return encoded[offset:offset + length], offset + length
+    raise ValueError(f"Unknown value tag {tag}")
+
+
+def encode_field(parts, kind, v):
+    """ Append the encoding of a variable field of the given kind to parts. """
+    if kind == 'v':
+        encode_value(parts, v)
+    elif kind == 'w':
+        parts.append(LENGTH.pack(len(v)))
+        for instance, (v_rnd, v_val) in v.items():
+            parts.append(VOTE.pack(instance, v_rnd))
+            encode_value(parts, v_val)
+    elif kind == 'm':
+        if v is None:
+            parts.append(LENGTH.pack(-1))
+        else:
+            parts.append(LENGTH.pack(len(v)))
+            for instance, value in v.items():
+                parts.append(INT.pack(instance))
+                encode_value(parts, value)
+
+
+def decode_field(encoded, offset, kind):
+    """ Decode a variable field of the given kind starting at offset.
+
+        :return: tuple
+            The decoded field and the position following it.
+    """
+    if kind == 'v':
+        return decode_value(encoded, offset)
+    length, = LENGTH.unpack_from(encoded, offset)
+    offset += LENGTH.size
+    if length == -1:
+        return None, offset
+    entries = {}
+    for _ in range(length):
+        if kind == 'w':
+            instance, v_rnd = VOTE.unpack_from(encoded, offset)
+            value, offset = decode_value(encoded, offset + VOTE.size)
+            entries[instance] = (v_rnd, value)
+        else:
+            instance, = INT.unpack_from(encoded, offset)
+            entries[instance], offset = decode_value(encoded, offset + INT.size)
+    return entries, offset
+
+
+def bundle(messages, max_bytes):
+    """ Pack encoded messages in datagrams of at most max_bytes, keeping their order. A datagram with
+        a single message is the message itself, so a message larger than max_bytes is sent alone.
+
+        :param messages: list
+            The encoded messages sent to the same group.
+        :param max_bytes: int
+            Max size of a BUNDLE.
+        :return: list
+            The datagrams to be sent.
+    """
+    if len(messages) == 1:
+        return messages
+    datagrams = []
+    group = []
+    size = len(BUNDLE_HEADER)
+    for msg in messages:
+        if len(group) > 0 and size + LENGTH.size + len(msg) > max_bytes:
+            datagrams.append(pack_bundle(group))
+            group = []
+            size = len(BUNDLE_HEADER)
+        group.append(msg)
+        size += LENGTH.size + len(msg)
+    datagrams.append(pack_bundle(group))
+    return datagrams
+
+
+def pack_bundle(group):
+    """ Return a BUNDLE of the encoded messages, or the message itself if there is only one. """
+    if len(group) == 1:
+        return group[0]
+    parts = [BUNDLE_HEADER]
+    for msg in group:
+        parts.append(LENGTH.pack(len(msg)))
+        parts.append(msg)
+    return b''.join(parts)
+
+
+def unbundle(datagram):
+    """ Return the messages of a datagram: the messages of a BUNDLE, or the datagram itself. """
+    if datagram[0] != BUNDLE_CODE:
+        return [datagram]
+    messages = []
+    offset = 1
+    while offset < len(datagram):
+        length, = LENGTH.unpack_from(datagram, offset)
+        offset += LENGTH.size
+        messages.append(datagram[offset:offset + length])
+        offset += length
+    return messages
+
+
 # ----------------------------------------------------------------------------------------------------
 #
 # HANDLING MESSAGES
@@ -21,8 +372,11 @@ class Msg():
         It contains a method for each phase of the paxos algorithm
         and for some additional phases. Each method fills the message
         with the information related to that specific phase.
+        A Msg can be reused to decode many messages.
     """
 
+    __slots__ = ("instance", "phase", "data")
+
     def __init__(self, instance=None, phase=None, data=None):
         """
             :param instance: int, optional
@@ -37,57 +391,781 @@ class Msg():
         self.data = data
 
     def encode(self):
-        return pickle.dumps(vars(self))
+        code = PHASE_CODES[self.phase]
+        layout, fixed, variable, with_str = PHASE_LAYOUTS[code]
+        data = self.data
+        instance = -1 if self.instance is None else self.instance
+        if with_str is not None and type(data[variable[0][0]]) is str:     # fast path: single str value
+            encoded = data[variable[0][0]].encode()
+            return with_str.pack(code, instance, *[data[key] for key in fixed], TAG_STR, len(encoded)) + encoded
+        parts = [layout.pack(code, instance, *[data[key] for key in fixed])]
+        for key, kind in variable:
+            encode_field(parts, kind, data[key])
+        return b''.join(parts)
 
     def decode(self, encoded):
-        decoded = pickle.loads(encoded)
-        self.instance, self.phase, self.data = (decoded['instance'], decoded['phase'], decoded['data'])
+        layout, fixed, variable, with_str = PHASE_LAYOUTS[encoded[0]]
+        if with_str is not None and encoded[layout.size] == TAG_STR:       # fast path: single str value
+            values = with_str.unpack_from(encoded)
+            self.phase = PHASES[values[0]]
+            self.instance = None if values[1] == -1 else values[1]
+            data = dict(zip(fixed, values[2:-2]))
+            data[variable[0][0]] = encoded[with_str.size:with_str.size + values[-1]].decode()
+            self.data = data
+            return self
+        values = layout.unpack_from(encoded)
+        self.phase = PHASES[values[0]]
+        self.instance = None if values[1] == -1 else values[1]
+        data = dict(zip(fixed, values[2:]))
+        offset = layout.size
+        for key, kind in variable:
+            data[key], offset = decode_field(encoded, offset, kind)
+        self.data = data
         return self
 
     def __str__(self):
         return str((self.instance, self.phase, self.data))
 
-    def fill_REQUEST(self, v):
+    def fill_REQUEST(self, v, client_id=0, seq=0):
         self.phase = "REQUEST"
-        self.data = {"v": v}
+        self.data = {"client_id": client_id, "seq": seq, "v": v}
 
     def fill_PHASE_1A(self, c_rnd):
         self.phase = "PHASE_1A"
         self.data = {"c_rnd": c_rnd}
 
-    def fill_PHASE_1B(self, rnd, v_rnd, v_val):
+    def fill_PHASE_1B(self, rnd, v_rnd, v_val, voters):
         self.phase = "PHASE_1B"
-        self.data = {"rnd": rnd, "v_rnd": v_rnd, "v_val": v_val}
+        self.data = {"rnd": rnd, "v_rnd": v_rnd, "v_val": v_val, "voters": voters}
+
+    def fill_PHASE_1A_RANGE(self, c_rnd):
+        self.phase = "PHASE_1A_RANGE"
+        self.data = {"c_rnd": c_rnd}
+
+    def fill_PHASE_1B_RANGE(self, rnd, votes, num_instance, voters, part=0, parts=1):
+        self.phase = "PHASE_1B_RANGE"
+        self.data = {"rnd": rnd, "votes": votes, "num_instance": num_instance, "voters": voters,
+                     "part": part, "parts": parts}
 
     def fill_PHASE_2A(self, c_rnd, c_val):
         self.phase = "PHASE_2A"
         self.data = {"c_rnd": c_rnd, "c_val": c_val}
 
-    def fill_PHASE_2B(self, v_rnd, v_val):
+    def fill_PHASE_2B(self, v_rnd, v_val, voters):
         self.phase = "PHASE_2B"
-        self.data = {"v_rnd": v_rnd, "v_val": v_val}
+        self.data = {"v_rnd": v_rnd, "v_val": v_val, "voters": voters}
 
     def fill_DECISION(self, c_rnd, v_val):
         self.phase = "DECISION"
         self.data = {"c_rnd": c_rnd, "v_val": v_val}
 
-    def fill_leader_sender(self, p_id):
+    def fill_NACK(self, rnd):
+        self.phase = "NACK"
+        self.data = {"rnd": rnd}
+
+    def fill_TRIMMED(self, trimmed, num_instance):
+        self.phase = "TRIMMED"
+        self.data = {"trimmed": trimmed, "num_instance": num_instance}
+
+    def fill_BACKPRESSURE(self, pause):
+        self.phase = "BACKPRESSURE"
+        self.data = {"pause": pause}
+
+    def fill_leader_sender(self, p_id, rnd):
         self.phase = "leader_sender"
-        self.data = {"p_id": p_id}
+        self.data = {"p_id": p_id, "rnd": rnd}
 
     def fill_catch_up_instance(self, num_instance=None, role=None):
         self.phase = "catch_up_instance"
         self.data = {"num_instance": num_instance, "role": role}
 
-    def fill_catch_up_learners(self, decisions=None):
+    def fill_catch_up_learners(self, p_id, server, first, last):
         self.phase = "catch_up_learners"
-        self.data = decisions
+        self.data = {"p_id": p_id, "server": server, "first": first, "last": last}
+
+    def fill_catch_up_chunk(self, p_id, last, decisions):
+        self.phase = "catch_up_chunk"
+        self.data = {"p_id": p_id, "last": last, "decisions": decisions}
+
+    def fill_catch_up_ack(self, p_id, server, next_instance):
+        self.phase = "catch_up_ack"
+        self.data = {"p_id": p_id, "server": server, "next": next_instance}
+
+    def fill_learner_watermark(self, p_id, last_delivered):
+        self.phase = "learner_watermark"
+        self.data = {"p_id": p_id, "last_delivered": last_delivered}
+
+    def fill_snapshot_request(self, last_delivered):
+        self.phase = "snapshot_request"
+        self.data = {"last_delivered": last_delivered}
+
+    def fill_SNAPSHOT(self, state):
+        self.phase = "SNAPSHOT"
+        self.data = {"state": state}
+
+    def fill_COMMIT(self, ids):
+        self.phase = "COMMIT"
+        self.data = {"ids": ids}
+
+    def fill_LEASE_REQUEST(self, rnd, sent, duration):
+        self.phase = "LEASE_REQUEST"
+        self.data = {"rnd": rnd, "sent": sent, "duration": duration}
+
+    def fill_LEASE(self, rnd, voters, sent):
+        self.phase = "LEASE"
+        self.data = {"rnd": rnd, "voters": voters, "sent": sent}
+
+    def fill_LEASE_RELEASE(self, rnd):
+        self.phase = "LEASE_RELEASE"
+        self.data = {"rnd": rnd}
+
+    def fill_READ(self, client_id, read_id, key):
+        self.phase = "READ"
+        self.data = {"client_id": client_id, "read_id": read_id, "key": key}
+
+    def fill_READ_REPLY(self, client_id, read_id, result):
+        self.phase = "READ_REPLY"
+        self.data = {"client_id": client_id, "read_id": read_id, "result": result}
+
+    def fill_PAYLOAD(self, digest, offset, chunk):
+        self.phase = "PAYLOAD"
+        self.data = {"digest": digest, "offset": offset, "chunk": chunk}
+
+    def fill_PAYLOAD_REQUEST(self, server, digest, role, offsets):
+        self.phase = "PAYLOAD_REQUEST"
+        self.data = {"server": server, "digest": digest, "role": role, "offsets": offsets}
+
+    def fill_PAYLOAD_ACK(self, digest, voters):
+        self.phase = "PAYLOAD_ACK"
+        self.data = {"digest": digest, "voters": voters}
+
+    def fill_skip(self, last):
+        self.phase = "skip"
+        self.data = {"last": last}
 
     def update_c_rnd(self, c_rnd):
         self.phase = "update_c_rnd"
         self.data = {"c_rnd": c_rnd}
 
 
+# ----------------------------------------------------------------------------------------------------
+#
+# REQUEST IDS
+#
+# ----------------------------------------------------------------------------------------------------
+
+
+class RequestTable():
+
+    """ Set of request ids (client_id, seq). Every client numbers its requests from 0 and retries
+        them until they are committed, so for each client the table keeps the first seq not in the
+        set and the seqs after it that are in the set: its size is bounded by the outstanding requests.
+        The ids are added in instance order, and a client without requests in the last retention
+        instances is forgotten (after retention to 2 * retention instances): only the clients of
+        the recent instances stay in memory. Forgetting depends only on the instances, so all the
+        learners forget the same clients at the same point of the sequence of decisions.
+    """
+
+    def __init__(self, retention=100000):
+        """
+            :param retention: int
+                Instances after which the ids of a client without new requests can be forgotten.
+        """
+        self.clients = {}               # for each client, [first seq not in the set, seqs in the set after it, last instance]
+        self.retention = retention
+        self.next_expiry = retention    # instance from which the next add forgets the idle clients
+
+    def __contains__(self, request_id):
+        client_id, seq = request_id
+        entry = self.clients.get(client_id)
+        return entry is not None and (seq < entry[0] or seq in entry[1])
+
+    def add(self, client_id, seq, instance):
+        """ Add a request id, return False if it was already in the set.
+
+            :param client_id: int
+                The client of the request.
+            :param seq: int
+                The number of the request.
+            :param instance: int
+                The instance in which the request is decided.
+        """
+        if instance >= self.next_expiry:
+            self.expire(instance - self.retention)
+            self.next_expiry = instance + self.retention
+        entry = self.clients.get(client_id)
+        if entry is None:
+            entry = self.clients[client_id] = [0, set(), instance]
+        entry[2] = max(entry[2], instance)
+        if seq < entry[0] or seq in entry[1]:
+            return False
+        entry[1].add(seq)
+        while entry[0] in entry[1]:
+            entry[1].remove(entry[0])
+            entry[0] += 1
+        return True
+
+    def expire(self, instance):
+        """ Forget the clients whose last request is in an instance lower than instance. """
+        for client_id in [client_id for client_id, entry in self.clients.items() if entry[2] < instance]:
+            del self.clients[client_id]
+
+
+# ----------------------------------------------------------------------------------------------------
+#
+# TIMERS
+#
+# ----------------------------------------------------------------------------------------------------
+
+
+class TimerWheel():
+
+    """ Hashed timer wheel: each timer is stored in the slot of its deadline and a single timer
+        of the event loop advances the wheel by one slot per tick, firing the expired timers.
+        Scheduling, rescheduling and cancelling a timer cost O(1), and the wheel does not use
+        the event loop when it is empty.
+    """
+
+    def __init__(self, loop, tick, num_slots, callback):
+        """
+            :param loop: class
+                The event loop running the wheel.
+            :param tick: float
+                Seconds between two slots, the resolution of the timers.
+            :param num_slots: int
+                Number of slots. Longer timers wait for more than one turn of the wheel.
+            :param callback: function
+                Called with the key of each expired timer.
+        """
+        self.loop = loop
+        self.tick = tick
+        self.slots = [{} for i in range(num_slots)]     # for each slot, the deadline of each timer key
+        self.slot_of = {}                               # for each timer key, its slot
+        self.current = 0                                # slot of the last tick
+        self.current_time = 0                           # time of the last tick
+        self.callback = callback
+        self.handle = None                              # event loop timer of the next tick
+
+    def __len__(self):
+        return len(self.slot_of)
+
+    def schedule(self, key, delay):
+        """ Start the timer of key, replacing the previous one if any.
+
+            :param key: hashable
+                The key passed to the callback.
+            :param delay: float
+                Seconds after which the timer expires.
+        """
+        self.cancel(key)
+        now = self.loop.time()
+        if self.handle is None:
+            self.current_time = now
+            self.handle = self.loop.call_at(now + self.tick, self.advance)
+        deadline = now + delay
+        ticks = max(1, math.ceil((deadline - self.current_time) / self.tick))
+        slot = (self.current + ticks) % len(self.slots)
+        self.slots[slot][key] = deadline
+        self.slot_of[key] = slot
+
+    def cancel(self, key):
+        slot = self.slot_of.pop(key, None)
+        if slot is not None:
+            del self.slots[slot][key]
+
+    def advance(self):
+        """ Move the wheel to the current time, firing the timers of the slots passed. """
+        now = self.loop.time()
+        while self.current_time + self.tick <= now and len(self.slot_of) > 0:
+            self.current = (self.current + 1) % len(self.slots)
+            self.current_time += self.tick
+            slot = self.slots[self.current]
+            # timers with a later deadline wait for the next turn of the wheel
+            expired = [key for key, deadline in slot.items() if deadline < self.current_time + self.tick]
+            for key in expired:
+                del slot[key]
+                del self.slot_of[key]
+                self.callback(key)
+        if len(self.slot_of) > 0:
+            self.handle = self.loop.call_at(max(self.current_time + self.tick, now), self.advance)
+        else:
+            self.handle = None
+
+
+# ----------------------------------------------------------------------------------------------------
+#
+# FAILURE DETECTION
+#
+# ----------------------------------------------------------------------------------------------------
+
+
+class PhiAccrualDetector():
+
+    """ Phi accrual failure detector (Hayashibara et al.): the inter-arrival times of the last heartbeats
+        are modelled with a normal distribution, and the suspicion phi = -log10(P(the next heartbeat
+        arrives later than now)) grows continuously with the time since the last heartbeat. The leader is
+        suspected when phi reaches threshold, so the timeout adapts to the jitter and to the losses
+        of the network instead of being a fixed number of seconds.
+    """
+
+    def __init__(self, threshold=8, window=100, min_std=0.05, first_timeout=0.5):
+        """
+            :param threshold: float
+                Value of phi at which the leader is suspected: 8 means a wrong suspicion with
+                probability 10**-8 if the inter-arrival times are normal.
+            :param window: int
+                Number of inter-arrival times kept.
+            :param min_std: float
+                Min standard deviation in seconds, so that very regular heartbeats do not make
+                the timeout as short as their interval.
+            :param first_timeout: float
+                Timeout in seconds before two heartbeats have been received.
+        """
+        self.threshold = threshold
+        self.min_std = min_std
+        self.first_timeout = first_timeout
+        self.intervals = collections.deque(maxlen=window)   # last inter-arrival times
+        self.sum = 0                                        # sum and sum of squares of the intervals
+        self.sum_squares = 0
+        self.last = None                                    # arrival time of the last heartbeat
+
+    def heartbeat(self, now):
+        """ Record the arrival of a heartbeat at time now. """
+        if self.last is not None:
+            interval = now - self.last
+            if len(self.intervals) == self.intervals.maxlen:
+                oldest = self.intervals[0]
+                self.sum -= oldest
+                self.sum_squares -= oldest * oldest
+            self.intervals.append(interval)
+            self.sum += interval
+            self.sum_squares += interval * interval
+        self.last = now
+
+    def reset(self):
+        """ Forget the last arrival, so that a pause of the heartbeats (a change of leader) is not measured. """
+        self.last = None
+
+    def distribution(self):
+        """ Return the mean and the standard deviation of the inter-arrival times. """
+        mean = self.sum / len(self.intervals)
+        variance = max(0, self.sum_squares / len(self.intervals) - mean * mean)
+        return mean, max(self.min_std, math.sqrt(variance))
+
+    def phi(self, now):
+        """ Return the suspicion level at time now. """
+        if self.last is None:
+            return 0
+        if len(self.intervals) == 0:
+            return self.threshold * (now - self.last) / self.first_timeout
+        mean, std = self.distribution()
+        p_later = 0.5 * math.erfc((now - self.last - mean) / (std * math.sqrt(2)))
+        return -math.log10(max(p_later, 1e-300))
+
+    def timeout(self):
+        """ Return the seconds after the last heartbeat at which phi reaches the threshold. """
+        if len(self.intervals) == 0:
+            return self.first_timeout
+        mean, std = self.distribution()
+        # phi is increasing: find z with 0.5 * erfc(z / sqrt(2)) = 10**-threshold by bisection
+        low, high = 0.0, 40.0
+        for i in range(50):
+            z = (low + high) / 2
+            if -math.log10(max(0.5 * math.erfc(z / math.sqrt(2)), 1e-300)) < self.threshold:
+                low = z
+            else:
+                high = z
+        return mean + high * std
+
+
+# ----------------------------------------------------------------------------------------------------
+#
+# METRICS
+#
+# ----------------------------------------------------------------------------------------------------
+
+
+class Histogram():
+
+    """ Histogram of durations with a bucket for each power of 2 of microseconds: recording a value
+        costs a frexp and an increment, the percentiles are the upper bounds of their buckets.
+    """
+
+    __slots__ = ("buckets", "count", "total", "max")
+
+    def __init__(self):
+        self.buckets = [0] * 40         # bucket k counts the durations in [2**(k-1), 2**k) microseconds
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def record(self, seconds):
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+        self.buckets[min(39, max(0, math.frexp(seconds * 1e6)[1]))] += 1
+
+    def percentile(self, p):
+        """ Return an upper bound of the p-th percentile (0-100) in seconds. """
+        rank = self.count * p / 100
+        seen = 0
+        for k, n in enumerate(self.buckets):
+            seen += n
+            if seen >= rank and n > 0:
+                return min(2 ** k / 1e6, self.max)
+        return self.max
+
+    def summary(self):
+        if self.count == 0:
+            return {"count": 0}
+        return {"count": self.count, "mean_ms": self.total / self.count * 1000,
+                "p50_ms": self.percentile(50) * 1000, "p99_ms": self.percentile(99) * 1000,
+                "max_ms": self.max * 1000}
+
+
+class Metrics():
+
+    """ Counters and histograms of an agent, cheap enough to be always on: the messages and bytes
+        in and out of each phase, named counters, histograms of durations and an optional trace
+        of the events of one instance every trace_sample.
+    """
+
+    def __init__(self, trace_sample=0, trace_size=1000):
+        """
+            :param trace_sample: int
+                One instance every trace_sample is traced, 0 to trace nothing.
+            :param trace_size: int
+                Number of trace events kept, the oldest ones are dropped.
+        """
+        self.msgs_in = [0] * len(PHASES)        # for each phase code, messages received
+        self.bytes_in = [0] * len(PHASES)
+        self.msgs_out = [0] * len(PHASES)       # for each phase code, messages sent
+        self.bytes_out = [0] * len(PHASES)
+        self.counters = collections.Counter()
+        self.histograms = collections.defaultdict(Histogram)
+        self.trace_sample = trace_sample
+        self.traces = collections.deque(maxlen=trace_size)     # (instance, event, time)
+        self.timing = None          # in the profiling mode, for each phase code the histograms of decode, handle and send
+
+    def received(self, encoded):
+        self.msgs_in[encoded[0]] += 1           # the first byte of a message is its phase code
+        self.bytes_in[encoded[0]] += len(encoded)
+
+    def sent(self, encoded):
+        self.msgs_out[encoded[0]] += 1
+        self.bytes_out[encoded[0]] += len(encoded)
+
+    def observe(self, name, seconds):
+        self.histograms[name].record(seconds)
+
+    def enable_timing(self):
+        """ Time the decoding and the handling of every message received, and the sending of every datagram,
+            by phase (the handling includes the encoding of the messages that it sends).
+        """
+        self.timing = [(Histogram(), Histogram(), Histogram()) for _ in PHASES]
+
+    def trace(self, instance, event, now):
+        if self.trace_sample > 0 and instance % self.trace_sample == 0:
+            self.traces.append((instance, event, now))
+
+    def snapshot(self):
+        """ Return the metrics as a dict that can be serialized in JSON. """
+        phases = {}
+        for code, phase in enumerate(PHASES):
+            if self.msgs_in[code] > 0 or self.msgs_out[code] > 0:
+                phases[phase] = {"in": self.msgs_in[code], "bytes_in": self.bytes_in[code],
+                                 "out": self.msgs_out[code], "bytes_out": self.bytes_out[code]}
+        snapshot = {"phases": phases, "counters": dict(self.counters),
+                    "histograms": {name: h.summary() for name, h in self.histograms.items()},
+                    "traces": list(self.traces)}
+        if self.timing is not None:
+            snapshot["timing"] = {PHASES[code]: {step: h.summary() for step, h in zip(TIMING_STEPS, histograms)}
+                                  for code, histograms in enumerate(self.timing)
+                                  if any(h.count > 0 for h in histograms)}
+        return snapshot
+
+
+# ----------------------------------------------------------------------------------------------------
+#
+# PROFILING
+#
+# ----------------------------------------------------------------------------------------------------
+
+TIMING_STEPS = ("decode", "handle", "send")     # the histograms of Metrics.timing
+
+
+class Profiler():
+
+    """ Opt-in profiler of a process, written when the process is terminated: with kind 'cprofile' the
+        statistics of cProfile in path.prof, with kind 'sample' the Python stack sampled every interval
+        seconds of CPU time in path.folded, one "frame;frame;... microseconds" line per stack (the input of
+        flamegraph.pl). The metrics of the agents, with their per-phase timing, go in path.json.
+    """
+
+    def __init__(self, kind, path, interval=0.005):
+        """
+            :param kind: str
+                'cprofile' or 'sample'.
+            :param path: str
+                Path of the output files without their extension.
+            :param interval: float
+                Seconds of CPU time between two samples of the sampling profiler.
+        """
+        if kind not in ('cprofile', 'sample'):
+            raise ValueError(f"unknown profiler {kind}")
+        self.kind = kind
+        self.path = path
+        self.interval = interval
+        self.profile = None                     # cProfile.Profile of the process
+        self.stacks = collections.Counter()     # for each stack of code objects, the samples that found it
+
+    def start(self):
+        if self.kind == 'cprofile':
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+        else:
+            signal.signal(signal.SIGPROF, self.sample)
+            signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def sample(self, signum, frame):
+        """ Handler of SIGPROF: counts the stack of the interrupted frame, formatted only when it is written. """
+        stack = []
+        while frame is not None:
+            stack.append(frame.f_code)
+            frame = frame.f_back
+        self.stacks[tuple(stack)] += 1
+
+    def stop(self, agents):
+        """ Stop profiling and write the profile and the metrics of agents. """
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        if self.kind == 'cprofile':
+            self.profile.disable()
+            self.profile.dump_stats(self.path + '.prof')
+        else:
+            signal.setitimer(signal.ITIMER_PROF, 0)
+            with open(self.path + '.folded', 'w') as f:
+                for stack, samples in self.stacks.items():
+                    f.write(';'.join(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+                                     for code in reversed(stack)) + f" {round(samples * self.interval * 1e6)}\n")
+        with open(self.path + '.json', 'w') as f:
+            json.dump([agent.stats() for agent in agents], f, indent=2)
+
+
+# ----------------------------------------------------------------------------------------------------
+#
+# LARGE VALUES
+#
+# ----------------------------------------------------------------------------------------------------
+
+
+class PayloadStore():
+
+    """ Payloads of the large values, indexed by their Digest. A payload travels in chunks of chunk_size
+        bytes (the last one can be shorter), which are reassembled and checked against the digest.
+        When the complete payloads exceed max_bytes, the oldest ones are evicted.
+    """
+
+    def __init__(self, chunk_size=32768, max_bytes=2 ** 28, max_partial=1000):
+        """
+            :param chunk_size: int
+                Size of the chunks, it has to be the same for all the agents.
+            :param max_bytes: int
+                Bytes of complete payloads kept.
+            :param max_partial: int
+                Number of incomplete payloads kept, the oldest ones are dropped.
+        """
+        self.chunk_size = chunk_size
+        self.max_bytes = max_bytes
+        self.max_partial = max_partial
+        self.payloads = collections.OrderedDict()   # complete payloads, the oldest first
+        self.partial = {}                           # for each incomplete payload, its chunks by offset
+        self.size = 0                               # bytes of the complete payloads
+
+    def __contains__(self, digest):
+        return digest in self.payloads
+
+    def __len__(self):
+        return len(self.payloads)
+
+    def get(self, digest):
+        return self.payloads[digest]
+
+    def add(self, digest, payload):
+        """ Add a complete payload. """
+        if digest not in self.payloads:
+            self.partial.pop(digest, None)
+            self.payloads[digest] = payload
+            self.size += len(payload)
+            while self.size > self.max_bytes and len(self.payloads) > 1:
+                self.size -= len(self.payloads.popitem(last=False)[1])
+
+    def add_chunk(self, digest, offset, chunk):
+        """ Add a chunk of a payload.
+
+            :return: bool
+                True only if the chunk completed the payload.
+        """
+        if digest in self.payloads or offset % self.chunk_size != 0 or offset >= max(digest.size, 1):
+            return False
+        if digest not in self.partial and len(self.partial) >= self.max_partial:
+            del self.partial[next(iter(self.partial))]
+        chunks = self.partial.setdefault(digest, {})
+        chunks[offset] = chunk
+        if len(chunks) < len(range(0, max(digest.size, 1), self.chunk_size)):
+            return False
+        payload = b''.join(chunks[offset] for offset in sorted(chunks))
+        del self.partial[digest]
+        if Digest.of(payload) != digest:    # corrupted chunk, the payload has to be sent again
+            return False
+        self.add(digest, payload)
+        return True
+
+    def missing(self, digest):
+        """ Return the offsets of the chunks of a payload that did not arrive. """
+        chunks = self.partial.get(digest, {})
+        return [offset for offset in range(0, max(digest.size, 1), self.chunk_size) if offset not in chunks]
+
+    def chunks(self, digest, offsets=None):
+        """ Return the (offset, chunk) pairs of a complete payload, only those at offsets if not None. """
+        payload = self.payloads[digest]
+        if offsets is None:
+            offsets = range(0, max(len(payload), 1), self.chunk_size)
+        return [(offset, payload[offset:offset + self.chunk_size]) for offset in offsets
+                if offset % self.chunk_size == 0 and offset < max(len(payload), 1)]
+
+    def discard(self, digest):
+        """ Remove a payload, complete or not. """
+        payload = self.payloads.pop(digest, None)
+        if payload is not None:
+            self.size -= len(payload)
+        self.partial.pop(digest, None)
+
+
+# ----------------------------------------------------------------------------------------------------
+#
+# INSTANCE STATES
+#
+# ----------------------------------------------------------------------------------------------------
+
+
+class InstanceStates():
+
+    """ States of the paxos instances of an agent, stored by columns: every field is an array of
+        machine integers or doubles (a list for the values), indexed by the offset of the instance
+        from base. The instances are almost contiguous, so a field costs a few bytes per instance
+        instead of a dict with its boxed ints, and trimming removes a prefix of the columns.
+        The gaps between the instances are marked in the present column.
+    """
+
+    def __init__(self, **fields):
+        """
+            :param fields: tuple
+                For each field, the typecode of its array ('q' int64, 'd' double, 'b' bool,
+                None for any value) and the value of the field in a new instance.
+        """
+        self.fields = fields
+        self.columns = {name: [] if typecode is None else array.array(typecode)
+                        for name, (typecode, default) in fields.items()}
+        self.present = array.array('b')     # 1 for the instances in the states, 0 for the gaps
+        self.base = 0                       # instance of the first element of the columns
+        self.count = 0                      # number of instances in the states
+        self.view = InstanceState(self, None)   # view of the last instance looked up
+
+    def __contains__(self, instance):
+        offset = instance - self.base
+        return 0 <= offset < len(self.present) and self.present[offset] == 1
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        """ Iterate over the instances in the states, in increasing order. """
+        return itertools.compress(range(self.base, self.base + len(self.present)), self.present)
+
+    def __getitem__(self, instance):
+        view = self.view
+        if view.instance == instance:       # the handlers look up the same instance several times
+            return view
+        offset = instance - self.base
+        if not (0 <= offset < len(self.present) and self.present[offset] == 1):
+            raise KeyError(instance)
+        self.view = view = InstanceState(self, instance)
+        return view
+
+    def get(self, instance, default=None):
+        return self[instance] if instance in self else default
+
+    def add(self, instance, **values):
+        """ Add instance with the initial values of the fields, then set values.
+            If instance is already in the states, only values are set.
+
+            :param instance: int
+                Instance to be added.
+            :param values: any
+                Values of some fields of the instance.
+        """
+        if len(self.present) == 0:
+            self.base = instance
+        offset = instance - self.base
+        if offset == len(self.present):     # the instance following the last one, the common case
+            for name, (typecode, default) in self.fields.items():
+                self.columns[name].append(default)
+            self.present.append(1)
+            self.count += 1
+        else:
+            if offset < 0:
+                self.insert_gap(0, -offset)
+                self.base = instance
+                offset = 0
+            elif offset > len(self.present):
+                self.insert_gap(len(self.present), offset + 1 - len(self.present))
+            if self.present[offset] == 0:
+                self.present[offset] = 1
+                self.count += 1
+                for name, (typecode, default) in self.fields.items():
+                    self.columns[name][offset] = default
+        for name, value in values.items():
+            self.columns[name][offset] = value
+
+    def insert_gap(self, offset, length):
+        """ Insert length missing instances in the columns, before offset. """
+        for name, (typecode, default) in self.fields.items():
+            gap = [default] * length if typecode is None else array.array(typecode, [default]) * length
+            self.columns[name][offset:offset] = gap
+        self.present[offset:offset] = array.array('b', [0]) * length
+
+    def trim(self, instance):
+        """ Remove the instances lower than instance. """
+        offset = min(instance - self.base, len(self.present))
+        if offset > 0:
+            self.count -= self.present[:offset].count(1)
+            for column in self.columns.values():
+                del column[:offset]
+            del self.present[:offset]
+        if instance > self.base:
+            self.base = instance
+        if self.view.instance is not None and self.view.instance < instance:
+            self.view = InstanceState(self, None)
+
+
+class InstanceState():
+
+    """ The fields of an instance of InstanceStates, read and written like a dict. """
+
+    __slots__ = ('states', 'instance')
+
+    def __init__(self, states, instance):
+        self.states = states
+        self.instance = instance
+
+    def __getitem__(self, field):
+        return self.states.columns[field][self.instance - self.states.base]
+
+    def __setitem__(self, field, value):
+        self.states.columns[field][self.instance - self.states.base] = value
+
+
 # ----------------------------------------------------------------------------------------------------
 #
 # AGENTS AND ROLES
@@ -95,11 +1173,235 @@ class Msg():
 # ----------------------------------------------------------------------------------------------------
 
 
-class Agent(Thread):
+class MulticastTransport():
+
+    """ Transport of an agent on UDP multicast: the server socket joins the group
+        of the agent and receives its datagrams, the client socket sends datagrams.
+        When the server socket is readable, the datagrams already queued are received
+        in a burst, without going back to the event loop (and to epoll) for each one.
+    """
+
+    def __init__(self, ip, port):
+        """
+            :param ip: str
+                The multicast group of the agent.
+            :param port: int
+                The communication port of the agent.
+        """
+        self.ip = ip
+        self.port = port
+        self.receive_buffer = 2 ** 22       # bytes of the receive buffer (bursts of payload chunks), capped by net.core.rmem_max
+        self.max_burst = 64                 # max datagrams received at each wakeup, then the other agents and timers run
+        self.max_burst_bytes = 2 ** 16      # max bytes received at each wakeup (a few chunks of large values)
+        self.max_datagram = 2 ** 16         # size of the largest datagram
+        self.server = self.setup_server()   # socket for the server side
+        self.client = self.setup_client()   # socket for the client side
+        self.agent = None                   # agent receiving the datagrams
+
+    def setup_server(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, struct.pack('b', 1))
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.receive_buffer)
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, struct.pack('4sL',
+                        socket.inet_aton(self.ip), socket.INADDR_ANY))
+        return sock
+
+    def setup_client(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.settimeout(0.2)
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, struct.pack('b', 1))
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, struct.pack('4sL',
+                        socket.inet_aton(self.ip), socket.INADDR_ANY))
+        return sock
+
+    async def open(self, agent):
+        """ Bind the server socket and pass its datagrams to agent in the running event loop. """
+        self.server.bind((self.ip, self.port))
+        self.server.setblocking(False)
+        self.agent = agent
+        agent.loop.add_reader(self.server.fileno(), self.receive_burst)
+
+    def receive_burst(self):
+        """ Called by the event loop when the server socket is readable: receives the datagrams queued,
+            up to max_burst datagrams and max_burst_bytes bytes.
+        """
+        received = 0
+        for _ in range(self.max_burst):
+            try:
+                datagram = self.server.recv(self.max_datagram)
+            except (BlockingIOError, InterruptedError):     # no more datagrams queued
+                break       # the other errors of the socket are reported by the event loop
+            self.agent.receive_datagram(datagram)
+            received += len(datagram)
+            if received >= self.max_burst_bytes:
+                break
+
+    def send(self, ip, port, msg):
+        self.client.sendto(msg, (ip, port))
+
+
+class UnicastTransport():
 
-    """ Generic class representing paxos processes. It inherits from Thread. """
+    """ Transport of an agent on a network that does not route multicast: the agent listens on its own
+        host:port with TCP, and a datagram for a role is written to every process of the role (network['peers']),
+        on a persistent connection to each one, as a frame prefixed by its length. As with UDP, the datagrams
+        for a peer that cannot be reached, or whose connection has too many bytes waiting, are lost:
+        the protocol sends them again.
+    """
 
-    def __init__(self, role, ip, port, p_id, network):
+    def __init__(self, address, network):
+        """
+            :param address: tuple
+                The host and port on which the agent listens.
+            :param network: dict
+                The network of the agent, with the addresses of the processes of each role.
+        """
+        self.address = address
+        self.peers = {}                     # for each address of a role, the addresses of its processes
+        for role, processes in network['peers'].items():
+            self.peers[(network[role]['ip'], network[role]['port'])] = sorted(processes.values())
+        self.connections = {}               # for each peer address, its PeerConnection
+        self.max_buffer = 2 ** 22           # bytes waiting in a connection above which its datagrams are dropped
+        self.reconnect_delay = 0.1          # seconds after a failed connection before connecting again
+        self.server = None                  # TCP server accepting the connections of the peers
+        self.agent = None                   # agent receiving the datagrams
+
+    async def open(self, agent):
+        """ Listen on the address of the agent and pass the datagrams of every connection to agent. """
+        self.agent = agent
+        self.server = await agent.loop.create_server(lambda: FrameReader(agent), *self.address, reuse_address=True)
+
+    def send(self, ip, port, msg):
+        """ Write msg to all the processes of the role with address ip:port. """
+        frame = [LENGTH.pack(len(msg)), msg]
+        for address in self.peers.get((ip, port), ()):
+            connection = self.connections.get(address)
+            if connection is None or (connection.failed is not None and
+                                      self.agent.loop.time() - connection.failed >= self.reconnect_delay):
+                connection = PeerConnection(self, address)
+                self.connections[address] = connection
+            connection.write(frame)
+
+
+class PeerConnection(asyncio.Protocol):
+
+    """ Outgoing connection of a UnicastTransport to a peer. The frames written while it connects wait in pending. """
+
+    def __init__(self, owner, address):
+        self.owner = owner
+        self.transport = None               # asyncio transport, once connected
+        self.pending = []                   # frames written while connecting
+        self.pending_bytes = 0
+        self.failed = None                  # time at which the connection failed or was closed
+        owner.agent.loop.create_task(self.connect(address))
+
+    async def connect(self, address):
+        try:
+            await self.owner.agent.loop.create_connection(lambda: self, *address)
+        except OSError:
+            self.connection_lost(None)
+
+    def connection_made(self, transport):
+        self.transport = transport
+        transport.writelines(self.pending)
+        self.pending = []
+
+    def connection_lost(self, exc):
+        self.transport = None
+        self.pending = []
+        self.failed = self.owner.agent.loop.time()
+
+    def write(self, frame):
+        if self.transport is not None:
+            if self.transport.get_write_buffer_size() < self.owner.max_buffer:
+                self.transport.writelines(frame)
+                return
+        elif self.failed is None and self.pending_bytes < self.owner.max_buffer:
+            self.pending.extend(frame)
+            self.pending_bytes += len(frame[1])
+            return
+        self.owner.agent.metrics.counters['frames_dropped'] += 1
+
+
+class FrameReader(asyncio.Protocol):
+
+    """ Incoming connection of a UnicastTransport: splits the stream in frames and passes them to the agent. """
+
+    def __init__(self, agent):
+        self.agent = agent
+        self.buffer = bytearray()
+
+    def data_received(self, data):
+        buffer = self.buffer
+        buffer += data
+        offset = 0
+        while len(buffer) - offset >= LENGTH.size:
+            length, = LENGTH.unpack_from(buffer, offset)
+            end = offset + LENGTH.size + length
+            if end > len(buffer):
+                break
+            self.agent.receive_datagram(bytes(buffer[offset + LENGTH.size:end]))
+            offset = end
+        del buffer[:offset]
+
+
+def create_transport(role, ip, port, p_id, network):
+    """ Return the transport of an agent: a UnicastTransport if the config gives the address of each process,
+        otherwise a MulticastTransport on the group of the role.
+    """
+    if not any(network['peers'].values()):
+        return MulticastTransport(ip, port)
+    if p_id not in network['peers'][role]:
+        raise ValueError(f"no address for {role} {p_id} in the config")
+    return UnicastTransport(network['peers'][role][p_id], network)
+
+
+def run_agents(agents, profiler=None):
+    """ Run one or more agents forever, sharing a single event loop.
+
+        :param agents: list
+            The agents to be run.
+        :param profiler: class
+            Profiler of the process, started with the per-phase timing of the agents and written on SIGTERM
+            or SIGINT (then the signal terminates the process as usual). None to run without profiling.
+    """
+    async def main():
+        loop = asyncio.get_running_loop()
+        for agent in agents:
+            await agent.start()
+        if hasattr(signal, 'SIGUSR1'):      # kill -USR1 <pid> dumps the metrics of the agents
+            loop.add_signal_handler(signal.SIGUSR1, dump_stats)
+        if profiler is not None:            # the test scripts stop the processes with pkill
+            for signum in (signal.SIGTERM, signal.SIGINT):
+                loop.add_signal_handler(signum, stop, signum)
+        await asyncio.Event().wait()
+
+    def dump_stats():
+        for agent in agents:
+            agent.dump_stats()
+
+    def stop(signum):
+        profiler.stop(agents)
+        signal.signal(signum, signal.SIG_DFL)
+        os.kill(os.getpid(), signum)
+
+    if profiler is not None:
+        for agent in agents:
+            agent.metrics.enable_timing()
+        profiler.start()
+    asyncio.run(main())
+
+
+class Agent():
+
+    """ Generic class representing paxos processes. All the agents of a process
+        share a single asyncio event loop: datagrams arrive from the transport of the agent
+        and periodic tasks are scheduled with timer handles.
+    """
+
+    def __init__(self, role, ip, port, p_id, network, transport=None):
         """
             :param role: str
                 The paxos role of the process.
@@ -111,15 +1413,37 @@ class Agent(Thread):
                 The process id.
             :param network: dict
                 The network containing processes info.
+            :param transport: class
+                The transport used to send and receive datagrams, by default the one of the network (see create_transport).
         """
-        Thread.__init__(self)
         self.role = role
         self.ip = ip
         self.port = port
         self.p_id = p_id
-        self.server = self.setup_server()   # socket for the server side
-        self.client = self.setup_client()   # socket for the client side
         self.network = network
+        self.transport = transport if transport is not None else create_transport(role, ip, port, p_id, network)
+        self.loop = None                    # event loop running the agent
+        self.msg = Msg()                    # preallocated message, reused to decode every datagram
+        self.outbox = {}                    # for each (ip, port), the messages sent in this iteration of the event loop
+        self.max_bundle_bytes = 32768       # max size of a datagram bundling several messages
+
+        self.num_learners = 2               # number of learners that have to agree on the low watermark
+        self.watermarks = {}                # for each learner, the last instance it delivered
+        self.trimmed = 0                    # instances lower than this have been removed from the states
+        self.trim_interval = 100            # min number of instances removed by a single trim
+
+        self.catch_up_streams = {}          # for each learner catching up from this process, [next, last] instances
+        self.chunk_size = 256               # max number of decisions in a catch up chunk
+        self.chunk_bytes = 32768            # max size of the decisions in a catch up chunk
+
+        self.payloads = PayloadStore()      # payloads of the large values
+        self.fetching = {}                  # for each payload being fetched, [attempt, offsets requested, timer]
+        self.payload_timeout = 0.05         # seconds without chunks after which the payload is asked to another server
+        self.fetch_chunks = 4               # max chunks asked with a single payload request
+
+        self.metrics = Metrics()            # counters and histograms of the agent
+        self.stats_interval = 0             # seconds between two dumps of the metrics, 0 to dump them only on SIGUSR1
+        self.stats_output = sys.stderr      # where the metrics are dumped, one JSON object per line
 
     def __str__(self):
         return str((self.role, self.ip, self.port, self.p_id))
@@ -131,34 +1455,283 @@ class Agent(Thread):
         # to be implemented by subclasses
         pass
 
-    def setup_server(self):
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, struct.pack('b', 1))
-        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, struct.pack('4sL',
-                        socket.inet_aton(self.ip), socket.INADDR_ANY))
-        return sock
+    def handle_watermark(self, data):
+        """ Handles the receiving of the last instance delivered by a learner. When all the learners
+            delivered the instances up to the low watermark, the states of those instances are trimmed.
+
+            :param data: dict
+                The p_id of the learner and its last delivered instance.
+        """
+        if data['last_delivered'] > self.watermarks.get(data['p_id'], -1):
+            self.watermarks[data['p_id']] = data['last_delivered']
+        if len(self.watermarks) >= self.num_learners:
+            low_watermark = min(self.watermarks.values())
+            if low_watermark + 1 - self.trimmed >= self.trim_interval:
+                self.trim(low_watermark + 1)
+
+    def trim(self, instance):
+        """ Remove from the states all the instances lower than instance.
+
+            :param instance: int
+                First instance to be kept.
+        """
+        self.states.trim(instance)
+        print_stuff("{} trimmed instances from {} to {}", self, self.trimmed, instance - 1)
+        self.trimmed = instance
+
+    def add_votes(self, votes, rnd, voters, quorum):
+        """ Add the acceptors of a 1B or 2B message to the votes received in a round.
+            Each acceptor is a bit of the bitset, so a duplicated message does not count twice,
+            and the votes of an older round are discarded when the first vote of rnd arrives.
+
+            :param votes: tuple
+                The round and the bitset of the acceptors that already voted.
+            :param rnd: int
+                The round of the message.
+            :param voters: int
+                The bitset of the acceptors that sent the message.
+            :param quorum: int
+                Number of acceptors in a quorum.
+            :return: tuple
+                The new votes, and True only if they became a quorum with this message.
+        """
+        votes_rnd, bitset = votes
+        if votes_rnd != rnd:
+            bitset = 0
+        had_quorum = bin(bitset).count('1') >= quorum
+        bitset |= voters
+        return (rnd, bitset), not had_quorum and bin(bitset).count('1') >= quorum
+
+    def get_decision(self, instance):
+        """ Return the value decided in instance, or raise KeyError if it is not known.
+            To be implemented by the subclasses serving catch up requests.
+        """
+        raise KeyError(instance)
+
+    def serve_catch_up(self, data):
+        """ Handles the request of a learner that needs the decisions from data['first'] to data['last'].
+            The decisions are streamed in chunks, the next chunk is sent when the previous one is acknowledged.
+        """
+        self.catch_up_streams[data['p_id']] = [data['first'], data['last']]
+        self.send_catch_up_chunk(data['p_id'])
+
+    def handle_catch_up_ack(self, data):
+        """ Handles the acknowledgement of a chunk by a learner that is catching up. """
+        if data['p_id'] in self.catch_up_streams:
+            self.catch_up_streams[data['p_id']][0] = data['next']
+            self.send_catch_up_chunk(data['p_id'])
+
+    def send_catch_up_chunk(self, p_id):
+        """ Sends to a learner the next chunk of decisions of its catch up. An empty chunk ends the stream:
+            its last instance is lower than the first one if the next decisions are not known yet,
+            otherwise the decisions needed have been trimmed.
+
+            :param p_id: int
+                The learner that is catching up.
+        """
+        first, last = self.catch_up_streams[p_id]
+        if first > last:
+            del self.catch_up_streams[p_id]
+            return
+        decisions = {}
+        size = 0
+        instance = first
+        while instance <= last and len(decisions) < self.chunk_size and size < self.chunk_bytes:
+            try:
+                decisions[instance] = self.get_decision(instance)
+            except KeyError:
+                break
+            size += len(str(decisions[instance])) + 16     # rough encoded size of the decision
+            instance += 1
+        if len(decisions) == 0:
+            del self.catch_up_streams[p_id]
+            if first >= self.trimmed:
+                last = first - 1
+        msg = Msg(first)
+        msg.fill_catch_up_chunk(p_id, last, decisions)
+        msg_encoded = msg.encode()
+        self.metrics.counters['catch_up_decisions_sent'] += len(decisions)
+        print_stuff("{} sends catch up chunk of {} decisions to learner {}", self, len(decisions), p_id)
+        self.send_role('learners', msg_encoded)
+
+    def send_payload(self, digest, role, offsets=None):
+        """ Sends the chunks of a payload to the agents of role.
+
+            :param digest: class
+                The Digest of the payload.
+            :param role: str
+                The role of the agents receiving the chunks.
+            :param offsets: list
+                Offsets of the chunks to be sent, None to send all of them.
+        """
+        msg = Msg()
+        chunks = self.payloads.chunks(digest, offsets)
+        print_stuff("{} sends {} chunks of payload {} to {}", self, len(chunks), digest, role)
+        for offset, chunk in chunks:
+            msg.fill_PAYLOAD(digest, offset, chunk)
+            self.send_role(role, msg.encode())
+
+    def handle_payload(self, data):
+        """ Handles a chunk of a payload. If the payload is being fetched and all the chunks requested
+            arrived, the next ones are requested immediately. If the first chunk received is not followed
+            by the others within payload_timeout seconds, the missing ones are fetched.
+        """
+        digest = data['digest']
+        if digest not in self.payloads and digest not in self.payloads.partial:
+            self.loop.call_later(self.payload_timeout, self.check_payload, digest)
+        if self.payloads.add_chunk(digest, data['offset'], data['chunk']):
+            fetch = self.fetching.pop(digest, None)
+            if fetch is not None and fetch[2] is not None:
+                fetch[2].cancel()
+            self.payload_ready(digest)
+        elif digest in self.fetching and digest not in self.payloads:
+            requested = self.fetching[digest][1]
+            if data['offset'] in requested:
+                requested.discard(data['offset'])
+                if len(requested) == 0:
+                    self.request_payload(digest)
+
+    def check_payload(self, digest):
+        if digest in self.payloads.partial:
+            self.fetch_payload(digest)
+
+    def payload_ready(self, digest):
+        # to be implemented by subclasses
+        pass
 
-    def setup_client(self):
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        sock.settimeout(0.2)
-        sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, struct.pack('b', 1))
-        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, struct.pack('4sL',
-                        socket.inet_aton(self.ip), socket.INADDR_ANY))
-        return sock
+    def fetch_payload(self, digest):
+        """ Starts fetching the chunks of a payload that did not arrive. """
+        if digest not in self.payloads and digest not in self.fetching:
+            self.metrics.counters['payloads_fetched'] += 1
+            self.fetching[digest] = [0, set(), None]
+            self.request_payload(digest)
+
+    def request_payload(self, digest):
+        """ Asks the next missing chunks of a payload to a server: the client that sent it (server 0)
+            or an acceptor, identified by its position in the group from 1 to num_acceptors.
+            A different server is asked every time a request gets no chunks for payload_timeout seconds.
+            Acceptors ask the client first, which keeps the payload until the commit, learners ask an
+            acceptor first, since a phase 2 quorum of acceptors has the payloads of the decided values.
+        """
+        fetch = self.fetching[digest]
+        if fetch[2] is not None:
+            fetch[2].cancel()
+        if self.role == 'acceptors':
+            rank = (self.p_id - 1) // self.network['groups'] + 1
+            servers = [0] + [k for k in range(1, self.network['quorums']['num_acceptors'] + 1) if k != rank]
+            server = servers[fetch[0] % len(servers)]
+        else:
+            servers = list(range(1, self.network['quorums']['num_acceptors'] + 1)) + [0]
+            server = servers[(self.p_id + fetch[0]) % len(servers)]
+        offsets = self.payloads.missing(digest)[:self.fetch_chunks]
+        fetch[1] = set(offsets)
+        role = 'clients' if server == 0 else 'acceptors'
+        msg = Msg()
+        msg.fill_PAYLOAD_REQUEST(server, digest, self.role, offsets)
+        msg_encoded = msg.encode()
+        print_stuff("{} sends msg {} to {}", self, msg, role)
+        self.send_role(role, msg_encoded)
+        fetch[2] = self.loop.call_later(self.payload_timeout, self.payload_expired, digest)
+
+    def payload_expired(self, digest):
+        fetch = self.fetching[digest]
+        fetch[0] += 1
+        fetch[2] = None
+        self.request_payload(digest)
+
+    def serve_payload(self, data):
+        """ Handles the request of a payload, the chunks are sent if the payload is complete here. """
+        if data['digest'] in self.payloads:
+            self.send_payload(data['digest'], data['role'], data['offsets'])
+
+    async def start(self):
+        """ Open the transport and start receiving messages in the running event loop. """
+        self.loop = asyncio.get_running_loop()
+        await self.transport.open(self)
+        print_stuff("{} is listening", self)
+        self.on_start()
+        if self.stats_interval > 0:
+            self.loop.call_later(self.stats_interval, self.dump_stats_periodically)
+
+    def on_start(self):
+        # to be implemented by subclasses
+        pass
 
-    def run(self):
-        self.server.bind((self.ip, self.port))
-        print_stuff(f"{self} is listening")
-        while True:
-            encoded_msg, address = self.server.recvfrom(2**16)
-            msg = Msg()
-            msg.decode(encoded_msg)
-            self.receive_msg(msg)       # behave in a specific way based on the process role
+    def run(self, profiler=None):
+        """ Run the agent alone in a new event loop, with an optional Profiler. """
+        run_agents([self], profiler)
+
+    def receive_datagram(self, encoded_msg):
+        """ Decode the messages of a datagram received by the server socket and handle them. """
+        self.metrics.counters['datagrams_received'] += 1
+        if encoded_msg[0] == BUNDLE_CODE:
+            self.metrics.received(encoded_msg)
+        if self.metrics.timing is not None:
+            self.receive_timed(encoded_msg)
+            return
+        for encoded in unbundle(encoded_msg):
+            self.metrics.received(encoded)
+            self.receive_msg(self.msg.decode(encoded))     # behave in a specific way based on the process role
+
+    def receive_timed(self, encoded_msg):
+        """ receive_datagram of the profiling mode, timing the decoding and the handling of each message. """
+        timing = self.metrics.timing
+        for encoded in unbundle(encoded_msg):
+            self.metrics.received(encoded)
+            start = time.perf_counter()
+            msg = self.msg.decode(encoded)
+            decoded = time.perf_counter()
+            self.receive_msg(msg)
+            decode, handle, _ = timing[encoded[0]]
+            decode.record(decoded - start)
+            handle.record(time.perf_counter() - decoded)
 
     def send_msg(self, ip, port, msg):
-        self.client.sendto(msg, (ip, port))
+        """ Queue a message for the group ip:port. The messages queued during an iteration of the event loop
+            are sent at its end, those for the same group bundled in as few datagrams as possible.
+        """
+        self.metrics.sent(msg)
+        if len(self.outbox) == 0:
+            self.loop.call_soon(self.flush)
+        self.outbox.setdefault((ip, port), []).append(msg)
+
+    def send_role(self, role, msg):
+        """ Send a message to all the processes of a role: its multicast group, or each of its processes
+            with a UnicastTransport.
+        """
+        self.send_msg(self.network[role]['ip'], self.network[role]['port'], msg)
+
+    def flush(self):
+        """ Send the messages queued by send_msg. """
+        outbox = self.outbox
+        self.outbox = {}
+        timing = self.metrics.timing
+        for (ip, port), messages in outbox.items():
+            for datagram in bundle(messages, self.max_bundle_bytes):
+                self.metrics.counters['datagrams_sent'] += 1
+                if datagram[0] == BUNDLE_CODE:
+                    self.metrics.sent(datagram)
+                if timing is None:
+                    self.transport.send(ip, port, datagram)
+                else:
+                    start = time.perf_counter()
+                    self.transport.send(ip, port, datagram)
+                    timing[datagram[0]][2].record(time.perf_counter() - start)
+
+    def stats(self):
+        """ Return the metrics of the agent, the subclasses add the state of their role. """
+        stats = {"role": self.role, "p_id": self.p_id, "time": self.loop.time()}
+        stats.update(self.metrics.snapshot())
+        return stats
+
+    def dump_stats(self):
+        """ Write the metrics on stats_output as a line of JSON. """
+        self.stats_output.write(json.dumps(self.stats()) + '\n')
+        self.stats_output.flush()
+
+    def dump_stats_periodically(self):
+        self.dump_stats()
+        self.loop.call_later(self.stats_interval, self.dump_stats_periodically)
 
     def receive_msg(self, msg):
         # to be implemented by subclasses
@@ -167,30 +1740,224 @@ class Agent(Thread):
 
 class Client(Agent):
 
+    """ Class representing client agent. Every request carries the id (client_id, seq) and is sent
+        again every retry_timeout seconds until the leader acknowledges its commit with a COMMIT
+        message, the learners deliver a retried request only once.
+    """
+
     def __init__(self, *args, **kwargs):
         Agent.__init__(self, role="clients", *args, **kwargs)
         self.num_instance = 0
-
-    def run(self):
+        self.pause_until = 0            # time until which the client does not send requests (backpressure)
+        self.sender = None              # task sending the values read from stdin
+        self.input = sys.stdin          # file from which the values to be proposed are read
+        self.client_id = (self.p_id << 32) | (os.getpid() & 0xffffffff)     # new id for every run of the client
+        self.seq = 0                    # seq of the next request
+        self.outstanding = {}           # for each request not committed yet, [value, future, time of the last send, time of the first send]
+        self.max_outstanding = 64       # max number of requests not committed yet
+        self.slots = None               # semaphore limiting the outstanding requests
+        self.retry_timeout = 0.5        # seconds after which a request not committed is sent again
+        self.retry_handle = None        # timer sending again the requests not committed
+        self.read_id = 0                # id of the next read
+        self.reads = {}                 # for each read not answered yet, [key, future, time of the last send, time of the first send]
+        self.payload_threshold = 8192   # bytes from which a value is sent out of band and its Digest is proposed, 0 never
+        self.uploads = {}               # for each payload sent, bitset of the acceptors that stored it
+        if isinstance(self.transport, MulticastTransport):
+            self.transport.max_burst = 1    # clients sharing a process take turns at each datagram, so that none lags behind
+
+    def on_start(self):
+        self.slots = asyncio.Semaphore(self.max_outstanding)
+        self.sender = self.loop.create_task(self.send_stdin())
+
+    async def send_stdin(self):
+        """ Send a request for each line of the input. The lines of stdin are read in a separate thread,
+            so that reading from a terminal or a pipe does not block the event loop.
+        """
         while True:
-            # v = input()
-            # self.request(v)
-            for value in sys.stdin:
-                value = value.strip()
-                self.request(value)
-                time.sleep(0.001)
-
-    def request(self, v):
+            if self.input is sys.stdin:
+                value = await self.loop.run_in_executor(None, self.input.readline)
+            else:
+                value = self.input.readline()
+            if value == '':             # end of stdin
+                break
+            value = value.strip()
+            pause = self.pause_until - self.loop.time()
+            if pause > 0:
+                await asyncio.sleep(pause)
+            await self.slots.acquire()
+            self.propose(value).add_done_callback(lambda future: self.slots.release())
+
+    async def submit(self, v):
+        """ Propose a value, waiting for a free slot if max_outstanding requests are not committed yet.
+
+            :param v: int or str
+                Value to be proposed.
+            :return: int or None
+                The instance in which the value is committed (None if the commit was acknowledged after a retry).
+        """
+        async with self.slots:
+            return await self.propose(v)
+
+    def propose(self, v):
+        """ Send a new request without waiting for a free slot.
+
+            :param v: int or str
+                Value to be proposed.
+            :return: asyncio.Future
+                Future done when the value is committed.
+        """
+        if isinstance(v, str) and 0 < self.payload_threshold <= len(v.encode()):
+            v = self.send_large_value(v)
+        seq = self.seq
+        self.seq += 1
+        future = self.loop.create_future()
+        self.outstanding[seq] = [v, future, self.loop.time(), self.loop.time()]
+        if not isinstance(v, Digest):   # a large value is requested when a quorum stored its payload
+            self.request(v, seq)
+        if self.retry_handle is None:
+            self.retry_handle = self.loop.call_later(self.retry_timeout, self.retry)
+        return future
+
+    def send_large_value(self, v):
+        """ Send the payload of a large value to acceptors and learners, out of band.
+            The payload is kept until the commit, to serve the chunks that are lost, and the value is
+            requested only when a phase 2 quorum of acceptors stored it, so a crash of the client
+            cannot leave the acceptors waiting for a payload that nobody has.
+
+            :param v: str
+                The large value.
+            :return: class
+                The Digest to be proposed in place of the value.
+        """
+        payload = v.encode()
+        digest = Digest.of(payload)
+        self.payloads.add(digest, payload)
+        self.uploads[digest] = 0
+        self.metrics.counters['large_values'] += 1
+        for role in ['acceptors', 'learners']:
+            self.send_payload(digest, role)
+        return digest
+
+    def stored(self, digest):
+        """ Return True if a phase 2 quorum of acceptors stored the payload. """
+        return digest not in self.uploads or bin(self.uploads[digest]).count('1') >= self.network['quorums']['phase2']
+
+    def handle_payload_ack(self, digest, voters):
+        """ Handles the acknowledgement of an acceptor that stored a payload: when it completes
+            a phase 2 quorum, the requests of the large value are sent.
+        """
+        if digest in self.uploads and not self.stored(digest):
+            self.uploads[digest] |= voters
+            if self.stored(digest):
+                for seq, request in self.outstanding.items():
+                    if request[0] == digest:
+                        self.request(digest, seq)
+
+    async def read(self, key=None):
+        """ Read the decided state from the leader, that answers without running consensus while
+            it holds a lease. The read is linearizable: it reflects every value committed before it.
+
+            :param key: int or None
+                The instance whose decided value is read, None to read the last instance of the decided prefix.
+            :return: int, str, list or None
+                The result of the read (see Proposer.read_state).
+        """
+        read_id = self.read_id
+        self.read_id += 1
+        future = self.loop.create_future()
+        self.reads[read_id] = [key, future, self.loop.time(), self.loop.time()]
+        self.send_read(key, read_id)
+        if self.retry_handle is None:
+            self.retry_handle = self.loop.call_later(self.retry_timeout, self.retry)
+        return await future
+
+    def retry(self):
+        """ Send again the requests that are not committed and the reads that are not answered
+            after retry_timeout seconds.
+        """
+        self.retry_handle = None
+        now = self.loop.time()
+        for seq, request in self.outstanding.items():
+            if request[2] + self.retry_timeout <= now:
+                request[2] = now
+                self.metrics.counters['retried_requests'] += 1
+                if isinstance(request[0], Digest) and not self.stored(request[0]):
+                    self.send_payload(request[0], 'acceptors')
+                else:
+                    self.request(request[0], seq)
+        for read_id, read in self.reads.items():
+            if read[2] + self.retry_timeout <= now:
+                read[2] = now
+                self.metrics.counters['retried_reads'] += 1
+                self.send_read(read[0], read_id)
+        waiting = [request[2] for request in self.outstanding.values()] + [read[2] for read in self.reads.values()]
+        if len(waiting) > 0:
+            self.retry_handle = self.loop.call_at(min(waiting) + self.retry_timeout, self.retry)
+
+    def commit(self, instance, ids):
+        """ Handles the acknowledgement of committed requests.
+
+            :param instance: int or None
+                The instance of the decision.
+            :param ids: list
+                client_id and seq of each committed request, one after the other.
+        """
+        for k in range(0, len(ids), 2):
+            if ids[k] == self.client_id:
+                request = self.outstanding.pop(ids[k + 1], None)
+                if request is not None and isinstance(request[0], Digest):
+                    self.payloads.discard(request[0])
+                    self.uploads.pop(request[0], None)
+                if request is not None and not request[1].done():
+                    self.metrics.observe('commit_latency', self.loop.time() - request[3])
+                    request[1].set_result(instance)
+
+    def receive_msg(self, msg):
+        """ Handle the receiving of a new message. """
+        print_stuff("{} receives msg {}", self, msg)
+
+        if msg.phase == "BACKPRESSURE":     # the window of the leader is full, slow down
+            self.pause_until = max(self.pause_until, self.loop.time() + msg.data['pause'])
+        elif msg.phase == "COMMIT":
+            self.commit(msg.instance, msg.data['ids'])
+        elif msg.phase == "READ_REPLY":
+            if msg.data['client_id'] == self.client_id:
+                read = self.reads.pop(msg.data['read_id'], None)
+                if read is not None and not read[1].done():
+                    self.metrics.observe('read_latency', self.loop.time() - read[3])
+                    read[1].set_result(msg.data['result'])
+        elif msg.phase == "PAYLOAD_REQUEST":
+            if msg.data['server'] == 0:
+                self.serve_payload(msg.data)
+        elif msg.phase == "PAYLOAD_ACK":
+            self.handle_payload_ack(msg.data['digest'], msg.data['voters'])
+
+    def stats(self):
+        stats = Agent.stats(self)
+        stats.update({"outstanding": len(self.outstanding), "reads": len(self.reads)})
+        return stats
+
+    def request(self, v, seq):
         """ Send a request to proposers.
 
                 :param v: int or str
                     Value to be proposed
+                :param seq: int
+                    Sequence number of the request.
         """
         msg = Msg()
-        msg.fill_REQUEST(v)
+        msg.fill_REQUEST(v, self.client_id, seq)
         msg_encoded = msg.encode()
-        print_stuff(f"{self} sends request msg {msg} to proposers")
-        self.send_msg(self.network['proposers']['ip'], self.network['proposers']['port'], msg_encoded)
+        print_stuff("{} sends request msg {} to proposers", self, msg)
+        self.send_role('proposers', msg_encoded)
+
+    def send_read(self, key, read_id):
+        """ Send a read to proposers, only the leader answers. """
+        msg = Msg()
+        msg.fill_READ(self.client_id, read_id, key)
+        msg_encoded = msg.encode()
+        print_stuff("{} sends read msg {} to proposers", self, msg)
+        self.send_role('proposers', msg_encoded)
 
 
 class Proposer(Agent):
@@ -199,28 +1966,79 @@ class Proposer(Agent):
 
     def __init__(self, *args, **kwargs):
         Agent.__init__(self, role="proposers", *args, **kwargs)
-        self.states = {}                # for each paxos instance, it saves the related values
+        self.states = InstanceStates(   # for each paxos instance, it saves the related values
+            c_rnd=('q', self.p_id + 1), c_val=(None, None), v=(None, None), max_v_rnd=('q', 0), max_v_val=(None, None),
+            quorum1B_rnd=('q', 0), quorum1B=('q', 0), quorum2B_rnd=('q', 0), quorum2B=('q', 0), decided=('b', False))
         self.leader = True              # the proposer is or is not the leader
         self.num_instance = -1          # greater instance identifying number seen
         self.instance_updated = False   # the proposer is or is not up to date with num_instance
         self.catch_up_counter = 0       # counter for quorum in the catch up phase
-        self.max_num_acceptors = 3      # needed to compute quorum
-
-        self.leader_sender = Thread(target=self.leader_sender)      # sends message if proposer is the leader
-        self.leader_listener = Thread(target=self.leader_listener)  # listen to the leader messages
-        self.leader_sender.daemon = True
-        self.leader_listener.daemon = True
-        self.leader_sender_interval = 1         # interval of seconds between leader_sender messages
-        self.leader_listener_interval = 2       # interval of seconds for leader_listener control
-        self.last_msg_leader_time = None        # time of the last message received from the leader
+        self.quorum1 = 2                # acceptors needed to complete phase 1 (and the catch up)
+        self.quorum2 = 2                # acceptors needed to decide a value in phase 2
+
+        self.multi_paxos = True         # the leader runs phase 1 once for all instances >= range_from
+        self.range_c_rnd = self.p_id + 1    # round used by the leader for all instances >= range_from
+        self.range_from = 0                 # first instance covered by the multi-paxos phase 1
+        self.range_ready = False            # phase 1 completed: new requests go directly to phase 2A
+        self.range_quorum1B = (0, 0)        # round and bitset of the acceptors that answered the multi-paxos phase 1
+        self.range_votes = {}               # for each instance, highest (v_rnd, v_val) reported by acceptors
+        self.range_parts = {}               # for each acceptor, the parts of its phase 1B received
+        self.range_started = 0              # time at which the multi-paxos phase 1 started
+
+        self.batching = True            # client values are proposed in batches, one batch per instance
+        self.batch = []                 # client values waiting to be proposed
+        self.batch_bytes = 0            # approximate size of the values in the batch
+        self.max_batch_size = 100       # max number of values in a batch
+        self.max_batch_bytes = 32768    # max size of a batch, it has to fit in a datagram (2**16 bytes)
+        self.max_batch_wait = 0.005     # max seconds a value waits before its batch is proposed
+        self.batch_handle = None        # timer proposing the batch after max_batch_wait
+
+        self.window_size = 10           # max number of instances in flight (proposed but not decided)
+        self.in_flight = {}             # for each instance in flight, the time at which it was proposed
+        self.pending = []               # values waiting for a free slot in the window
+        self.committed = RequestTable() # ids of the client requests committed
+        self.proposed = set()           # ids of the client requests proposed by the leader and not committed yet
+        self.last_committed = -1        # last instance of the prefix of decided instances
+        self.backpressure_pause = 0.01          # seconds clients have to pause when the window is full
+        self.last_backpressure_time = 0         # time of the last backpressure message sent to clients
+        self.window_stats = {"samples": 0, "occupancy": 0, "max_occupancy": 0, "full": 0,
+                             "retransmitted": 0, "escalated": 0}
+
+        self.retransmission = None      # timer wheel of the instances in flight and of the multi-paxos phase 1
+        self.wheel_tick = 0.002         # resolution of the retransmission timers
+        self.wheel_slots = 512          # slots of the timer wheel
+        self.retries = {}               # for each instance (or "range" for the phase 1), retransmissions in the round
+        self.max_retries = 3            # retransmissions after which the leader tries a new round
+        self.srtt = None                # smoothed round trip time from phase 2A to the quorum of 2B
+        self.rttvar = 0                 # variation of the round trip time
+        self.initial_rto = 0.05         # retransmission timeout before the first round trip is measured
+        self.min_rto = 0.005            # bounds of the retransmission timeout
+        self.max_rto = 1
+
+        self.leader_sender_interval = 0.1       # interval of seconds between leader_sender messages
+        self.leader_listener_interval = 0.5     # seconds after which the leader is suspected, before measuring heartbeats
+        self.leader_listener_handle = None      # timer firing if the leader does not send messages
+        self.leader_rnd = 0                     # highest round of another leader seen in heartbeats and NACKs
+        self.detector = PhiAccrualDetector(first_timeout=self.leader_listener_interval)
+        self.takeover_stagger = 0.05            # extra seconds before taking over, divided by p_id + 1
+        self.hint_interval = 1                  # seconds between the catch up hints of the leader to learners
+        self.last_hint_time = 0                 # time of the last hint
+
+        self.lease_duration = 0.5       # seconds of the leases requested to acceptors, 0 to never serve local reads
+        self.lease_margin = 0.1         # fraction of the lease not used by the leader, against clock drift
+        self.lease_expiry = 0           # time until which a phase 2 quorum of acceptors granted the lease
+        self.lease_grants = (0, 0)      # sending time and bitset of the acceptors granting the last lease request
+        self.lease_retry = 0.05         # min seconds between the lease requests of reads waiting for the lease
+        self.read_index = None          # instance to be decided before reading, after a phase 1 (None: no wait)
+        self.pending_reads = {}         # (client_id, read_id): key of the reads waiting for the lease
 
     def catch_up_instance(self):
         """ Sends a message to acceptors to know the updated num_instance. """
         msg = Msg()
         msg.fill_catch_up_instance(role="proposers")
         msg_encoded = msg.encode()
-        print_stuff(f"{self} sends catch up request to acceptors")
-        self.send_msg(self.network['acceptors']['ip'], self.network['acceptors']['port'], msg_encoded)
+        print_stuff("{} sends catch up request to acceptors", self)
+        self.send_role('acceptors', msg_encoded)
 
     def catch_up_request(self, instance):
         """ Sends a "client" request with specific instance to know the decision made in that instance.
@@ -231,14 +2049,14 @@ class Proposer(Agent):
         msg = Msg(instance)
         msg.fill_REQUEST(None)
         msg_encoded = msg.encode()
-        print_stuff(f"{self} sends catch up request to proposers")
-        self.send_msg(self.network['proposers']['ip'], self.network['proposers']['port'], msg_encoded)
+        print_stuff("{} sends catch up request to proposers", self)
+        self.send_role('proposers', msg_encoded)
 
     def catch_up_control(self):
         """ Check if the proposer is updated with all the instances in memory.
             If not, it asks for the missing instances.
         """
-        for i in range(0, self.num_instance + 1):
+        for i in range(self.trimmed, self.num_instance + 1):
             if i != -1 and i not in self.states:
                 self.catch_up_request(i)
 
@@ -255,166 +2073,773 @@ class Proposer(Agent):
             self.catch_up_counter += 1
             if msg.data['num_instance'] > self.num_instance:
                 self.num_instance = msg.data['num_instance']
-            if self.catch_up_counter == math.ceil((self.max_num_acceptors + 1) / 2):
+            if self.catch_up_counter == self.quorum1:
                 self.catch_up_counter = 0
                 self.instance_updated = True
                 print_stuff("Instance updated")
+                if self.leader and self.multi_paxos and not self.range_ready:
+                    self.phase_1A_range()
+                elif self.leader and not self.multi_paxos:
+                    self.start_instances()
         self.catch_up_control()         # after having updated num_instance, check to have all instances in memory
 
-    def catch_up_learners(self):
-        """ Handles the receiving of a request of update sent by learners.
-            The leader sends back to the learners a dictionary containing
-            all the values decided until now.
+    def start_instances(self):
+        """ Without Multi-Paxos, start the phase 1 of the instances allocated to requests received
+            before num_instance was updated.
         """
-        decisions = {}
-        for instance in self.states:
-            if self.states[instance]['c_val'] is not None:
-                decisions[int(instance)] = int(self.states[instance]['c_val'])
-            else:
-                decisions[int(instance)] = None
-        if len(decisions) == 0:
-            decisions = None
-        msg = Msg()
-        msg.fill_catch_up_learners(decisions)
-        msg_encoded = msg.encode()
-        print_stuff(f"{self} sends catch up learners to learners")
-        self.send_msg(self.network['learners']['ip'], self.network['learners']['port'], msg_encoded)
-
-    def run(self):
-        if not self.leader_sender.is_alive():
-            self.leader_sender.start()
-        if not self.leader_listener.is_alive():
-            self.leader_listener.start()
-        self.server.bind((self.ip, self.port))
-        print_stuff(f"{self} is listening")
+        for i in range(self.first_undecided(), self.num_instance + 1):
+            if i in self.states and not self.states[i]['decided'] and i not in self.in_flight:
+                self.phase_1A(i)
+
+    def get_decision(self, instance):
+        if instance in self.states and self.states[instance]['decided']:
+            return self.states[instance]['c_val']
+        raise KeyError(instance)
+
+    def on_start(self):
         self.catch_up_instance()
-        while True:
-            encoded_msg, address = self.server.recvfrom(2**16)
-            msg = Msg()
-            msg.decode(encoded_msg)
-            self.receive_msg(msg)
+        self.loop.call_later(self.leader_sender_interval, self.leader_sender)
+        self.retransmission = TimerWheel(self.loop, self.wheel_tick, self.wheel_slots, self.retransmit)
+
+    def receive_datagram(self, encoded_msg):
+        Agent.receive_datagram(self, encoded_msg)
+        self.check_window()         # decisions may have freed slots for pending values
+        if len(self.pending_reads) > 0:
+            self.serve_reads()      # the lease or the decisions may allow the reads
 
     def leader_sender(self):
-        """ Sends message if proposer is the leader. """
-        while True:
-            time.sleep(self.leader_sender_interval)
-            if self.leader:
+        """ Sends a heartbeat with the round of the leader if it can decide values, then schedules the next one. """
+        if self.leader:
+            self.renew_lease()
+            if self.can_lead():
+                self.send_heartbeat()
+            now = self.loop.time()
+            if self.last_committed >= 0 and now - self.last_hint_time >= self.hint_interval:
+                # learners that lost the last decisions catch them up
+                self.last_hint_time = now
                 msg = Msg()
-                msg.fill_leader_sender(self.p_id)
-                msg_encoded = msg.encode()
-                print_stuff(f"{self} sends msg: I AM THE LEADER")
-                # print(self.states)
-                self.send_msg(self.network['proposers']['ip'], self.network['proposers']['port'], msg_encoded)
+                msg.fill_catch_up_instance(num_instance=self.last_committed, role="proposers")
+                self.send_role('learners', msg.encode())
+        self.loop.call_later(self.leader_sender_interval, self.leader_sender)
+
+    def send_heartbeat(self):
+        msg = Msg()
+        msg.fill_leader_sender(self.p_id, self.range_c_rnd)
+        msg_encoded = msg.encode()
+        print_stuff("{} sends msg: I AM THE LEADER", self)
+        print_stuff("{} window {}", self, self.window_occupancy())
+        # print(self.states)
+        self.send_role('proposers', msg_encoded)
+
+    def can_lead(self):
+        """ Return True if the leader can decide values: its phase 1 completed and, with leases, a phase 2
+            quorum of acceptors grants it the lease. A leader that cannot reach the acceptors stops
+            sending heartbeats, so the other proposers suspect it and take over.
+        """
+        if not self.multi_paxos:
+            return self.leader
+        return (self.leader and self.range_ready
+                and (self.lease_duration == 0 or self.loop.time() < self.lease_expiry))
+
+    def renew_lease(self):
+        """ Request a new lease when less than half of the current one is left. """
+        now = self.loop.time()
+        if self.lease_expiry - now < self.lease_duration / 2 and now - self.lease_grants[0] >= self.lease_retry:
+            self.request_lease()
+
+    def request_lease(self):
+        """ Ask the acceptors to renew the lease. While a phase 2 quorum of acceptors grants it,
+            no other proposer can complete phase 1, so no value can be decided without the leader
+            and it can answer reads from its decided state.
+        """
+        if self.lease_duration > 0 and self.multi_paxos and self.range_ready:
+            self.lease_grants = (self.loop.time(), 0)
+            msg = Msg()
+            msg.fill_LEASE_REQUEST(self.range_c_rnd, self.loop.time(), self.lease_duration)
+            msg_encoded = msg.encode()
+            print_stuff("{} sends msg {} to acceptors", self, msg)
+            self.send_role('acceptors', msg_encoded)
+
+    def handle_lease(self, data):
+        """ Handles the grant of an acceptor. The lease is counted from the sending of the request,
+            before the acceptors start counting it.
+
+            :param data: dict
+                The round, the acceptor and the sending time of the request.
+        """
+        if data['rnd'] != self.range_c_rnd or data['sent'] < self.lease_grants[0]:
+            return
+        self.lease_grants, quorum = self.add_votes(self.lease_grants, data['sent'], data['voters'], self.quorum2)
+        if quorum:
+            acquired = self.lease_expiry <= self.loop.time()
+            self.lease_expiry = max(self.lease_expiry, data['sent'] + self.lease_duration * (1 - self.lease_margin))
+            if acquired:
+                self.send_heartbeat()   # the other candidates step down without waiting for the next heartbeat
+
+    def release_lease(self):
+        """ Give back the lease when stepping down, so that the new leader does not wait for it to expire. """
+        if self.lease_expiry > self.loop.time():
+            msg = Msg()
+            msg.fill_LEASE_RELEASE(self.range_c_rnd)
+            msg_encoded = msg.encode()
+            print_stuff("{} sends msg {} to acceptors", self, msg)
+            self.send_role('acceptors', msg_encoded)
+        self.lease_expiry = 0
+        self.lease_grants = (0, 0)
+        self.pending_reads = {}
+
+    def can_read(self):
+        """ Return True if the reads can be answered locally: the proposer is the leader, holds the lease
+            and knows the decisions of all the instances recovered by its phase 1.
+        """
+        if not (self.leader and self.range_ready and self.loop.time() < self.lease_expiry):
+            return False
+        if self.read_index is not None:
+            if self.last_committed < self.read_index:
+                return False
+            self.read_index = None
+        return True
+
+    def read_state(self, key):
+        """ Return the result of a read on the decided state: the value decided in instance key or,
+            if key is None, the last instance of the prefix of decided instances.
+
+            :param key: int or None
+                The instance to be read.
+        """
+        if key is None:
+            return self.last_committed
+        if key in self.states and self.states[key]['decided']:
+            return self.states[key]['c_val']
+        return None
+
+    def handle_read(self, client_id, read_id, key):
+        """ Answers a read if the lease allows it, otherwise the read waits for the lease. """
+        if not self.leader:
+            return
+        if self.can_read():
+            self.send_read_reply(client_id, read_id, self.read_state(key))
+        else:
+            self.pending_reads[(client_id, read_id)] = key
+            now = self.loop.time()
+            if now >= self.lease_expiry and now - self.lease_grants[0] >= self.lease_retry:
+                self.request_lease()    # the lease expired, do not wait for the next heartbeat
+
+    def serve_reads(self):
+        """ Answers the reads waiting for the lease. """
+        if self.can_read():
+            reads, self.pending_reads = self.pending_reads, {}
+            for (client_id, read_id), key in reads.items():
+                self.send_read_reply(client_id, read_id, self.read_state(key))
+
+    def send_read_reply(self, client_id, read_id, result):
+        msg = Msg()
+        msg.fill_READ_REPLY(client_id, read_id, result)
+        msg_encoded = msg.encode()
+        print_stuff("{} sends msg {} to clients", self, msg)
+        self.send_role('clients', msg_encoded)
+
+    def handle_heartbeat(self, rnd):
+        """ Handles the heartbeat of a leader with round rnd. The highest round wins: a leader or a candidate
+            that has not completed its phase 1 steps down, and a follower restarts its failure detector.
+
+            :param rnd: int
+                Round of the leader.
+        """
+        if rnd < self.leader_rnd:
+            return          # an old leader that has not stepped down yet
+        if rnd > self.leader_rnd:
+            self.leader_rnd = rnd
+            self.detector.reset()       # do not measure the pause between two leaders
+        if self.leader and (rnd > self.range_c_rnd or (self.multi_paxos and not self.range_ready)):
+            self.step_down()
+        self.detector.heartbeat(self.loop.time())
+        if not self.leader:
+            self.reset_leader_listener()
+
+    def reset_leader_listener(self):
+        """ Restart the timer that suspects the leader, called for every heartbeat of the leader. """
+        if self.leader_listener_handle is not None:
+            self.leader_listener_handle.cancel()
+        # the proposers with a higher id suspect the leader first, so usually a single one takes over
+        delay = self.detector.timeout() + self.takeover_stagger / (self.p_id + 1)
+        self.leader_listener_handle = self.loop.call_later(delay, self.leader_listener)
 
     def leader_listener(self):
-        """ Listen to the leader messages and check if it may be dead. """
-        while True:
-            time.sleep(0.001)
-            if self.last_msg_leader_time is not None:
-                current_time = time.time()
-                interval = current_time - self.last_msg_leader_time
-                if not self.leader:
-                    if interval > self.leader_listener_interval:
-                        print_stuff("Probably leader is dead")
-                        self.leader = True
-                        self.catch_up_instance()
+        """ Called when the suspicion of the failure detector reaches its threshold. """
+        self.leader_listener_handle = None
+        if not self.leader:
+            print_stuff("Probably leader is dead")
+            self.take_over()
+
+    def take_over(self):
+        """ Become the leader with a round higher than the one of the suspected leader. With Multi-Paxos,
+            a single phase 1 recovers all the instances that the old leader left open.
+        """
+        self.leader = True
+        self.metrics.counters['takeovers'] += 1
+        self.range_c_rnd = max(self.range_c_rnd, self.leader_rnd - self.leader_rnd % 1000 + self.p_id + 1)
+        self.catch_up_instance()
+        if not self.multi_paxos:
+            self.range_c_rnd += 1000
+        elif self.instance_updated:
+            self.phase_1A_range()
 
     def update_state(self, instance):
-        """ Add instance to the dictionary.
+        """ Add instance to the states.
                 :param instance: int
                     Instance to be added
         """
         if instance is not None and instance not in self.states:
-            self.states[int(instance)] = {"c_rnd": self.p_id + 1, "c_val": None, "v": None,
-                                     "max_v_rnd": 0, "max_v_val": 0,
-                                     "quorum1B": 0, "quorum2B": 0}
+            self.states.add(int(instance))
+
+    def trim(self, instance):
+        for i in range(self.trimmed, instance):
+            self.in_flight.pop(i, None)
+        Agent.trim(self, instance)
+
+    def first_undecided(self):
+        """ Return the lowest instance whose decision is not known by the proposer. """
+        instance = self.trimmed
+        while instance in self.states and self.states[instance]['decided']:
+            instance += 1
+        return instance
+
+    def phase_1A_range(self):
+        """ Handle phase 1A of Multi-Paxos: a single phase 1 for all the instances >= range_from. """
+        self.range_ready = False
+        self.range_quorum1B = (0, 0)
+        self.range_votes = {}
+        self.range_parts = {}
+        self.range_from = self.first_undecided()
+        self.range_c_rnd += 1000        # assuming that the max number of proposers is 1000
+        self.retries = {}               # every instance starts again with the new round
+        self.range_started = self.loop.time()
+        self.send_phase_1A_range()
+
+    def send_phase_1A_range(self):
+        """ Send (or retransmit) the phase 1A of Multi-Paxos for range_c_rnd. """
+        if self.range_from < self.trimmed:      # the acceptors would drop a phase 1 for trimmed instances
+            self.range_from = self.first_undecided()
+            self.range_quorum1B = (0, 0)
+            self.range_votes = {}
+            self.range_parts = {}
+        self.retransmission.schedule("range", self.rto("range"))
+        msg = Msg(self.range_from)
+        msg.fill_PHASE_1A_RANGE(self.range_c_rnd)
+        msg_encoded = msg.encode()
+        print_stuff("{} sends msg {} to acceptors", self, msg)
+        self.send_role('acceptors', msg_encoded)
+
+    def phase_2A_range(self, instance, data):
+        """ Handle the phase 1B answers of Multi-Paxos. The votes of an acceptor can be split in
+            several parts: it counts for the quorum when all of them arrived. Once there is a quorum,
+            the leader proposes again the values voted in the open instances and fills the gaps, then
+            new requests are sent directly to phase 2A.
+        """
+        if self.range_ready or instance != self.range_from or data['rnd'] != self.range_c_rnd:
+            return
+        for i, (v_rnd, v_val) in data['votes'].items():
+            if i not in self.range_votes or v_rnd > self.range_votes[i][0]:
+                self.range_votes[i] = (v_rnd, v_val)
+        if data['num_instance'] > self.num_instance:
+            self.num_instance = data['num_instance']
+        received = self.range_parts.setdefault(data['voters'], set())
+        received.add(data['part'])
+        if len(received) < data['parts']:
+            return
+        self.range_quorum1B, quorum = self.add_votes(self.range_quorum1B, data['rnd'], data['voters'], self.quorum1)
+        if quorum:
+            self.range_ready = True
+            self.read_index = self.num_instance     # the recovered instances may have been decided and read
+            self.metrics.observe('phase1_wait', self.loop.time() - self.range_started)
+            print_stuff("{} completed phase 1 for instances >= {}", self, self.range_from)
+            for i in range(self.range_from, self.num_instance + 1):
+                self.update_state(i)
+                if self.states[i]['decided']:
+                    continue
+                if i in self.range_votes:
+                    self.propose(i, self.range_votes[i][1])
+                else:
+                    self.propose(i, self.uncommitted(self.states[i]['v']))
+            self.request_lease()
+
+    def uncommitted(self, v):
+        """ Return the value without the client requests already committed. An instance that no acceptor
+            of the phase 1 quorum voted for can be proposed with any value: a request retried and committed
+            meanwhile is not proposed again (the acceptors may have dropped the payload of a large value).
+        """
+        if isinstance(v, Command) and (v.client_id, v.seq) in self.committed:
+            return None
+        if isinstance(v, list) and any(isinstance(value, Command) for value in v):
+            v = [value for value in v if not isinstance(value, Command) or (value.client_id, value.seq) not in self.committed]
+            return v if len(v) > 0 else None
+        return v
+
+    def propose(self, instance, value):
+        """ Send phase 2A for instance using the round of the Multi-Paxos phase 1. """
+        state = self.states[instance]
+        state['c_rnd'] = self.range_c_rnd
+        state['c_val'] = value
+        self.in_flight[instance] = self.loop.time()
+        self.retransmission.schedule(instance, self.rto(instance))
+        self.metrics.trace(instance, 'proposed', self.in_flight[instance])
+        msg = Msg(instance)
+        msg.fill_PHASE_2A(self.range_c_rnd, value)
+        msg_encoded = msg.encode()
+        print_stuff("{} sends msg {} to acceptors", self, msg)
+        self.send_role('acceptors', msg_encoded)
+
+    def handle_request_multi_paxos(self, instance, v, new):
+        """ Handle a request when the leader already completed phase 1 for all instances >= range_from.
+
+            :param instance: int
+                Instance of the request.
+            :param v: int or str
+                Value of the request.
+            :param new: bool
+                The request is for a new instance and not for an old decision.
+        """
+        state = self.states[instance]
+        if state['decided']:                        # resend the known decision
+            msg = Msg(instance)
+            msg.fill_DECISION(state['c_rnd'], state['c_val'])
+            msg_encoded = msg.encode()
+            print_stuff("{} sends msg {} to learners", self, msg)
+            self.send_role('learners', msg_encoded)
+            self.send_role('proposers', msg_encoded)
+        elif state['c_rnd'] == self.range_c_rnd:    # already proposed in this round, never change the value
+            self.propose(instance, state['c_val'])
+        elif new or instance >= self.range_from:
+            self.propose(instance, v)
 
     def phase_1A(self, instance):
         """ Handle phase 1A of Paxos algorithm. """
         # print("Phase 1A")
+        self.in_flight[instance] = self.loop.time()
+        self.retransmission.schedule(instance, self.rto(instance))
         msg = Msg(instance)
         msg.fill_PHASE_1A(self.states[instance]['c_rnd'])
         msg_encoded = msg.encode()
-        print_stuff(f"{self} sends msg {msg} to acceptors")
-        self.send_msg(self.network['acceptors']['ip'], self.network['acceptors']['port'], msg_encoded)
+        print_stuff("{} sends msg {} to acceptors", self, msg)
+        self.send_role('acceptors', msg_encoded)
 
     def phase_2A(self, instance, data):
         """ Handle phase 2A of Paxos algorithm. """
         # print("Phase 2A")
-        if data['rnd'] == self.states[instance]['c_rnd']:
-            self.states[instance]['quorum1B'] += 1
-        print_stuff(self.states[instance]['max_v_rnd'])
-        if data['v_rnd'] >= self.states[instance]['max_v_rnd']:
-            self.states[instance]['max_v_rnd'] = data['v_rnd']
-            self.states[instance]['max_v_val'] = data['v_val']
-        if self.states[instance]['quorum1B'] >= math.ceil((self.max_num_acceptors+1) / 2):  # if it has quorum
-            self.states[instance]['quorum1B'] = 0  # reset quorum
-            if self.states[instance]['max_v_rnd'] == 0:
-                self.states[instance]['c_val'] = self.states[instance]['v']
+        state = self.states[instance]
+        if state['decided']:    # c_rnd may be the round of the proposer that decided it
+            return
+        quorum = False
+        if data['rnd'] == state['c_rnd']:
+            votes, quorum = self.add_votes((state['quorum1B_rnd'], state['quorum1B']), data['rnd'],
+                                           data['voters'], self.quorum1)
+            state['quorum1B_rnd'], state['quorum1B'] = votes
+        print_stuff(state['max_v_rnd'])
+        if data['v_rnd'] >= state['max_v_rnd']:
+            state['max_v_rnd'] = data['v_rnd']
+            state['max_v_val'] = data['v_val']
+        if quorum:
+            if state['max_v_rnd'] == 0:
+                state['c_val'] = state['v']
             else:
-                self.states[instance]['c_val'] = self.states[instance]['max_v_val']
+                state['c_val'] = state['max_v_val']
 
             msg = Msg(instance)
-            msg.fill_PHASE_2A(self.states[instance]['c_rnd'], self.states[instance]['c_val'])
+            msg.fill_PHASE_2A(state['c_rnd'], state['c_val'])
             msg_encoded = msg.encode()
-            print_stuff(f"{self} sends msg {msg} to acceptors")
-            self.send_msg(self.network['acceptors']['ip'], self.network['acceptors']['port'], msg_encoded)
+            print_stuff("{} sends msg {} to acceptors", self, msg)
+            self.send_role('acceptors', msg_encoded)
 
     def decide(self, instance, data):
         """ Handle phase decide of Paxos algorithm. """
         # print("Deciding")
-        if data['v_rnd'] == self.states[instance]['c_rnd']:
-            self.states[instance]['quorum2B'] += 1
-        if self.states[instance]['quorum2B'] >= math.ceil((self.max_num_acceptors+1) / 2):  # if it has quorum
-            self.states[instance]['quorum2B'] = 0  # reset quorum
+        state = self.states[instance]
+        if data['v_rnd'] != state['c_rnd']:
+            return
+        votes, quorum = self.add_votes((state['quorum2B_rnd'], state['quorum2B']), data['v_rnd'],
+                                       data['voters'], self.quorum2)
+        state['quorum2B_rnd'], state['quorum2B'] = votes
+        if quorum:
+            now = self.loop.time()
+            if instance in self.in_flight and instance not in self.retries:     # Karn: no samples of retransmissions
+                self.sample_rtt(now - self.in_flight[instance])
+                self.metrics.observe('quorum_wait', now - self.in_flight[instance])
+            self.metrics.trace(instance, 'decided', now)
+            self.settle(instance)
+            state['decided'] = True
 
             msg = Msg(instance)
-            msg.fill_DECISION(self.states[instance]['c_rnd'], self.states[instance]['c_val'])
+            msg.fill_DECISION(state['c_rnd'], state['c_val'])
             msg_encoded = msg.encode()
-            print_stuff(f"{self} sends msg {msg} to learners")
-            self.send_msg(self.network['learners']['ip'], self.network['learners']['port'], msg_encoded)
-            self.send_msg(self.network['proposers']['ip'], self.network['proposers']['port'], msg_encoded)
+            print_stuff("{} sends msg {} to learners", self, msg)
+            self.send_role('learners', msg_encoded)
+            self.send_role('proposers', msg_encoded)
+            self.commit_prefix()
+
+    def commit_prefix(self):
+        """ Commits the decided instances following last_committed in instance order: the requests of
+            an instance are acknowledged only when the instances before it are decided too, so that
+            the decided state read by the clients contains them.
+        """
+        instance = max(self.last_committed + 1, self.trimmed)
+        while instance in self.states and self.states[instance]['decided']:
+            self.commit(instance, self.states[instance]['c_val'])
+            self.release(self.states[instance]['v'])    # the instance may be decided with another value
+            instance += 1
+        self.last_committed = instance - 1
 
-    def receive_msg(self, msg):
-        """ Handle the receiving of a new message. """
-        print_stuff(f"{self} receives msg {msg}")
+    def commit(self, instance, v):
+        """ Records the ids of the client requests decided in an instance and, if the proposer is
+            the leader, acknowledges them to the clients.
 
-        self.update_state(msg.instance)
+            :param instance: int
+                The decided instance.
+            :param v: int, str, Command, list or None
+                The decided value.
+        """
+        ids = []
+        for command in commands(v):
+            self.proposed.discard((command.client_id, command.seq))
+            if self.committed.add(command.client_id, command.seq, instance):
+                ids.extend((command.client_id, command.seq))
+        if self.leader and len(ids) > 0:
+            self.metrics.trace(instance, 'committed', self.loop.time())
+            self.send_commit(instance, ids)
+
+    def release(self, v):
+        """ Forget the proposal of the requests of a value that are not committed, so that their retries
+            are proposed again: the value was replaced in its instance by the value of another proposer.
+
+            :param v: int, str, Command, list or None
+                The value proposed by the leader.
+        """
+        for command in commands(v):
+            self.proposed.discard((command.client_id, command.seq))
 
-        if msg.phase == "REQUEST":
-            if msg.instance is None:        # request for a new instance
-                self.num_instance += 1
-                self.update_state(self.num_instance)
-                num_instance = self.num_instance
-            else:                           # request for the value decided in an old instance
-                num_instance = int(msg.instance)
-            self.states[num_instance]['v'] = msg.data['v']
-            if not self.instance_updated:
-                self.catch_up_instance()
+    def send_commit(self, instance, ids):
+        """ Sends the acknowledgement of committed requests to clients.
+
+            :param instance: int or None
+                The instance of the decision, None if it is not known.
+            :param ids: list
+                client_id and seq of each committed request, one after the other.
+        """
+        msg = Msg(instance)
+        msg.fill_COMMIT(ids)
+        msg_encoded = msg.encode()
+        print_stuff("{} sends msg {} to clients", self, msg)
+        self.send_role('clients', msg_encoded)
+
+    def handle_request(self, instance, v):
+        """ Start paxos for a request.
+
+            :param instance: int or None
+                Instance of the request, None if the request is for a new instance.
+            :param v: int, str or list
+                Value (or batch of values) to be proposed.
+        """
+        if instance is None and self.leader and self.window_full():
+            self.pending.append(v)      # wait for a free slot in the window
+            self.backpressure()
+            return
+        if instance is None:            # request for a new instance
+            self.num_instance += 1
+            self.update_state(self.num_instance)
+            num_instance = self.num_instance
+        else:                           # request for the value decided in an old instance
+            num_instance = int(instance)
+            self.release(self.states[num_instance]['v'])
+        self.states[num_instance]['v'] = v
+        if not self.instance_updated:
+            self.catch_up_instance()
+        if self.multi_paxos:
+            if self.leader and self.range_ready:
+                self.handle_request_multi_paxos(num_instance, v, instance is None)
+        else:
             # assuming that the max number of proposers is 1000
             self.states[num_instance]['c_rnd'] = self.states[num_instance]['c_rnd'] + 1000
             if self.leader and self.instance_updated:
                 self.phase_1A(num_instance)
+
+    def add_to_batch(self, v):
+        """ Add a client value to the current batch and propose the batch if it is full.
+
+            :param v: int or str
+                Value sent by a client.
+        """
+        if len(self.batch) == 0:
+            self.batch_handle = self.loop.call_later(self.max_batch_wait, self.flush_batch)
+        if isinstance(v, Command):
+            self.proposed.add((v.client_id, v.seq))
+        self.batch.append(v)
+        self.batch_bytes += encoded_size(v)
+        if len(self.batch) >= self.max_batch_size or self.batch_bytes >= self.max_batch_bytes:
+            self.flush_batch()
+
+    def flush_batch(self):
+        """ Propose the current batch of client values in a single paxos instance. """
+        if len(self.batch) > 0:
+            batch = self.batch
+            self.batch = []
+            self.batch_bytes = 0
+            if self.batch_handle is not None:
+                self.batch_handle.cancel()
+                self.batch_handle = None
+            print_stuff("{} proposes a batch of {} values", self, len(batch))
+            self.metrics.counters['batches'] += 1
+            self.metrics.counters['batched_values'] += len(batch)
+            self.handle_request(None, batch)
+
+    def window_full(self):
+        """ Return True if the leader cannot start new instances because too many are in flight. """
+        return len(self.in_flight) >= self.window_size
+
+    def backpressure(self):
+        """ Ask clients to slow down, at most once every backpressure_pause seconds. """
+        current_time = self.loop.time()
+        if current_time - self.last_backpressure_time >= self.backpressure_pause:
+            self.last_backpressure_time = current_time
+            self.window_stats['full'] += 1
+            msg = Msg()
+            msg.fill_BACKPRESSURE(self.backpressure_pause)
+            msg_encoded = msg.encode()
+            print_stuff("{} sends msg {} to clients", self, msg)
+            self.send_role('clients', msg_encoded)
+
+    def check_window(self):
+        """ Propose the pending values while there is space in the window. """
+        while len(self.pending) > 0 and self.leader and not self.window_full():
+            self.handle_request(None, self.pending.pop(0))
+        occupancy = len(self.in_flight)
+        self.window_stats['samples'] += 1
+        self.window_stats['occupancy'] += occupancy
+        if occupancy > self.window_stats['max_occupancy']:
+            self.window_stats['max_occupancy'] = occupancy
+
+    def stats(self):
+        stats = Agent.stats(self)
+        stats.update({"leader": self.leader, "range_c_rnd": self.range_c_rnd, "num_instance": self.num_instance,
+                      "last_committed": self.last_committed, "window": self.window_occupancy(),
+                      "phi": None if self.leader else self.detector.phi(self.loop.time())})
+        return stats
+
+    def window_occupancy(self):
+        """ Return the statistics about the occupancy of the window. """
+        samples = max(self.window_stats['samples'], 1)
+        return {"in_flight": len(self.in_flight), "pending": len(self.pending),
+                "avg_occupancy": self.window_stats['occupancy'] / samples,
+                "max_occupancy": self.window_stats['max_occupancy'],
+                "full": self.window_stats['full'], "retransmitted": self.window_stats['retransmitted'],
+                "escalated": self.window_stats['escalated'], "srtt": self.srtt}
+
+    def rto(self, key):
+        """ Return the retransmission timeout of an instance (or of the phase 1, key "range"):
+            the smoothed round trip time plus four times its variation, doubled at every retransmission.
+        """
+        rto = self.initial_rto if self.srtt is None else self.srtt + 4 * self.rttvar
+        return min(self.max_rto, max(self.min_rto, rto) * 2 ** self.retries.get(key, 0))
+
+    def sample_rtt(self, rtt):
+        """ Update the smoothed round trip time with a new measure (Jacobson/Karels). """
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+
+    def settle(self, instance):
+        """ Remove a decided instance from the window and stop its retransmissions. """
+        self.in_flight.pop(instance, None)
+        self.retries.pop(instance, None)
+        self.retransmission.cancel(instance)
+
+    def step_down(self):
+        """ Stop being the leader because a proposer with a higher round is alive. """
+        if self.leader:
+            self.metrics.counters['step_downs'] += 1
+            self.release_lease()
+            self.detector.reset()   # no heartbeats were measured while leading
+        self.leader = False
+        self.range_ready = False    # a new leader will run its own phase 1
+        self.in_flight = {}
+        self.proposed = set()       # the new leader may not decide them, the retries are proposed again
+        self.reset_leader_listener()
+
+    def handle_nack(self, instance, rnd):
+        """ Handles the refusal of an acceptor that promised rnd, a round higher than the one of our message.
+            With Multi-Paxos, if rnd belongs to another proposer, that proposer is the new leader, otherwise
+            (an older run of this proposer) the leader tries again with a round higher than rnd.
+            Without Multi-Paxos, the instance is tried again with a higher round.
+
+            :param instance: int
+                Instance of the refused message.
+            :param rnd: int
+                Round promised by the acceptor.
+        """
+        if self.multi_paxos:
+            if rnd <= self.range_c_rnd:
+                return                          # refusal of a message of an older round
+            if rnd % 1000 - 1 != self.p_id:     # the round of a proposer is p_id + 1 + 1000 * k
+                self.leader_rnd = max(self.leader_rnd, rnd)
+                self.step_down()
+            else:
+                self.window_stats['escalated'] += 1
+                self.range_c_rnd = rnd - rnd % 1000 + self.p_id + 1
+                self.phase_1A_range()
+        elif instance in self.in_flight and rnd >= self.states[instance]['c_rnd']:
+            self.window_stats['escalated'] += 1
+            self.retries.pop(instance, None)
+            self.states[instance]['c_rnd'] = rnd - rnd % 1000 + self.p_id + 1 + 1000
+            self.phase_1A(instance)
+
+    def handle_trimmed(self, trimmed, num_instance):
+        """ Handles the refusal of a phase 1 of Multi-Paxos for instances that an acceptor already trimmed
+            (a new proposer that has not received the watermarks of the learners yet). Those instances are
+            decided and delivered by all the learners, so the proposer trims them too, as its snapshot,
+            and sends its phase 1 again from the first instance that is not trimmed.
+
+            :param trimmed: int
+                First instance kept by the acceptor.
+            :param num_instance: int
+                Greater instance seen by the acceptor.
+        """
+        if trimmed <= self.trimmed:
+            return
+        self.trim(trimmed)
+        if max(num_instance, trimmed - 1) > self.num_instance:
+            self.num_instance = max(num_instance, trimmed - 1)
+        if self.leader and self.multi_paxos and not self.range_ready:
+            self.send_phase_1A_range()
+
+    def skip(self, last):
+        """ Handles the request of a learner merging several Paxos groups, which waits for this
+            group: the instances up to last are decided without values, so that the learners can
+            deliver the values of the other groups.
+
+            :param last: int
+                Last instance to be decided.
+        """
+        for i in range(last - self.num_instance - len(self.pending)):
+            self.handle_request(None, None)
+
+    def retransmit(self, key):
+        """ Called by the timer wheel when an instance in flight (or the phase 1 of Multi-Paxos, key "range")
+            did not reach a quorum in time. The leader sends again the last message in the same round and,
+            after max_retries retransmissions, tries a new round: the acceptors may have promised a higher one
+            and their NACK may have been lost.
+
+            :param key: int or str
+                The instance, or "range".
+        """
+        if not self.leader or (key == "range" and self.range_ready) or (key != "range" and key not in self.in_flight):
+            self.retries.pop(key, None)
+            return
+        if key != "range" and self.multi_paxos and not self.range_ready:
+            # the instance will be proposed again when the phase 1 of the new round completes
+            self.retransmission.schedule(key, self.rto(key))
+            return
+        if self.retries.get(key, 0) >= self.max_retries:
+            self.window_stats['escalated'] += 1
+            print_stuff("{} tries a new round for {}", self, key)
+            if self.multi_paxos:
+                self.phase_1A_range()
+            else:
+                self.retries.pop(key, None)
+                self.states[key]['c_rnd'] += 1000
+                self.phase_1A(key)
+            return
+        self.retries[key] = self.retries.get(key, 0) + 1
+        self.window_stats['retransmitted'] += 1
+        if key == "range":
+            self.send_phase_1A_range()
+            return
+        state = self.states[key]
+        if self.multi_paxos:
+            self.propose(key, state['c_val'])
+        elif state['quorum1B_rnd'] == state['c_rnd'] and bin(state['quorum1B']).count('1') >= self.quorum1:
+            self.in_flight[key] = self.loop.time()      # phase 1 completed, send phase 2A again
+            self.retransmission.schedule(key, self.rto(key))
+            msg = Msg(key)
+            msg.fill_PHASE_2A(state['c_rnd'], state['c_val'])
+            msg_encoded = msg.encode()
+            print_stuff("{} sends msg {} to acceptors", self, msg)
+            self.send_role('acceptors', msg_encoded)
+        else:
+            self.phase_1A(key)
+
+    def receive_msg(self, msg):
+        """ Handle the receiving of a new message. """
+        print_stuff("{} receives msg {}", self, msg)
+
+        if msg.instance is not None and msg.instance < self.trimmed:
+            return      # the instance is decided and delivered by all learners
+        self.update_state(msg.instance)
+
+        if msg.phase == "REQUEST":
+            v = msg.data['v']
+            if msg.data['client_id'] != 0:      # request with an id
+                if (msg.data['client_id'], msg.data['seq']) in self.committed:
+                    if self.leader:             # the COMMIT was lost, the client sent the request again
+                        self.send_commit(None, [msg.data['client_id'], msg.data['seq']])
+                    return
+                if (msg.data['client_id'], msg.data['seq']) in self.proposed:
+                    return      # a retry of a request in the batch, pending or in flight: its commit acknowledges both
+                v = Command(msg.data['client_id'], msg.data['seq'], v)
+            if msg.instance is None and self.batching:
+                if self.leader:             # only the leader allocates instances for batches
+                    self.add_to_batch(v)
+            else:
+                if msg.instance is None and self.leader and isinstance(v, Command):
+                    self.proposed.add((v.client_id, v.seq))
+                self.handle_request(msg.instance, v)
         elif msg.phase == "PHASE_1B":
             if self.leader:
                 self.phase_2A(int(msg.instance), msg.data)
+        elif msg.phase == "PHASE_1B_RANGE":
+            if self.leader and self.multi_paxos:
+                self.phase_2A_range(int(msg.instance), msg.data)
         elif msg.phase == "PHASE_2B":
             if self.leader:
                 self.decide(int(msg.instance), msg.data)
+        elif msg.phase == "NACK":
+            if self.leader:
+                self.handle_nack(int(msg.instance), msg.data['rnd'])
+        elif msg.phase == "TRIMMED":
+            self.handle_trimmed(msg.data['trimmed'], msg.data['num_instance'])
         elif msg.phase == "DECISION":
             # print(f"Proposer {self.p_id} update {msg}")
             self.update_state(msg.instance)
-            self.states[int(msg.instance)]['c_rnd'] = msg.data['c_rnd']
-            self.states[int(msg.instance)]['c_val'] = msg.data['v_val']
+            state = self.states[int(msg.instance)]
+            state['c_rnd'] = msg.data['c_rnd']
+            state['c_val'] = msg.data['v_val']
+            state['decided'] = True
+            self.settle(int(msg.instance))
+            self.commit_prefix()
+            if int(msg.instance) > self.num_instance:
+                self.num_instance = int(msg.instance)
         elif msg.phase == "leader_sender":
-            self.last_msg_leader_time = time.time()
-            if msg.data['p_id'] > self.p_id:
-                self.leader = False
+            if msg.data['p_id'] != self.p_id:
+                self.handle_heartbeat(msg.data['rnd'])
         elif msg.phase == "catch_up_instance":
             self.handle_catch_up(msg)
         elif msg.phase == "catch_up_learners":
+            if self.leader and msg.data['server'] == -1:    # -1: the request is for the leader
+                self.serve_catch_up(msg.data)
+        elif msg.phase == "catch_up_ack":
+            if msg.data['server'] == -1:
+                self.handle_catch_up_ack(msg.data)
+        elif msg.phase == "learner_watermark":
+            self.handle_watermark(msg.data)
+        elif msg.phase == "skip":
             if self.leader:
-                self.catch_up_learners()
+                self.skip(msg.data['last'])
+        elif msg.phase == "LEASE":
+            if self.leader:
+                self.handle_lease(msg.data)
+        elif msg.phase == "READ":
+            self.handle_read(msg.data['client_id'], msg.data['read_id'], msg.data['key'])
 
 
 class Acceptor(Agent):
@@ -423,41 +2848,354 @@ class Acceptor(Agent):
 
     def __init__(self, *args, **kwargs):
         Agent.__init__(self, role="acceptors", *args, **kwargs)
-        self.states = {}            # for each paxos instance, it saves the related values
+        self.states = InstanceStates(rnd=('q', 0), v_rnd=('q', 0), v_val=(None, None))  # promises and votes of each instance
         self.num_instance = -1      # greater instance identifying number seen
+        self.range_rnd = 0          # round promised by Multi-Paxos phase 1 for all instances >= range_from
+        self.range_from = None      # first instance covered by range_rnd
+        self.voter = 1 << (self.p_id - 1)   # bit of the acceptor in the vote bitsets, ids from 1 to 63
+        self.direct_2B = False              # PHASE_2B is sent also to the learners, that decide without the leader
+        self.lease_owner = None             # p_id of the leader holding the lease (-1 nobody can run phase 1)
+        self.lease_expiry = 0               # time at which the lease expires
+        self.max_lease_duration = 2         # longest lease granted
+        self.deferred_1A = None             # (instance, data) of the highest phase 1 waiting for the lease to expire
+        self.deferred_handle = None         # timer answering deferred_1A when the lease expires
+        self.waiting_2A = {}                # for each instance, the PHASE_2A waiting for the payloads of its large values
+
+        self.wal_path = None            # if set, promises and votes are saved in this write-ahead log
+        self.wal = None                 # file of the write-ahead log
+        self.wal_records = []           # encoded records waiting to be written in the log
+        self.wal_replies = []           # replies waiting for their records to be on disk
+        self.wal_handle = None          # timer committing the records
+        self.wal_commit_interval = 0.001    # max seconds a reply waits for the group commit
+        self.wal_max_records = 256          # number of records that forces an immediate commit
+
+    def on_start(self):
+        if self.wal_path is not None:
+            if os.path.exists(self.wal_path):
+                # a lease granted before the crash may still hold: no phase 1 until it expires
+                self.lease_owner = -1
+                self.lease_expiry = self.loop.time() + self.max_lease_duration
+            self.recover()
+            self.wal = open(self.wal_path, 'ab')
+
+    def recover(self):
+        """ Rebuild promises and votes by replaying the write-ahead log.
+            A record truncated by a crash at the end of the log is ignored.
+        """
+        if not os.path.exists(self.wal_path):
+            return
+        with open(self.wal_path, 'rb') as f:
+            log = f.read()
+        offset = 0
+        record = Msg()
+        while offset + LENGTH.size <= len(log):
+            length, = LENGTH.unpack_from(log, offset)
+            if offset + LENGTH.size + length > len(log):
+                break
+            record.decode(log[offset + LENGTH.size:offset + LENGTH.size + length])
+            offset += LENGTH.size + length
+            self.apply_record(record)
+        print_stuff("{} recovered {} instances from {}", self, len(self.states), self.wal_path)
+
+    def apply_record(self, record):
+        """ Apply a record of the write-ahead log to the state.
+
+            :param record: class
+                A PHASE_1A (promise), PHASE_1A_RANGE (promise for a range), PHASE_2A (vote),
+                PAYLOAD (complete payload of a large value) or TRIMMED (trimmed instances) message.
+        """
+        instance = record.instance
+        if record.phase == "TRIMMED":
+            if record.data['trimmed'] > self.trimmed:
+                Agent.trim(self, record.data['trimmed'])
+            if record.data['num_instance'] > self.num_instance:
+                self.num_instance = record.data['num_instance']
+            return
+        if record.phase == "PAYLOAD":
+            self.payloads.add(record.data['digest'], record.data['chunk'])
+            return
+        if record.phase == "PHASE_1A_RANGE":
+            self.range_rnd = max(self.range_rnd, record.data['c_rnd'])
+            if self.range_from is None or instance < self.range_from:
+                self.range_from = instance
+            return
+        self.update_state(instance)
+        if instance > self.num_instance:
+            self.num_instance = instance
+        if record.data['c_rnd'] > self.states[instance]['rnd']:
+            self.states[instance]['rnd'] = record.data['c_rnd']
+        if record.phase == "PHASE_2A":
+            self.states[instance]['v_rnd'] = record.data['c_rnd']
+            self.states[instance]['v_val'] = record.data['c_val']
+
+    def log(self, record):
+        """ Add a record to the write-ahead log. It is written at the next group commit.
+
+            :param record: class
+                Message describing the state change (see apply_record).
+        """
+        if self.wal is not None:
+            encoded = record.encode()
+            self.wal_records.append(LENGTH.pack(len(encoded)) + encoded)
+
+    def reply(self, role, msg):
+        """ Send a reply that depends on state changes. With the write-ahead log, the reply is sent
+            only after the group commit has saved the records on disk.
+        """
+        if self.wal is None:
+            self.send_role(role, msg)
+            return
+        self.wal_replies.append((role, msg))
+        if len(self.wal_records) >= self.wal_max_records:
+            self.commit()
+        elif self.wal_handle is None:
+            self.wal_handle = self.loop.call_later(self.wal_commit_interval, self.commit)
+
+    def commit(self):
+        """ Group commit: write the records with a single fsync, then send all the waiting replies. """
+        if self.wal_handle is not None:
+            self.wal_handle.cancel()
+            self.wal_handle = None
+        if len(self.wal_records) > 0:
+            start = self.loop.time()
+            self.wal.write(b''.join(self.wal_records))
+            self.wal.flush()
+            os.fsync(self.wal.fileno())
+            self.metrics.observe('wal_commit', self.loop.time() - start)
+            self.metrics.counters['wal_records'] += len(self.wal_records)
+            self.wal_records = []
+        replies = self.wal_replies
+        self.wal_replies = []
+        for role, msg in replies:
+            self.send_role(role, msg)
+
+    def trim(self, instance):
+        for i in range(self.trimmed, instance):
+            self.waiting_2A.pop(i, None)
+            if i in self.states:
+                for digest in digests(self.states[i]['v_val']):
+                    self.payloads.discard(digest)
+        Agent.trim(self, instance)
+        if self.wal is not None:
+            self.checkpoint()
+
+    def checkpoint(self):
+        """ Compact the write-ahead log: replace it with the trimmed instances and the records of the instances
+            still in the states.
+        """
+        self.commit()
+        self.log(Msg(None, "TRIMMED", {"trimmed": self.trimmed, "num_instance": self.num_instance}))
+        if self.range_from is not None:
+            self.log(Msg(self.range_from, "PHASE_1A_RANGE", {"c_rnd": self.range_rnd}))
+        for instance in self.states:
+            state = self.states[instance]
+            for digest in digests(state['v_val']):
+                if digest in self.payloads:
+                    self.log(Msg(None, "PAYLOAD", {"digest": digest, "offset": 0, "chunk": self.payloads.get(digest)}))
+            if state['v_rnd'] > 0:
+                self.log(Msg(instance, "PHASE_2A", {"c_rnd": state['v_rnd'], "c_val": state['v_val']}))
+            if state['rnd'] > state['v_rnd']:
+                self.log(Msg(instance, "PHASE_1A", {"c_rnd": state['rnd']}))
+        records, self.wal_records = self.wal_records, []
+        with open(self.wal_path + '.tmp', 'wb') as f:
+            f.write(b''.join(records))
+            f.flush()
+            os.fsync(f.fileno())
+        self.wal.close()
+        os.replace(self.wal_path + '.tmp', self.wal_path)
+        self.wal = open(self.wal_path, 'ab')
+        print_stuff("{} wrote a checkpoint with {} records", self, len(records))
 
     def update_state(self, instance):
-        """ Add instance to the dictionary.
+        """ Add instance to the states.
                 :param instance: int
                     Instance to be added
         """
         if instance is not None and instance not in self.states:
-            self.states[instance] = {"rnd": 0, "v_rnd": 0, "v_val": None}
+            self.states.add(instance)
+
+    def get_rnd(self, instance):
+        """ Return the highest round promised for instance, considering also the Multi-Paxos promise.
+
+            :param instance: int
+                Instance of which the promised round is needed.
+        """
+        rnd = self.states[instance]['rnd']
+        if self.range_from is not None and instance >= self.range_from and self.range_rnd > rnd:
+            rnd = self.range_rnd
+        return rnd
+
+    def leased_to_other(self, rnd):
+        """ Return True if another proposer than the one of rnd holds a lease. """
+        return self.lease_owner not in (None, rnd % 1000 - 1) and self.loop.time() < self.lease_expiry
+
+    def grant_lease(self, data):
+        """ Handles the lease request of the leader: until the lease expires, the acceptor does not
+            answer the phase 1 of the other proposers.
+
+            :param data: dict
+                The round of the leader, the sending time and the duration of the lease.
+        """
+        if data['rnd'] < self.range_rnd or self.leased_to_other(data['rnd']):
+            return
+        self.deferred_1A = None         # the leader is alive, the proposers waiting will retry
+        self.metrics.counters['leases_granted'] += 1
+        self.lease_owner = data['rnd'] % 1000 - 1
+        self.lease_expiry = self.loop.time() + min(data['duration'], self.max_lease_duration)
+        msg = Msg()
+        msg.fill_LEASE(data['rnd'], self.voter, data['sent'])
+        msg_encoded = msg.encode()
+        print_stuff("{} sends msg {} to proposers", self, msg)
+        self.send_role('proposers', msg_encoded)
+
+    def phase_1B_range(self, instance, data):
+        """ Handle phase 1B of Multi-Paxos: promise c_rnd for all the instances >= instance
+            and send back the votes of those instances, in parts of at most chunk_bytes.
+        """
+        if self.leased_to_other(data['c_rnd']):
+            self.defer_1A(instance, data)
+            return
+        if data['c_rnd'] >= self.range_rnd and data['c_rnd'] >= self.get_rnd(instance):
+            self.range_rnd = data['c_rnd']
+            # promising on a larger range is always safe, never shrink it
+            if self.range_from is None or instance < self.range_from:
+                self.range_from = instance
+            self.log(Msg(instance, "PHASE_1A_RANGE", {"c_rnd": self.range_rnd}))
+            votes = [{}]
+            size = 0
+            for i in self.states:
+                if i >= instance and self.states[i]['v_rnd'] > 0:
+                    vote_size = len(str(self.states[i]['v_val'])) + 16    # rough encoded size of the vote
+                    if size + vote_size > self.chunk_bytes and len(votes[-1]) > 0:
+                        votes.append({})
+                        size = 0
+                    votes[-1][i] = (self.states[i]['v_rnd'], self.states[i]['v_val'])
+                    size += vote_size
+
+            for part in range(len(votes)):
+                msg = Msg(instance)
+                msg.fill_PHASE_1B_RANGE(self.range_rnd, votes[part], self.num_instance, self.voter, part, len(votes))
+                msg_encoded = msg.encode()
+                print_stuff("{} sends msg {} to proposers", self, msg)
+                self.reply('proposers', msg_encoded)
+        else:
+            self.nack(instance, max(self.range_rnd, self.get_rnd(instance)))
+
+    def defer_1A(self, instance, data):
+        """ Keep the highest phase 1 of Multi-Paxos refused because of a lease and answer it as soon as
+            the lease expires, so that the proposer that suspected the leader first, with the highest
+            round, takes over without waiting for its retransmissions. A renewal of the lease drops it.
+        """
+        self.metrics.counters['deferred_phase1'] += 1
+        if self.deferred_1A is None or data['c_rnd'] > self.deferred_1A[1]['c_rnd']:
+            self.deferred_1A = (instance, data)
+        if self.deferred_handle is None:
+            self.deferred_handle = self.loop.call_at(self.lease_expiry, self.answer_deferred_1A)
+
+    def answer_deferred_1A(self):
+        self.deferred_handle = None
+        if self.deferred_1A is not None:
+            instance, data = self.deferred_1A
+            self.deferred_1A = None
+            if instance >= self.trimmed:
+                self.phase_1B_range(instance, data)
 
     def phase_1B(self, instance, data):
         """ Handle phase 1B of Paxos algorithm. """
         # print("Phase 1B")
-        if data['c_rnd'] >= self.states[instance]['rnd']:
+        if self.leased_to_other(data['c_rnd']):
+            return
+        if data['c_rnd'] >= self.get_rnd(instance):
             self.states[instance]['rnd'] = data['c_rnd']
+            self.log(Msg(instance, "PHASE_1A", {"c_rnd": data['c_rnd']}))
 
             msg = Msg(instance)
-            msg.fill_PHASE_1B(self.states[instance]['rnd'], self.states[instance]['v_rnd'], self.states[instance]['v_val'])
+            msg.fill_PHASE_1B(self.states[instance]['rnd'], self.states[instance]['v_rnd'], self.states[instance]['v_val'],
+                              self.voter)
             msg_encoded = msg.encode()
-            print_stuff(f"{self} sends msg {msg} to proposers")
-            self.send_msg(self.network['proposers']['ip'], self.network['proposers']['port'], msg_encoded)
+            print_stuff("{} sends msg {} to proposers", self, msg)
+            self.reply('proposers', msg_encoded)
+        else:
+            self.nack(instance, self.get_rnd(instance))
 
     def phase_2B(self, instance, data):
-        """ Handle phase 2B of Paxos algorithm. """
+        """ Handle phase 2B of Paxos algorithm. The acceptor votes for a value with large values only
+            when it has their payloads, so a phase 2 quorum can serve the payloads of every decided value.
+        """
         # print("Phase 2B")
-        if data['c_rnd'] >= self.states[instance]['rnd']:
-            self.states[instance]['v_rnd'] = data['c_rnd']
-            self.states[instance]['v_val'] = data['c_val']
+        if data['c_rnd'] >= self.get_rnd(instance):
+            missing = [digest for digest in digests(data['c_val']) if digest not in self.payloads]
+            if len(missing) > 0:
+                self.waiting_2A[instance] = data
+                for digest in missing:
+                    self.fetch_payload(digest)
+                return
+            state = self.states[instance]
+            state['rnd'] = data['c_rnd']
+            state['v_rnd'] = data['c_rnd']
+            state['v_val'] = data['c_val']
+            self.log(Msg(instance, "PHASE_2A", {"c_rnd": data['c_rnd'], "c_val": data['c_val']}))
 
             msg = Msg(instance)
-            msg.fill_PHASE_2B(self.states[instance]['v_rnd'], self.states[instance]['v_val'])
+            msg.fill_PHASE_2B(state['v_rnd'], state['v_val'], self.voter)
             msg_encoded = msg.encode()
-            print_stuff(f"{self} sends msg {msg} to proposers")
-            self.send_msg(self.network['proposers']['ip'], self.network['proposers']['port'], msg_encoded)
+            print_stuff("{} sends msg {} to proposers", self, msg)
+            self.reply('proposers', msg_encoded)
+            if self.direct_2B:
+                self.reply('learners', msg_encoded)
+        else:
+            self.nack(instance, self.get_rnd(instance))
+
+    def handle_payload(self, data):
+        """ Handles a chunk of a payload like the other agents. The first chunk of a payload already stored
+            is sent again by a client that missed the acknowledgement, which is sent again.
+        """
+        stored = data['digest'] in self.payloads
+        Agent.handle_payload(self, data)
+        if stored and data['offset'] == 0:
+            self.ack_payload(data['digest'])
+
+    def payload_ready(self, digest):
+        """ Logs a payload that has been completed, acknowledges it to the client and votes for the values
+            that were waiting for it.
+        """
+        self.log(Msg(None, "PAYLOAD", {"digest": digest, "offset": 0, "chunk": self.payloads.get(digest)}))
+        self.ack_payload(digest)
+        for instance, data in list(self.waiting_2A.items()):
+            if all(d in self.payloads for d in digests(data['c_val'])):
+                del self.waiting_2A[instance]
+                self.phase_2B(instance, data)
+
+    def ack_payload(self, digest):
+        """ Tell the clients that the payload is stored, after its record is in the write-ahead log. """
+        msg = Msg()
+        msg.fill_PAYLOAD_ACK(digest, self.voter)
+        msg_encoded = msg.encode()
+        print_stuff("{} sends msg {} to clients", self, msg)
+        self.reply('clients', msg_encoded)
+
+    def nack(self, instance, rnd):
+        """ Tell the proposers that a message for instance was refused because rnd has been promised. """
+        self.metrics.counters['nacks'] += 1
+        msg = Msg(instance)
+        msg.fill_NACK(rnd)
+        msg_encoded = msg.encode()
+        print_stuff("{} sends msg {} to proposers", self, msg)
+        self.send_role('proposers', msg_encoded)
+
+    def send_trimmed(self):
+        """ Tell the proposers the first instance kept, in place of the phase 1B of a range starting below it. """
+        msg = Msg()
+        msg.fill_TRIMMED(self.trimmed, self.num_instance)
+        msg_encoded = msg.encode()
+        print_stuff("{} sends msg {} to proposers", self, msg)
+        self.send_role('proposers', msg_encoded)
+
+    def stats(self):
+        stats = Agent.stats(self)
+        stats.update({"num_instance": self.num_instance, "range_rnd": self.range_rnd, "lease_owner": self.lease_owner,
+                      "payloads": len(self.payloads), "waiting_2A": len(self.waiting_2A)})
+        return stats
 
     def handle_catch_up(self, role):
         """ Handles the receiving of the request of a num_instance update.
@@ -468,23 +3206,41 @@ class Acceptor(Agent):
         msg = Msg()
         msg.fill_catch_up_instance(num_instance=self.num_instance)
         msg_encoded = msg.encode()
-        print_stuff(f"{self} sends msg {msg} to {role}")
-        self.send_msg(self.network[role]['ip'], self.network[role]['port'], msg_encoded)
+        print_stuff("{} sends msg {} to {}", self, msg, role)
+        self.send_role(role, msg_encoded)
 
     def receive_msg(self, msg):
         """ Handle the receiving of a new message. """
-        print_stuff(f"{self} receives msg {msg}")
+        print_stuff("{} receives msg {}", self, msg)
 
+        if msg.instance is not None and msg.instance < self.trimmed:
+            if msg.phase == "PHASE_1A_RANGE":
+                self.send_trimmed()     # a new proposer does not know that the start of its range is trimmed
+            return      # the instance is decided and delivered by all learners
         self.update_state(msg.instance)
         if msg.instance is not None and int(msg.instance) > self.num_instance:
             self.num_instance = int(msg.instance)
 
         if msg.phase == "PHASE_1A":
             self.phase_1B(int(msg.instance), msg.data)
+        elif msg.phase == "PHASE_1A_RANGE":
+            self.phase_1B_range(int(msg.instance), msg.data)
         elif msg.phase == "PHASE_2A":
             self.phase_2B(int(msg.instance), msg.data)
+        elif msg.phase == "LEASE_REQUEST":
+            self.grant_lease(msg.data)
+        elif msg.phase == "LEASE_RELEASE":
+            if self.lease_owner == msg.data['rnd'] % 1000 - 1:
+                self.lease_owner = None
         elif msg.phase == "catch_up_instance":
             self.handle_catch_up(msg.data['role'])
+        elif msg.phase == "learner_watermark":
+            self.handle_watermark(msg.data)
+        elif msg.phase == "PAYLOAD":
+            self.handle_payload(msg.data)
+        elif msg.phase == "PAYLOAD_REQUEST":
+            if msg.data['server'] == (self.p_id - 1) // self.network['groups'] + 1:
+                self.serve_payload(msg.data)
 
 
 class Learner(Agent):
@@ -493,46 +3249,117 @@ class Learner(Agent):
 
     def __init__(self, *args, **kwargs):
         Agent.__init__(self, role="learners", *args, **kwargs)
-        self.states = {}
-        self.can_deliver = True
-        self.last_delivered = -1
+        self.states = InstanceStates(   # decisions delivered (until trimmed) and decisions waiting to be delivered
+            v=(None, None), learned=('d', 0))
+        self.last_delivered = -1        # the next instance to be delivered is last_delivered + 1
         self.num_instance = -1
+        self.output = sys.stdout        # where the values are delivered
+        self.gap_handle = None          # timer starting the catch up if the next instance does not arrive
+        self.gap_timeout = 0.05         # seconds a missing instance is waited before starting the catch up
+        self.delivered_values = 0       # number of values delivered, the state of the application
+        self.snapshot = None            # (instance, state of the application) when the last trim happened
+        self.watermark_interval = 1     # interval of seconds between learner_watermark messages
+        self.catch_up_server = None     # process sending the decisions during catch up (-1 is the leader)
+        self.catch_up_handle = None     # timer restarting the catch up if the server stops answering
+        self.catch_up_timeout = 0.5     # seconds without chunks after which the catch up is restarted
+        self.catch_up_retries = 0       # number of times the catch up has been restarted
+        self.quorum2 = 2                # acceptors needed to decide a value in phase 2
+        self.votes2B = {}               # for each undecided instance, round and bitset of the PHASE_2B received
+        self.group = 0                  # Paxos group of the learner, when there are several groups
+        self.merger = None              # Merger of the groups, None if the learner writes directly on output
+        self.delivered_requests = RequestTable()    # ids of the client requests delivered
 
     def catch_up_instance(self):
         """ Sends a message to acceptors to know the updated num_instance. """
         msg = Msg()
         msg.fill_catch_up_instance(role="learners")
         msg_encoded = msg.encode()
-        print_stuff(f"{self} sends catch up request to acceptors")
-        self.send_msg(self.network['acceptors']['ip'], self.network['acceptors']['port'], msg_encoded)
+        print_stuff("{} sends catch up request to acceptors", self)
+        self.send_role('acceptors', msg_encoded)
 
     def catch_up_learners(self):
-        """ Sends a message to proposers to know the updated decided values. """
+        """ Asks the decisions from last_delivered + 1 to num_instance to the most updated
+            learner, or to the leader if no other learner is known or the previous attempt failed.
+        """
+        first = self.last_delivered + 1
+        peers = [p_id for p_id in self.watermarks if p_id != self.p_id and self.watermarks[p_id] >= first]
+        if len(peers) > 0 and self.catch_up_retries % 2 == 0:
+            self.catch_up_server = max(peers, key=lambda p_id: self.watermarks[p_id])
+            role = 'learners'
+        else:
+            self.catch_up_server = -1
+            role = 'proposers'
         msg = Msg()
-        msg.fill_catch_up_learners()
+        msg.fill_catch_up_learners(self.p_id, self.catch_up_server, first, self.num_instance)
         msg_encoded = msg.encode()
-        print_stuff(f"{self} sends catch up learners to proposers")
-        self.send_msg(self.network['proposers']['ip'], self.network['proposers']['port'], msg_encoded)
+        print_stuff("{} sends catch up learners to {}", self, role)
+        self.metrics.counters['catch_up_requests'] += 1
+        self.send_role(role, msg_encoded)
+        self.reset_catch_up_timer()
+
+    def reset_catch_up_timer(self):
+        """ Restart the timer that restarts the catch up if no chunk arrives. """
+        if self.catch_up_handle is not None:
+            self.catch_up_handle.cancel()
+        self.catch_up_handle = self.loop.call_later(self.catch_up_timeout, self.catch_up_expired)
+
+    def catch_up_expired(self):
+        """ Called when the server of the catch up did not send chunks for catch_up_timeout seconds. """
+        self.catch_up_handle = None
+        self.catch_up_server = None
+        self.catch_up_retries += 1
+        self.catch_up_control()
+
+    def get_decision(self, instance):
+        if instance <= self.last_delivered and instance in self.states:
+            return self.states[instance]['v']
+        raise KeyError(instance)
 
     def catch_up_control(self):
-        """ Check if the learner is updated with all the instances in memory.
-            If not, it asks for the missing instances.
+        """ Deliver the decisions following the last delivered one. If the learner is still
+            behind num_instance, it asks for the missing instances.
         """
-        for i in range(0, self.num_instance + 1):
-            if i != -1 and i not in self.states:
-                self.can_deliver = False
-                break
-        print_stuff(f" {self} Can deliver? {self.can_deliver}")
-        if not self.can_deliver:
+        self.deliver()
+        if self.gap_handle is not None:
+            self.gap_handle.cancel()
+            self.gap_handle = None
+        if self.last_delivered < self.num_instance and self.catch_up_server is None:   # no catch up in progress
             self.catch_up_learners()
-        else:
+
+    def learn(self, instance, v):
+        """ Handles a decision. The decisions are delivered as soon as they are contiguous to the
+            last delivered one. If the next instance is missing, it is waited for gap_timeout seconds
+            (it may just be reordered) before starting the catch up.
+
+            :param instance: int
+                The decided instance.
+            :param v: int, str, list or None
+                The decided value (None for instances without value).
+        """
+        if instance > self.num_instance:
+            self.num_instance = instance
+        if instance <= self.last_delivered or instance in self.states:
+            return                      # duplicate decision
+        self.votes2B.pop(instance, None)
+        self.states.add(instance, v=v, learned=self.loop.time())
+        for digest in digests(v):       # payloads lost, fetched before the instance can be delivered
+            self.fetch_payload(digest)
+        self.metrics.trace(instance, 'learned', self.states[instance]['learned'])
+        if instance == self.last_delivered + 1:
             self.deliver()
+        if self.last_delivered < self.num_instance:
+            if self.gap_handle is None and self.catch_up_server is None:
+                self.gap_handle = self.loop.call_later(self.gap_timeout, self.catch_up_control)
+        elif self.gap_handle is not None:
+            self.gap_handle.cancel()
+            self.gap_handle = None
 
     def handle_catch_up(self, msg):
-        """ Handles the receiving of a num_instance update sent by acceptors.
+        """ Handles the receiving of a num_instance update sent by acceptors, or by the leader with
+            its heartbeat (the last decisions may have been lost).
 
             :param msg: class
-                Message received by acceptors
+                Message received by acceptors or by the leader
         """
         if msg.data['num_instance'] > self.num_instance:
             if self.num_instance == -1:     # learner is just born and have to update also decide values
@@ -540,62 +3367,350 @@ class Learner(Agent):
                 self.catch_up_control()
             else:
                 self.num_instance = msg.data['num_instance']
+                if self.gap_handle is None and self.catch_up_server is None:
+                    self.gap_handle = self.loop.call_later(self.gap_timeout, self.catch_up_control)
 
-    def update_decisions(self, decisions):
-        """ Handles the receiving of a decisions update sent by the leader proposer.
-            It update the learner dictionary with the missing decisions.
+    def handle_catch_up_chunk(self, instance, data):
+        """ Handles the receiving of a chunk of decisions during the catch up and acknowledges it.
 
-            :param decisions: dict
-                Dictionary of decisions sent by leader
+            :param instance: int
+                First instance of the chunk.
+            :param data: dict
+                The decisions of the chunk and the last instance of the catch up.
         """
-        if decisions is not None:
-            if len(decisions) - 1 > self.num_instance:
-                self.num_instance = len(decisions) - 1
-            for instance in decisions:
-                if int(instance) not in self.states or self.states[int(instance)]['v'] is None:
-                    self.states[int(instance)] = {'v': decisions[instance]}
-        self.can_deliver = True
+        if data['p_id'] != self.p_id or self.catch_up_server is None:
+            return
+        decisions = data['decisions']
+        if len(decisions) == 0:         # the server does not have the decisions
+            self.catch_up_handle.cancel()
+            self.catch_up_handle = None
+            self.catch_up_server = None
+            if data['last'] >= instance:    # they have been trimmed
+                self.snapshot_request()
+            elif self.gap_handle is None:   # they are not decided yet
+                self.gap_handle = self.loop.call_later(self.gap_timeout, self.catch_up_control)
+            return
+        self.metrics.counters['catch_up_decisions_received'] += len(decisions)
+        for i in decisions:
+            if i >= self.trimmed and (i not in self.states or self.states[i]['v'] is None):
+                self.states.add(i, v=decisions[i], learned=self.loop.time())
+                self.votes2B.pop(i, None)
+        next_instance = max(decisions) + 1
+        if next_instance > self.num_instance:
+            self.num_instance = next_instance - 1
+        role = 'learners' if self.catch_up_server != -1 else 'proposers'
+        msg = Msg()
+        msg.fill_catch_up_ack(self.p_id, self.catch_up_server, next_instance)
+        msg_encoded = msg.encode()
+        self.send_role(role, msg_encoded)
+        if next_instance > data['last']:   # catch up completed
+            self.catch_up_handle.cancel()
+            self.catch_up_handle = None
+            self.catch_up_server = None
+            self.catch_up_retries = 0
+        else:
+            self.reset_catch_up_timer()
         self.catch_up_control()
 
-    def run(self):
-        self.server.bind((self.ip, self.port))
-        print_stuff(f"{self} is listening")
+    def handle_2B(self, instance, data):
+        """ Handles a PHASE_2B sent directly by an acceptor: the instance is decided as soon as
+            a phase 2 quorum of acceptors voted in the same round, without waiting for the DECISION
+            of the leader, which is still used if some PHASE_2B are lost.
+
+            :param instance: int
+                The instance of the vote.
+            :param data: dict
+                The round, the acceptors and the value of the vote.
+        """
+        if instance <= self.last_delivered or instance in self.states:
+            return
+        votes = self.votes2B.get(instance, (0, 0))
+        if data['v_rnd'] < votes[0]:
+            return                      # a quorum of an older round is not needed, the DECISION will arrive
+        votes, quorum = self.add_votes(votes, data['v_rnd'], data['voters'], self.quorum2)
+        if quorum:
+            self.learn(instance, data['v_val'])
+        else:
+            self.votes2B[instance] = votes
+
+    def on_start(self):
         self.catch_up_instance()
-        while True:
-            encoded_msg, address = self.server.recvfrom(2**16)
-            msg = Msg()
-            msg.decode(encoded_msg)
-            self.receive_msg(msg)
+        self.loop.call_later(self.watermark_interval, self.watermark_sender)
 
-    def update_state(self, instance):
-        """ Add instance to the dictionary.
-                :param instance: int
-                    Instance to be added
+    def watermark_sender(self):
+        """ Periodically sends the last delivered instance to the other roles, then schedules the next one. """
+        msg = Msg()
+        msg.fill_learner_watermark(self.p_id, self.last_delivered)
+        msg_encoded = msg.encode()
+        print_stuff("{} sends msg {} to proposers, acceptors and learners", self, msg)
+        for role in ['proposers', 'acceptors', 'learners']:
+            self.send_role(role, msg_encoded)
+        self.loop.call_later(self.watermark_interval, self.watermark_sender)
+
+    def handle_watermark(self, data):
+        """ Handles the watermark of a learner like the other agents. If the learner delivered
+            instances whose decisions never arrived here (the last decisions have been lost),
+            they are caught up.
+        """
+        Agent.handle_watermark(self, data)
+        if data['last_delivered'] > self.num_instance:
+            self.num_instance = data['last_delivered']
+            if self.gap_handle is None and self.catch_up_server is None:
+                self.gap_handle = self.loop.call_later(self.gap_timeout, self.catch_up_control)
+
+    def trim(self, instance):
+        instance = min(instance, self.last_delivered + 1)    # never trim values not delivered yet
+        if instance > self.trimmed:
+            self.snapshot = (self.last_delivered, self.snapshot_state())
+            for i in range(self.trimmed, instance):
+                if i in self.states:
+                    for digest in digests(self.states[i]['v']):
+                        self.payloads.discard(digest)
+            Agent.trim(self, instance)
+            self.trim_votes(instance)
+
+    def trim_votes(self, instance):
+        """ Remove the PHASE_2B received for the instances lower than instance, they are learned. """
+        for i in [i for i in self.votes2B if i < instance]:
+            del self.votes2B[i]
+
+    def snapshot_state(self):
+        """ Return the state of the application after the last delivered value. """
+        return self.delivered_values
+
+    def install_state(self, state):
+        """ Replace the state of the application with the state of a snapshot. """
+        self.delivered_values = state
+
+    def snapshot_request(self):
+        """ Sends a message to the other learners to get a snapshot covering the trimmed instances. """
+        msg = Msg()
+        msg.fill_snapshot_request(self.last_delivered)
+        msg_encoded = msg.encode()
+        print_stuff("{} sends snapshot request to learners", self)
+        self.send_role('learners', msg_encoded)
+
+    def send_snapshot(self, last_delivered):
+        """ Sends the snapshot to a learner that is behind it.
+
+            :param last_delivered: int
+                Last instance delivered by the learner requesting the snapshot.
+        """
+        if self.snapshot is not None and self.snapshot[0] > last_delivered:
+            msg = Msg(self.snapshot[0])
+            msg.fill_SNAPSHOT(self.snapshot[1])
+            msg_encoded = msg.encode()
+            print_stuff("{} sends msg {} to learners", self, msg)
+            self.send_role('learners', msg_encoded)
+
+    def install_snapshot(self, instance, state):
+        """ Handles the receiving of a snapshot: the instances up to instance are considered
+            delivered and the state of the application is replaced.
         """
-        if instance not in self.states:
-            self.states[instance] = {'v': None}
+        if instance > self.last_delivered:
+            print_stuff("{} installs snapshot of instance {}", self, instance)
+            self.metrics.counters['snapshots_installed'] += 1
+            self.install_state(state)
+            self.last_delivered = instance
+            self.snapshot = (instance, state)
+            for fetch in self.fetching.values():    # the payloads of the instances skipped are not needed
+                if fetch[2] is not None:
+                    fetch[2].cancel()
+            self.fetching = {}
+            Agent.trim(self, instance + 1)
+            self.trim_votes(instance + 1)
+            if instance > self.num_instance:
+                self.num_instance = instance
+            self.catch_up_control()
 
     def deliver(self):
-        """ Deliver all values from the last delivered to the maximum instance value. """
-        for i in range((self.last_delivered + 1), (len(self.states))):
-            if i in self.states and self.states[i]['v'] is not None:
-                print_stuff(f"Instance {i}:")
-                print(self.states[i]['v'], flush=True)          # deliver
-        self.last_delivered = len(self.states)-1
+        """ Deliver the values of the contiguous run of decided instances following the last delivered one,
+            with a single write on the output. The delivery stops at an instance whose large values
+            miss their payloads, until they are fetched.
+        """
+        lines = []
+        i = self.last_delivered + 1
+        now = self.loop.time()
+        while i in self.states:
+            state = self.states[i]
+            missing = [command.v for command in commands(state['v']) if isinstance(command.v, Digest)
+                       and command.v not in self.payloads and (command.client_id, command.seq) not in self.delivered_requests]
+            if len(missing) > 0:
+                for digest in missing:
+                    self.fetch_payload(digest)
+                break
+            self.metrics.observe('delivery_lag', now - state['learned'])     # time waited for the previous instances
+            self.metrics.trace(i, 'delivered', now)
+            v = self.resolve_payloads(self.remove_duplicates(i, state['v']))
+            if self.merger is not None:     # the values are delivered in the merged order
+                if v is not None:
+                    self.merger.add(self.group, i, v)
+                    self.delivered_values += len(v) if isinstance(v, list) else 1
+            elif isinstance(v, list):       # batch of values
+                lines.extend(map(str, v))
+            elif v is not None:
+                lines.append(str(v))
+            i += 1
+        if i - 1 > self.last_delivered:
+            print_stuff("Instances {} to {}:", self.last_delivered + 1, i - 1)
+            self.last_delivered = i - 1
+        if len(lines) > 0:
+            self.output.write('\n'.join(lines) + '\n')     # deliver
+            self.output.flush()
+            self.delivered_values += len(lines)
+        if self.merger is not None:
+            self.merger.merge(self.group, self.last_delivered + 1)
+
+    def stats(self):
+        stats = Agent.stats(self)
+        stats.update({"last_delivered": self.last_delivered, "num_instance": self.num_instance,
+                      "behind": self.num_instance - self.last_delivered, "delivered_values": self.delivered_values})
+        return stats
+
+    def remove_duplicates(self, instance, v):
+        """ Return the decided value without the client requests already delivered: a request retried
+            by its client can be decided in two instances, but it is delivered only in the first one.
+
+            :param instance: int
+                The instance of the decision.
+            :param v: int, str, Command, list or None
+                The decided value.
+        """
+        if isinstance(v, Command):
+            return v if self.delivered_requests.add(v.client_id, v.seq, instance) else None
+        if isinstance(v, list):
+            return [value for value in v if not isinstance(value, Command)
+                    or self.delivered_requests.add(value.client_id, value.seq, instance)]
+        return v
+
+    def resolve_payloads(self, v):
+        """ Return the value with the payloads of its large values in place of their digests. """
+        if isinstance(v, Command) and isinstance(v.v, Digest):
+            return Command(v.client_id, v.seq, self.payloads.get(v.v).decode())
+        if isinstance(v, list) and any(isinstance(value, Command) and isinstance(value.v, Digest) for value in v):
+            return [self.resolve_payloads(value) for value in v]
+        return v
+
+    def payload_ready(self, digest):
+        self.deliver()
+
+    def request_skip(self, last):
+        """ Asks the leader of the group to decide the instances up to last, without values if there are no requests. """
+        msg = Msg()
+        msg.fill_skip(last)
+        msg_encoded = msg.encode()
+        print_stuff("{} sends msg {} to proposers", self, msg)
+        self.send_role('proposers', msg_encoded)
 
     def receive_msg(self, msg):
         """ Handle the receiving of a new message. """
-        print_stuff(f"{self} receives msg {msg}")
+        print_stuff("{} receives msg {}", self, msg)
 
+        if msg.instance is not None and msg.instance < self.trimmed:
+            return      # the instance is already delivered
         if msg.phase == "DECISION":
-            if msg.instance is not None and int(msg.instance) > self.num_instance:
-                self.num_instance = int(msg.instance)
-            self.update_state(msg.instance)
-            self.states[int(msg.instance)]['v'] = msg.data['v_val']
-            self.can_deliver = True
-            self.catch_up_control()
+            self.learn(int(msg.instance), msg.data['v_val'])
+        elif msg.phase == "PHASE_2B":
+            self.handle_2B(int(msg.instance), msg.data)
         elif msg.phase == "catch_up_instance":
             self.handle_catch_up(msg)
         elif msg.phase == "catch_up_learners":
-            self.update_decisions(msg.data)
+            if msg.data['server'] == self.p_id:
+                self.serve_catch_up(msg.data)
+        elif msg.phase == "catch_up_ack":
+            if msg.data['server'] == self.p_id:
+                self.handle_catch_up_ack(msg.data)
+        elif msg.phase == "catch_up_chunk":
+            self.handle_catch_up_chunk(msg.instance, msg.data)
+        elif msg.phase == "learner_watermark":
+            self.handle_watermark(msg.data)
+        elif msg.phase == "snapshot_request":
+            self.send_snapshot(msg.data['last_delivered'])
+        elif msg.phase == "SNAPSHOT":
+            self.install_snapshot(msg.instance, msg.data['state'])
+        elif msg.phase == "PAYLOAD":
+            self.handle_payload(msg.data)
+
+
+# ----------------------------------------------------------------------------------------------------
+#
+# MERGING THE PAXOS GROUPS
+#
+# ----------------------------------------------------------------------------------------------------
 
+
+class Merger():
+
+    """ Merges the logs of several Paxos groups into a single total order. The instances are taken
+        round-robin: instance i of group 0, ..., instance i of group K-1, then instance i+1 of group 0...
+        so every learner delivers the same sequence. A group without requests blocks the others: when
+        the merge waits for it more than skip_timeout seconds, its leader is asked to decide the missing
+        instances without values (as in Mencius).
+    """
+
+    def __init__(self, num_groups, output=sys.stdout):
+        self.learners = []              # learner of each group
+        self.output = output            # where the values are delivered
+        self.queues = [collections.deque() for g in range(num_groups)]  # (instance, value) delivered by each group
+        self.next = [0] * num_groups    # first instance not delivered yet by the learner of each group
+        self.skip_timeout = 0.01        # seconds the merge waits for a group before asking it to skip
+        self.skip_handle = None         # timer asking the group blocking the merge to skip
+
+    def add(self, group, instance, v):
+        """ Adds a value decided in a group, the instances without value are not added.
+
+            :param group: int
+                The group that decided the value.
+            :param instance: int
+                The instance of the value in the group.
+            :param v: int, str or list
+                The decided value (or batch of values).
+        """
+        self.queues[group].append((instance, v))
+
+    def position(self, group):
+        """ Return the position in the merged order of the next instance of a group. """
+        queue = self.queues[group]
+        return (queue[0][0] if len(queue) > 0 else self.next[group], group)
+
+    def blocking(self):
+        """ Return the group whose instance is the next one in the merged order. """
+        return min(self.position(g) for g in range(len(self.queues)))[1]
+
+    def merge(self, group, next_instance):
+        """ Called when the learner of a group delivers instances: delivers the values that are
+            next in the merged order, with a single write on the output.
+
+            :param group: int
+                The group of the learner.
+            :param next_instance: int
+                The first instance not delivered yet by the learner.
+        """
+        self.next[group] = next_instance
+        lines = []
+        while True:
+            queue = self.queues[self.blocking()]
+            if len(queue) == 0:
+                break
+            instance, v = queue.popleft()
+            if isinstance(v, list):
+                lines.extend(map(str, v))
+            else:
+                lines.append(str(v))
+        if len(lines) > 0:
+            self.output.write('\n'.join(lines) + '\n')     # deliver
+            self.output.flush()
+        if any(len(queue) > 0 for queue in self.queues):
+            if self.skip_handle is None:
+                self.skip_handle = self.learners[group].loop.call_later(self.skip_timeout, self.skip)
+        elif self.skip_handle is not None:
+            self.skip_handle.cancel()
+            self.skip_handle = None
+
+    def skip(self):
+        """ Asks the group blocking the merge to decide the instances up to the last one waiting. """
+        self.skip_handle = None
+        waiting = [queue[-1][0] for queue in self.queues if len(queue) > 0]
+        if len(waiting) > 0:
+            self.learners[self.blocking()].request_skip(max(waiting))
+            self.skip_handle = self.learners[0].loop.call_later(self.skip_timeout, self.skip)
@@ -2,12 +2,41 @@
 from utils import *
 from classes import *
 
-MAX_NUM_ACCEPTORS = 3       # if you want more acceptors, change here
+NUM_LEARNERS = 2            # learners that must have delivered an instance before it is trimmed
+MULTI_PAXOS = True          # if False, the leader runs phase 1 for every single instance
+BATCHING = True             # if False, every client value is proposed in its own instance
+WINDOW_SIZE = 10            # max number of instances that the leader keeps in flight
+DIRECT_2B = False           # if True, acceptors send PHASE_2B also to learners, that decide without the leader
+LEASE_DURATION = 0.5        # seconds of the leader leases that allow local reads, 0 to disable them
+HEARTBEAT_INTERVAL = 0.1    # seconds between the heartbeats of the leader
+PHI_THRESHOLD = 8           # suspicion level of the phi accrual failure detector at which the leader is replaced
+ACCEPTOR_WAL_DIR = None     # directory of the acceptors write-ahead logs, None to keep the state only in memory
+STATS_INTERVAL = 0          # seconds between two dumps of the metrics on stderr, 0 to dump them only on SIGUSR1
+TRACE_SAMPLE = 0            # one instance every TRACE_SAMPLE is traced in the metrics, 0 to trace nothing
+LARGE_VALUE_THRESHOLD = 8192    # bytes from which a client value is sent out of band and only its digest is proposed
+PROFILE = None              # 'cprofile' or 'sample' to profile the processes and time the messages of each phase
+PROFILE_DIR = 'profiles'    # directory where each profiled process writes its files when it is terminated
+
+
+def profiler(role, p_id):
+
+    """ Return the Profiler of a process, None if PROFILE is None.
+
+        :param role: str
+            The role of the process.
+        :param p_id: int
+            The process id.
+    """
+
+    if PROFILE is None:
+        return None
+    return Profiler(PROFILE, os.path.join(PROFILE_DIR, f"{role}{p_id}"))
 
 
 def client(network, p_id):
 
-    """ Create a client from the network and run it.
+    """ Create a client from the network and run it. With several Paxos groups,
+        the client belongs to the group (p_id - 1) % groups.
 
         :param network: dict
             The network containing processes info.
@@ -15,19 +44,23 @@ def client(network, p_id):
             The process id of the created client.
     """
 
+    network = group_network(network, (int(p_id) - 1) % network['groups'])
     # print('-> client ', p_id)
     client = Client(ip=network['clients']['ip'],
                     port=network['clients']['port'],
                     p_id=int(p_id),
                     network=network)
 
-    client.run()
+    client.stats_interval = STATS_INTERVAL
+    client.payload_threshold = LARGE_VALUE_THRESHOLD
+    client.run(profiler('client', p_id))
     # print('client done.')
 
 
 def proposer(network, p_id):
 
-    """ Create a proposer from the network and run it.
+    """ Create a proposer from the network and run it. With several Paxos groups,
+        the proposer belongs to the group (p_id - 1) % groups.
 
         :param network: dict
             The network containing processes info.
@@ -35,15 +68,26 @@ def proposer(network, p_id):
             The process id of the created proposer.
     """
 
+    network = group_network(network, (int(p_id) - 1) % network['groups'])
     # print('-> proposer', p_id)
     proposer = Proposer(ip=network['proposers']['ip'],
                         port=network['proposers']['port'],
                         p_id=int(p_id),
                         network=network)
 
-    proposer.max_num_acceptors = MAX_NUM_ACCEPTORS
+    proposer.quorum1 = network['quorums']['phase1']
+    proposer.quorum2 = network['quorums']['phase2']
+    proposer.num_learners = NUM_LEARNERS
+    proposer.multi_paxos = MULTI_PAXOS
+    proposer.batching = BATCHING
+    proposer.window_size = WINDOW_SIZE
+    proposer.lease_duration = LEASE_DURATION
+    proposer.leader_sender_interval = HEARTBEAT_INTERVAL
+    proposer.detector.threshold = PHI_THRESHOLD
+    proposer.stats_interval = STATS_INTERVAL
+    proposer.metrics.trace_sample = TRACE_SAMPLE
 
-    proposer.start()
+    proposer.run(profiler('proposer', p_id))
 
 
 def acceptor(network, p_id):
@@ -56,18 +100,26 @@ def acceptor(network, p_id):
             The process id of the created acceptor.
     """
 
+    network = group_network(network, (int(p_id) - 1) % network['groups'])
     # print('-> acceptor', p_id)
     acceptor = Acceptor(ip=network['acceptors']['ip'],
                         port=network['acceptors']['port'],
                         p_id=int(p_id),
                         network=network)
 
-    acceptor.start()
+    acceptor.num_learners = NUM_LEARNERS
+    acceptor.direct_2B = DIRECT_2B
+    acceptor.stats_interval = STATS_INTERVAL
+    if ACCEPTOR_WAL_DIR is not None:
+        acceptor.wal_path = os.path.join(ACCEPTOR_WAL_DIR, f"acceptor{p_id}.wal")
+
+    acceptor.run(profiler('acceptor', p_id))
 
 
 def learner(network, p_id):
 
-    """ Create a learner from the network and run it.
+    """ Create a learner from the network and run it. With several Paxos groups,
+        the process runs a learner for each group and merges their values.
 
         :param network: dict
             The network containing processes info.
@@ -76,14 +128,26 @@ def learner(network, p_id):
     """
 
     # print('-> learner ', p_id)
-    learner = Learner(ip=network['learners']['ip'],
-                      port=network['learners']['port'],
-                      p_id=int(p_id),
-                      network=network)
-
-    learner.max_num_acceptors = MAX_NUM_ACCEPTORS
-
-    learner.start()
+    merger = Merger(network['groups']) if network['groups'] > 1 else None
+    learners = []
+    for group in range(network['groups']):
+        group_net = group_network(network, group)
+        learner = Learner(ip=group_net['learners']['ip'],
+                          port=group_net['learners']['port'],
+                          p_id=int(p_id),
+                          network=group_net)
+
+        learner.num_learners = NUM_LEARNERS
+        learner.quorum2 = network['quorums']['phase2']
+        learner.stats_interval = STATS_INTERVAL
+        learner.metrics.trace_sample = TRACE_SAMPLE
+        if merger is not None:
+            learner.group = group
+            learner.merger = merger
+            merger.learners.append(learner)
+        learners.append(learner)
+
+    run_agents(learners, profiler('learner', p_id))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+import argparse
+import collections
+import glob
+import json
+import os
+import pstats
+import re
+
+# ----------------------------------------------------------------------------------------------------
+#
+# REPORT OF THE PROFILED RUNS
+#
+# ----------------------------------------------------------------------------------------------------
+
+IDLE = ("<method 'poll' of 'select.epoll' objects>", "<method 'select' of 'select.epoll' objects>")   # waits of the event loop
+
+
+def process_role(path):
+    """ Return the role of the process that wrote a profile file, from its name (e.g. proposer2.prof). """
+    return re.sub(r'\d+$', '', os.path.splitext(os.path.basename(path))[0])
+
+
+def load_timing(directory):
+    """ Return, for each (role, phase, step), the messages and the seconds summed over the processes of a run. """
+    timing = collections.defaultdict(lambda: [0, 0.0])
+    for path in glob.glob(os.path.join(directory, '*.json')):
+        with open(path) as f:
+            for stats in json.load(f):
+                for phase, steps in stats.get('timing', {}).items():
+                    for step, summary in steps.items():
+                        if summary['count'] > 0:
+                            entry = timing[(process_role(path), phase, step)]
+                            entry[0] += summary['count']
+                            entry[1] += summary['count'] * summary['mean_ms'] / 1000
+    return timing
+
+
+def load_functions(directory):
+    """ Return, for each role, the seconds spent in each function itself (without its callees),
+        from the cProfile statistics or from the leaves of the sampled stacks of a run.
+        The sampled profiles count CPU time only, so the waits of the event loop are dropped from cProfile too.
+    """
+    functions = collections.defaultdict(collections.Counter)
+    for path in glob.glob(os.path.join(directory, '*.prof')):
+        for (filename, line, name), (_, _, tottime, _, _) in pstats.Stats(path).stats.items():
+            if name in IDLE:
+                continue
+            functions[process_role(path)][f"{name} ({os.path.basename(filename)}:{line})"] += tottime
+    for path in glob.glob(os.path.join(directory, '*.folded')):
+        with open(path) as f:
+            for line in f:
+                stack, microseconds = line.rsplit(' ', 1)
+                functions[process_role(path)][stack.split(';')[-1]] += int(microseconds) / 1e6
+    return functions
+
+
+def change(old, new):
+    """ Return the relative change from old to new as a string, empty if old is 0. """
+    return f"{(new - old) / old * 100:+.0f}%" if old > 0 else ""
+
+
+def report(runs, top):
+    """ Print the per-phase timing and the functions with the most time of each role, side by side for the runs,
+        with the change of the last run from the first one.
+
+        :param runs: list
+            The directories of the profiled runs (PROFILE_DIR of paxos.py).
+        :param top: int
+            Number of functions shown for each role.
+    """
+    names = [os.path.basename(os.path.normpath(run)) for run in runs]
+    timings = [load_timing(run) for run in runs]
+    print(f"{'role':<10} {'phase':<18} {'step':<7}" + ''.join(f" {name[:23]:>23}" for name in names) + f" {'change':>7}")
+    print(f"{'':<37}" + f" {'msgs':>8} {'us/msg':>7} {'ms':>6}" * len(runs))
+    keys = sorted(set().union(*timings), key=lambda key: -max(timing[key][1] for timing in timings))
+    for key in keys:
+        entries = [timing.get(key, [0, 0.0]) for timing in timings]
+        means = [seconds / count * 1e6 if count > 0 else 0 for count, seconds in entries]
+        print(f"{key[0]:<10} {key[1]:<18} {key[2]:<7}" +
+              ''.join(f" {count:>8} {mean:>7.1f} {seconds * 1000:>6.0f}" for (count, seconds), mean in zip(entries, means)) +
+              f" {change(means[0], means[-1]):>7}")
+
+    functions = [load_functions(run) for run in runs]
+    for role in sorted(set().union(*functions)):
+        print(f"\n{role}: seconds in the function itself")
+        names = set()
+        for run_functions in functions:
+            names.update(name for name, _ in run_functions[role].most_common(top))
+        for name in sorted(names, key=lambda name: -max(run_functions[role][name] for run_functions in functions))[:top]:
+            seconds = [run_functions[role][name] for run_functions in functions]
+            print(''.join(f"{s:>9.3f}" for s in seconds) + f" {change(seconds[0], seconds[-1]):>7}  {name}")
+
+
+def folded(runs):
+    """ Print the per-phase timing of the runs as folded stacks "run;role;phase;step microseconds", for flamegraph.pl. """
+    for run in runs:
+        name = os.path.basename(os.path.normpath(run))
+        for (role, phase, step), (count, seconds) in sorted(load_timing(run).items()):
+            print(f"{name};{role};{phase};{step} {round(seconds * 1e6)}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compare the profiles written by the processes of paxos.py with PROFILE.")
+    parser.add_argument('runs', nargs='+', help="directories of the profiles of each run, the first one is the baseline")
+    parser.add_argument('--top', type=int, default=15, help="functions shown for each role")
+    parser.add_argument('--folded', action='store_true',
+                        help="print the per-phase timing as folded stacks for flamegraph.pl instead of the report")
+    args = parser.parse_args()
+
+    if args.folded:
+        folded(args.runs)
+    else:
+        report(args.runs, args.top)
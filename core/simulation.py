@@ -0,0 +1,510 @@
+#!/usr/bin/env python
+import argparse
+import asyncio
+import io
+import os
+import random
+import selectors
+import tempfile
+import time
+from classes import Client, Proposer, Acceptor, Learner, Merger, Msg, Command, commands
+from utils import create_network, group_network, majority
+
+# ----------------------------------------------------------------------------------------------------
+#
+# SIMULATED NETWORK
+#
+# ----------------------------------------------------------------------------------------------------
+
+
+class VirtualSelector(selectors.BaseSelector):
+
+    """ Selector that never waits: when nothing is ready, it moves the virtual clock
+        forward to the next timer of the event loop instead of sleeping.
+    """
+
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()     # real selector, for the internal pipe of the loop
+        self.time = 0.0                                 # virtual time in seconds
+
+    def register(self, fileobj, events, data=None):
+        return self.selector.register(fileobj, events, data)
+
+    def unregister(self, fileobj):
+        return self.selector.unregister(fileobj)
+
+    def modify(self, fileobj, events, data=None):
+        return self.selector.modify(fileobj, events, data)
+
+    def select(self, timeout=None):
+        events = self.selector.select(0)
+        if len(events) == 0:
+            if timeout is None:     # no timer scheduled, the simulation would wait forever
+                return self.selector.select(None)
+            self.time += timeout
+        return events
+
+    def close(self):
+        self.selector.close()
+
+    def get_key(self, fileobj):
+        return self.selector.get_key(fileobj)
+
+    def get_map(self):
+        return self.selector.get_map()
+
+
+class VirtualClockLoop(asyncio.SelectorEventLoop):
+
+    """ Event loop whose clock is virtual: timers fire in order without waiting for them. """
+
+    def __init__(self):
+        self.virtual_selector = VirtualSelector()
+        asyncio.SelectorEventLoop.__init__(self, self.virtual_selector)
+
+    def time(self):
+        return self.virtual_selector.time
+
+
+class SimTransport():
+
+    """ Transport of an agent on a SimNetwork. """
+
+    def __init__(self, network, ip, port):
+        """
+            :param network: class
+                The simulated network.
+            :param ip: str
+                The group of the agent.
+            :param port: int
+                The communication port of the agent.
+        """
+        self.network = network
+        self.ip = ip
+        self.port = port
+        self.agent = None
+
+    async def open(self, agent):
+        self.agent = agent
+        self.network.groups.setdefault((self.ip, self.port), []).append(agent)
+
+    def send(self, ip, port, msg):
+        self.network.send(self.agent, ip, port, msg)
+
+
+class SimNetwork():
+
+    """ In-memory network that delivers the datagrams of the agents running on its virtual clock loop.
+        Every datagram is delivered to all the agents of the destination group, each copy with
+        its own random latency, and it can be lost, duplicated, delayed or blocked by a partition.
+        All the random choices come from a seeded generator, so a run can be repeated exactly.
+    """
+
+    def __init__(self, seed=0, latency=(0.0002, 0.001), loss=0.0, duplication=0.0, reordering=0.0,
+                 reorder_delay=0.01):
+        """
+            :param seed: int
+                Seed of the random choices.
+            :param latency: tuple
+                Min and max latency of a datagram, in seconds.
+            :param loss: float
+                Probability that a datagram is lost.
+            :param duplication: float
+                Probability that a datagram is delivered twice.
+            :param reordering: float
+                Probability that a datagram is delayed by up to reorder_delay seconds more.
+            :param reorder_delay: float
+                Max additional delay of a reordered datagram.
+        """
+        self.random = random.Random(seed)
+        self.latency = latency
+        self.loss = loss
+        self.duplication = duplication
+        self.reordering = reordering
+        self.reorder_delay = reorder_delay
+        self.loop = VirtualClockLoop()
+        self.groups = {}            # for each (ip, port), the agents receiving its datagrams
+        self.sides = {}             # for each agent in a partition, its side
+        self.stats = {"sent": 0, "delivered": 0, "lost": 0, "blocked": 0, "duplicated": 0}
+
+    def transport(self, ip, port):
+        """ Return a transport for an agent with the given ip and port. """
+        return SimTransport(self, ip, port)
+
+    def partition(self, *sides):
+        """ Split the network: the agents of different sides cannot communicate,
+            the agents not in any side still communicate with everybody.
+
+            :param sides: list
+                The lists of agents of each side.
+        """
+        self.sides = {agent: k for k, side in enumerate(sides) for agent in side}
+
+    def heal(self):
+        """ Remove the partition. """
+        self.sides = {}
+
+    def send(self, sender, ip, port, msg):
+        self.stats["sent"] += 1
+        for receiver in self.groups.get((ip, port), []):
+            if receiver is not sender:
+                side = self.sides.get(sender)
+                if side is not None and self.sides.get(receiver, side) != side:
+                    self.stats["blocked"] += 1
+                    continue
+                if self.random.random() < self.loss:
+                    self.stats["lost"] += 1
+                    continue
+            copies = 2 if self.random.random() < self.duplication else 1
+            self.stats["duplicated"] += copies - 1
+            for k in range(copies):
+                delay = self.random.uniform(*self.latency)
+                if self.random.random() < self.reordering:
+                    delay += self.random.uniform(0, self.reorder_delay)
+                self.loop.call_later(delay, self.deliver, receiver, msg)
+
+    def deliver(self, receiver, msg):
+        self.stats["delivered"] += 1
+        receiver.receive_datagram(msg)
+
+    def start(self, agents):
+        """ Start the agents on the virtual clock loop. """
+        async def main():
+            for agent in agents:
+                await agent.start()
+        self.loop.run_until_complete(main())
+
+    def run(self, duration):
+        """ Run the simulation for duration virtual seconds. """
+        self.loop.run_until_complete(asyncio.sleep(duration))
+
+    def close(self):
+        self.loop.close()
+
+
+# ----------------------------------------------------------------------------------------------------
+#
+# SEEDED SCENARIOS
+#
+# ----------------------------------------------------------------------------------------------------
+
+class TimedLines(io.StringIO):
+
+    """ StringIO that records the virtual time at which each line is first read or written. """
+
+    def __init__(self, loop, initial_value=''):
+        io.StringIO.__init__(self, initial_value)
+        self.loop = loop
+        self.times = {}
+
+    def readline(self, *args):
+        line = io.StringIO.readline(self, *args)
+        if line != '':
+            self.times.setdefault(line.strip(), self.loop.time())
+        return line
+
+    def write(self, s):
+        now = self.loop.time()
+        for line in s.split('\n'):
+            if line != '':
+                self.times.setdefault(line, now)
+        return io.StringIO.write(self, s)
+
+
+def percentile(values, p):
+    """ Return the p-th percentile (0-100) of a sorted list, None if the list is empty. """
+    if len(values) == 0:
+        return None
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+CONFIG = [['clients', 'sim', 100], ['proposers', 'sim', 200], ['acceptors', 'sim', 300], ['learners', 'sim', 400]]
+
+
+def scenario(seed, values=100, clients=2, proposers=2, acceptors=3, learners=2, loss=0.0, duplication=0.0,
+             reordering=0.0, partition=None, duration=10, quorum1=None, quorum2=None, direct_2B=False, groups=1,
+             reads=0, crash=None, value_size=0, multi_paxos=True):
+    """ Run a complete execution of the protocol on a simulated network and check its results.
+
+        :param seed: int
+            Seed of the network.
+        :param values: int
+            Number of values proposed by each client.
+        :param partition: tuple
+            Virtual start and end time of a partition isolating the leader from the acceptors, or None.
+        :param duration: float
+            Virtual seconds of the execution.
+        :param quorum1: int
+            Size of the phase 1 quorums, a majority if None.
+        :param quorum2: int
+            Size of the phase 2 quorums, a majority if None.
+        :param direct_2B: bool
+            Acceptors send PHASE_2B also to the learners.
+        :param groups: int
+            Number of Paxos groups, each one with its proposers and acceptors. The clients are
+            partitioned among the groups and every learner merges all of them.
+        :param reads: int
+            Number of values that each client of the first group proposes and then reads back with a local read of the leader.
+        :param crash: float
+            Virtual time at which the leader of the first group is isolated from all the other agents, or None.
+        :param value_size: int
+            Characters of each value proposed by the clients, large values are sent out of band.
+        :param multi_paxos: bool
+            The leader runs phase 1 once for all the instances, otherwise once for every instance.
+        :return: dict
+            The checks of the execution, the latency from the client to learner 1 and the statistics of the network.
+    """
+    sim = SimNetwork(seed, loss=loss, duplication=duplication, reordering=reordering)
+    network = create_network(CONFIG + [['num_acceptors', acceptors],
+                                       ['phase1_quorum', quorum1 or majority(acceptors)],
+                                       ['phase2_quorum', quorum2 or majority(acceptors)],
+                                       ['groups', groups]])
+
+    def create(role, cls, p_id, group):
+        group_net = group_network(network, group)
+        ip, port = group_net[role]['ip'], group_net[role]['port']
+        agent = cls(ip=ip, port=port, p_id=p_id, network=group_net, transport=sim.transport(ip, port))
+        agent.num_learners = learners
+        return agent
+
+    # the process p_id of proposers, acceptors and clients belongs to the group (p_id - 1) % groups
+    acceptor_agents = [create('acceptors', Acceptor, i, (i - 1) % groups) for i in range(1, acceptors * groups + 1)]
+    learner_agents = [create('learners', Learner, i, g) for i in range(1, learners + 1) for g in range(groups)]
+    proposer_agents = [create('proposers', Proposer, i, (i - 1) % groups) for i in range(1, proposers * groups + 1)]
+    client_agents = [create('clients', Client, i, (i - 1) % groups) for i in range(1, clients + 1)]
+    for proposer in proposer_agents:
+        proposer.quorum1 = network['quorums']['phase1']
+        proposer.quorum2 = network['quorums']['phase2']
+        proposer.multi_paxos = multi_paxos
+    for acceptor in acceptor_agents:
+        acceptor.direct_2B = direct_2B
+    outputs = []
+    for learner in learner_agents:
+        learner.quorum2 = network['quorums']['phase2']
+        if groups == 1:
+            learner.output = TimedLines(sim.loop)
+            outputs.append(learner.output)
+        else:
+            if learner.network['learners']['port'] == network['learners']['port']:    # first group
+                outputs.append(TimedLines(sim.loop))
+                merger = Merger(groups, outputs[-1])
+            learner.group = len(merger.learners)
+            learner.merger = merger
+            merger.learners.append(learner)
+    proposed = set()
+    for client in client_agents:
+        client_values = [f"{client.p_id}-{i}".ljust(value_size, 'x') for i in range(values)]
+        proposed.update(client_values)
+        client.input = TimedLines(sim.loop, ''.join(v + '\n' for v in client_values))
+
+    if partition is not None:
+        leader = proposer_agents[-1]        # the proposer with the highest id becomes the leader
+        sim.loop.call_at(partition[0], sim.partition, [leader], acceptor_agents)
+        sim.loop.call_at(partition[1], sim.heal)
+
+    agents = acceptor_agents + learner_agents + proposer_agents + client_agents
+    if crash is not None:
+        def crash_leader():
+            leaders = [p for p in proposer_agents[::groups] if p.leader and p.range_ready]
+            if len(leaders) > 0:
+                sim.partition(leaders[-1:], [agent for agent in agents if agent is not leaders[-1]])
+        sim.loop.call_at(crash, crash_leader)
+
+    sim.start(agents)
+    committed = [-1]        # highest instance whose commit has been acknowledged
+    read_checks = []
+    completions = []        # virtual times at which the operations of the readers completed
+
+    async def reader(client):
+        """ Propose a value, then check that a read started after its commit reflects every commit before it. """
+        for i in range(reads):
+            value = f"{client.p_id}-r{i}"
+            proposed.add(value)
+            instance = await client.submit(value)
+            completions.append(sim.loop.time())
+            if instance is not None:
+                committed[0] = max(committed[0], instance)
+            floor = committed[0]
+            read_checks.append(await client.read() >= floor)
+            completions.append(sim.loop.time())
+
+    readers = [client for client in client_agents if client.network['clients']['port'] == network['clients']['port']]
+    if reads > 0:
+        for client in readers:
+            sim.loop.create_task(reader(client))
+    sim.run(duration)
+    sim.close()
+
+    delivered = [output.getvalue().split() for output in outputs]
+    longest = max(delivered, key=len)
+    sent = {v: t for client in client_agents for v, t in client.input.times.items()}
+    latencies = sorted((t - sent[v]) * 1000 for v, t in outputs[0].times.items() if v in sent)
+    completions.sort()
+    gaps = [(b - a) * 1000 for a, b in zip(completions, completions[1:])]
+    return {
+        "seed": seed,
+        "delivered": [len(d) for d in delivered],
+        "proposed": len(proposed),
+        "consistent": all(d == longest[:len(d)] for d in delivered),    # learners deliver the same sequence
+        "valid": all(v in proposed for v in longest),                     # only proposed values are delivered
+        "complete": set(longest) == proposed,
+        "exactly_once": len(set(longest)) == len(longest),             # retried values are delivered once
+        "linearizable": all(read_checks) and len(read_checks) == reads * len(readers),   # all reads answered
+        "latency_ms": {"p50": percentile(latencies, 50), "p99": percentile(latencies, 99)},
+        "max_gap_ms": max(gaps, default=None),      # longest time without completed reads or commits
+        "network": sim.stats,
+    }
+
+
+def duplicate_request(seed, acceptors=3):
+    """ Send the same request twice to a ready leader before its commit, proposing a batch after each copy.
+
+        :param seed: int
+            Seed of the network.
+        :return: list
+            The decided instances whose value contains the request, a single one if the retry is not proposed again.
+    """
+    sim = SimNetwork(seed)
+    network = create_network(CONFIG + [['num_acceptors', acceptors],
+                                       ['phase1_quorum', majority(acceptors)],
+                                       ['phase2_quorum', majority(acceptors)]])
+
+    def create(role, cls, p_id):
+        ip, port = network[role]['ip'], network[role]['port']
+        return cls(ip=ip, port=port, p_id=p_id, network=network, transport=sim.transport(ip, port))
+
+    leader = create('proposers', Proposer, 1)
+    leader.quorum1 = leader.quorum2 = majority(acceptors)
+    agents = [create('acceptors', Acceptor, i) for i in range(1, acceptors + 1)] + [leader]
+    sim.start(agents)
+    sim.run(1)      # the leader completes its phase 1
+    msg = Msg()
+    msg.fill_REQUEST('x', 7 << 32, 0)
+    for k in range(2):
+        sim.deliver(leader, msg.encode())
+        leader.flush_batch()
+    sim.run(1)
+    sim.close()
+    command = Command(7 << 32, 0, 'x')
+    return [i for i in leader.states if leader.states[i]['decided'] and command in commands(leader.states[i]['c_val'])]
+
+
+def recover_after_trim(seed, values=300, acceptors=3):
+    """ Run acceptors with a write-ahead log until they trim, then restart one of them from its log.
+
+        :param seed: int
+            Seed of the network.
+        :param values: int
+            Number of values proposed by the client, one per instance.
+        :return: tuple
+            The (trimmed, num_instance) of the acceptor before and after the restart.
+    """
+    sim = SimNetwork(seed)
+    network = create_network(CONFIG + [['num_acceptors', acceptors],
+                                       ['phase1_quorum', majority(acceptors)],
+                                       ['phase2_quorum', majority(acceptors)]])
+
+    def create(role, cls, p_id):
+        ip, port = network[role]['ip'], network[role]['port']
+        agent = cls(ip=ip, port=port, p_id=p_id, network=network, transport=sim.transport(ip, port))
+        agent.num_learners = 1
+        agent.trim_interval = 10
+        return agent
+
+    with tempfile.TemporaryDirectory() as wal_dir:
+        acceptor_agents = [create('acceptors', Acceptor, i) for i in range(1, acceptors + 1)]
+        for acceptor in acceptor_agents:
+            acceptor.wal_path = os.path.join(wal_dir, f"acceptor{acceptor.p_id}.wal")
+        learner = create('learners', Learner, 1)
+        learner.output = TimedLines(sim.loop)
+        proposer = create('proposers', Proposer, 1)
+        proposer.batching = False
+        client = create('clients', Client, 1)
+        client.input = TimedLines(sim.loop, ''.join(f"{i}\n" for i in range(values)))
+        sim.start(acceptor_agents + [learner, proposer, client])
+        sim.run(3)
+        before = (acceptor_agents[0].trimmed, acceptor_agents[0].num_instance)
+        restarted = create('acceptors', Acceptor, 1)
+        restarted.wal_path = acceptor_agents[0].wal_path
+        sim.partition([acceptor_agents[0], restarted])     # the restarted acceptor only reads its log
+        sim.loop.run_until_complete(restarted.start())
+        after = (restarted.trimmed, restarted.num_instance)
+        sim.close()
+    return before, after
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run seeded executions of the protocol on a simulated network.")
+    parser.add_argument('--runs', type=int, default=100)
+    parser.add_argument('--seed', type=int, default=0, help="seed of the first run")
+    parser.add_argument('--values', type=int, default=100, help="values proposed by each client")
+    parser.add_argument('--clients', type=int, default=2)
+    parser.add_argument('--proposers', type=int, default=2)
+    parser.add_argument('--acceptors', type=int, default=3)
+    parser.add_argument('--learners', type=int, default=2)
+    parser.add_argument('--quorum1', type=int, help="size of the phase 1 quorums (default: majority)")
+    parser.add_argument('--quorum2', type=int, help="size of the phase 2 quorums (default: majority)")
+    parser.add_argument('--loss', type=float, default=0.0)
+    parser.add_argument('--duplication', type=float, default=0.0)
+    parser.add_argument('--reordering', type=float, default=0.0)
+    parser.add_argument('--partition', type=float, nargs=2, metavar=('START', 'END'),
+                        help="virtual time interval in which the leader is isolated from the acceptors")
+    parser.add_argument('--crash', type=float, metavar='TIME',
+                        help="virtual time at which the leader is isolated from all the other agents")
+    parser.add_argument('--duration', type=float, default=10, help="virtual seconds of each run")
+    parser.add_argument('--direct-2b', action='store_true', help="acceptors send PHASE_2B also to the learners")
+    parser.add_argument('--reads', type=int, default=0,
+                        help="values that each client proposes and reads back with a local read of the leader")
+    parser.add_argument('--groups', type=int, default=1,
+                        help="Paxos groups, --proposers and --acceptors are the processes of each group")
+    parser.add_argument('--classic', action='store_true', help="run phase 1 for every instance, without Multi-Paxos")
+    parser.add_argument('--value-size', type=int, default=0,
+                        help="characters of each value, values of at least 8192 characters are sent out of band")
+    args = parser.parse_args()
+
+    start = time.time()
+    failures = {"inconsistent": [], "invalid": [], "incomplete": [], "duplicated": [], "not linearizable": [],
+                "proposed twice": [], "classic mode": [],
+                "not recovered": []}
+    p50, p99, gaps = [], [], []
+    for seed in range(args.seed, args.seed + args.runs):
+        result = scenario(seed, args.values, args.clients, args.proposers, args.acceptors, args.learners,
+                          args.loss, args.duplication, args.reordering, args.partition, args.duration,
+                          args.quorum1, args.quorum2, args.direct_2b, args.groups, args.reads, args.crash,
+                          args.value_size, not args.classic)
+        if not result["consistent"]:
+            failures["inconsistent"].append(seed)
+        if not result["valid"]:
+            failures["invalid"].append(seed)
+        if not result["complete"]:
+            failures["incomplete"].append(seed)
+        if not result["exactly_once"]:
+            failures["duplicated"].append(seed)
+        if not result["linearizable"]:
+            failures["not linearizable"].append(seed)
+        if len(duplicate_request(seed)) != 1:
+            failures["proposed twice"].append(seed)
+        before, after = recover_after_trim(seed)
+        if before[0] == 0 or after != before:        # the log of the acceptor is checkpointed after a trim
+            failures["not recovered"].append(seed)
+        if not args.classic:        # a short run without Multi-Paxos, with the same network
+            classic = scenario(seed, 10, args.clients, args.proposers, args.acceptors, args.learners, args.loss,
+                               args.duplication, args.reordering, duration=args.duration, multi_paxos=False)
+            if not (classic["consistent"] and classic["valid"] and classic["complete"] and classic["exactly_once"]):
+                failures["classic mode"].append(seed)
+        if result["latency_ms"]["p50"] is not None:
+            p50.append(result["latency_ms"]["p50"])
+            p99.append(result["latency_ms"]["p99"])
+        if result["max_gap_ms"] is not None:
+            gaps.append(result["max_gap_ms"])
+    elapsed = time.time() - start
+
+    print(f"{args.runs} runs in {elapsed:.2f} s ({args.runs / elapsed * 60:.0f} runs per minute)")
+    for check, seeds in failures.items():
+        print(f"{check}: {len(seeds)} {seeds[:20]}")
+    if len(p50) > 0:
+        print(f"virtual latency: median p50 {sorted(p50)[len(p50) // 2]:.2f} ms, "
+              f"median p99 {sorted(p99)[len(p99) // 2]:.2f} ms, max p99 {max(p99):.2f} ms")
+    if len(gaps) > 0:
+        print(f"max time without completed operations of the readers: median {sorted(gaps)[len(gaps) // 2]:.0f} ms, "
+              f"max {max(gaps):.0f} ms")
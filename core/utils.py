@@ -5,6 +5,8 @@
 # ----------------------------------------------------------------------------------------------------
 
 PRINTING = False
+DEFAULT_NUM_ACCEPTORS = 3      # acceptors of the network if the config file does not say otherwise
+ROLES = ['clients', 'proposers', 'acceptors', 'learners']
 
 
 def greedy_leader_election(network):
@@ -34,15 +36,29 @@ def import_config(config_file):
     config = []
     with open(config_file, 'r') as f:
         for line in f.readlines():
-            if line != '':
-                role, ip, port = line.strip('\n').split(' ')
-                config.append([role, ip, port])
+            if line.strip() != '':
+                config.append(line.split())
     return config
 
 
+def majority(num_acceptors):
+
+    """ Return the size of a majority quorum of num_acceptors acceptors. """
+
+    return num_acceptors // 2 + 1
+
+
 def create_network(config):
 
     """ Convert config list to a network dictionary where the processes are divided by roles.
+        Besides the "role ip port" lines, the config can contain the lines "num_acceptors N",
+        "phase1_quorum Q1" and "phase2_quorum Q2": by default there are DEFAULT_NUM_ACCEPTORS
+        acceptors and both quorums are majorities. With Flexible Paxos the two quorums can have
+        different sizes, as long as every phase 1 quorum intersects every phase 2 quorum.
+        The line "groups K" runs K independent Paxos groups (see group_network).
+        On a network without multicast, the lines "role p_id host port" give the address of each
+        process: the agents use a UnicastTransport, and the address of a role without a
+        "role ip port" line is only the key of its processes in network['peers'].
 
         :param config: list
             The list create using the config file.
@@ -51,18 +67,65 @@ def create_network(config):
     """
 
     network = {'clients': [], 'proposers': [], 'acceptors': [], 'learners': []}
-    k = 0
+    peers = {role: {} for role in ROLES}
+    settings = {}
     for agent in config:
+        if len(agent) == 2:
+            settings[agent[0]] = int(agent[1])
+            continue
+        if len(agent) == 4:
+            peers[agent[0]][int(agent[1])] = (agent[2], int(agent[3]))
+            continue
         role, ip, port = agent[0], agent[1], int(agent[2])
         network[role] = {'ip': ip, 'port': port}
-        k += 1
+    network['peers'] = peers
+    for role in ROLES:
+        if len(peers[role]) > 0 and len(network[role]) == 0:
+            network[role] = {'ip': role, 'port': 0}
+
+    num_acceptors = settings.get('num_acceptors', DEFAULT_NUM_ACCEPTORS)
+    phase1 = settings.get('phase1_quorum', majority(num_acceptors))
+    phase2 = settings.get('phase2_quorum', majority(num_acceptors))
+    if not (1 <= phase1 <= num_acceptors and 1 <= phase2 <= num_acceptors and phase1 + phase2 > num_acceptors):
+        raise ValueError(f"quorums {phase1} and {phase2} do not intersect with {num_acceptors} acceptors")
+    network['quorums'] = {'num_acceptors': num_acceptors, 'phase1': phase1, 'phase2': phase2}
+    network['groups'] = settings.get('groups', 1)
     return network
 
 
-def print_stuff(msg):
+def group_network(network, group):
 
-    """ It just allow to easily insert or eliminate the prints """
+    """ Return the network of one of the Paxos groups: group 0 uses the ports of the config file,
+        group g uses the same ports + g. On a unicast network, the group keeps the processes
+        that belong to it, and every learner process listens on its port + g for the group g.
+
+        :param network: dict
+            The network created from the config file.
+        :param group: int
+            The group, from 0 to network['groups'] - 1.
+        :return: dict
+            The network of the processes of the group.
+    """
+
+    group_net = dict(network)
+    group_net['peers'] = {}
+    for role in ROLES:
+        group_net[role] = {'ip': network[role]['ip'], 'port': network[role]['port'] + group}
+        if role == 'learners':
+            group_net['peers'][role] = {p_id: (host, port + group)
+                                        for p_id, (host, port) in network['peers'][role].items()}
+        else:
+            group_net['peers'][role] = {p_id: address for p_id, address in network['peers'][role].items()
+                                        if (p_id - 1) % network['groups'] == group}
+    return group_net
+
+
+def print_stuff(msg, *args):
+
+    """ It just allow to easily insert or eliminate the prints. The message is formatted with args
+        only when PRINTING is on, so that the disabled prints do not format the messages on the hot path.
+    """
 
     if PRINTING:
-        print(msg)
+        print(msg.format(*args) if len(args) > 0 else msg)
 